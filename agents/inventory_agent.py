@@ -11,7 +11,7 @@ class InventoryAgent:
         if not product_id:
             return "I'd be happy to check inventory for you! Could you specify which product you're interested in?"
 
-        product = db.get_product(product_id)
+        product = db.get_catalog_product(product_id)
         if not product:
             return f"I couldn't find product #{product_id}. Could you check the product number?"
 
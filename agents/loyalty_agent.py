@@ -11,6 +11,16 @@ TIER_RANKS = {
 }
 
 
+def loyalty_tier(points: int) -> str:
+    if points >= 500:
+        return "Platinum"
+    if points >= 200:
+        return "Gold"
+    if points >= 100:
+        return "Silver"
+    return "Bronze"
+
+
 class LoyaltyAgent:
     async def apply_offers(self, user_message: str, user_context: Dict[str, Any]) -> str:
         """Apply loyalty points, coupons, and offers."""
@@ -163,13 +173,7 @@ class LoyaltyAgent:
         return response
 
     def _get_loyalty_tier(self, points: int) -> str:
-        if points >= 500:
-            return "Platinum"
-        if points >= 200:
-            return "Gold"
-        if points >= 100:
-            return "Silver"
-        return "Bronze"
+        return loyalty_tier(points)
 
     def _get_next_tier_info(self, current_points: int) -> str:
         if current_points < 100:
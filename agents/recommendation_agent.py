@@ -1,6 +1,10 @@
 from typing import List, Dict, Any
 import random
 from database import db
+from item_similarity import blend_scores
+from trending import trending
+
+SIMILARITY_SEED_LIMIT = 10
 
 class RecommendationAgent:
     async def get_recommendations(self, user_message: str, user_context: Dict[str, Any]) -> str:
@@ -9,16 +13,32 @@ class RecommendationAgent:
         # Parse user intent from message
         intent = self._parse_intent(user_message)
         
-        # Get relevant products
-        products = db.search_products(
-            category=intent.get("category"),
-            occasion=intent.get("occasion"),
-            min_price=intent.get("min_price"),
-            max_price=intent.get("max_price")
-        )
-        
-        # Filter to top 3 recommendations
-        recommendations = products[:3]
+        filters = {
+            "category": intent.get("category"),
+            "occasion": intent.get("occasion"),
+            "min_price": intent.get("min_price"),
+            "max_price": intent.get("max_price"),
+        }
+
+        # The precomputed slate is already ranked for this user; keep the entries that fit the message
+        slate = {entry.get("product_id"): entry for entry in user_context.get("recommendation_slate", [])}
+        records = db.product_records(slate)
+        matches = [
+            product_id for product_id in slate
+            if (record := records.get(product_id)) is not None and record.matches(**filters)
+        ]
+        similar = {product_id for product_id, entry in slate.items() if "similar" in entry.get("reasons", [])}
+
+        if len(matches) < 3:
+            # No slate yet, or too little of it fits: filter the catalog, then rank matches by
+            # similarity to what the user bought and browsed, and by what is trending
+            affinity = self._similar_product_scores(user_context)
+            rest = [product_id for product_id in db.matching_product_ids(**filters) if product_id not in slate]
+            rest.sort(key=lambda product_id: (-affinity.get(product_id, 0.0), -trending.score(product_id)))
+            matches.extend(rest)
+            similar.update(product_id for product_id, score in affinity.items() if score)
+
+        recommendations = db.get_products_by_ids(matches[:3])
         
         if not recommendations:
             return "I couldn't find any products matching your criteria. Could you tell me more about what you're looking for?"
@@ -32,6 +52,8 @@ class RecommendationAgent:
             response += f"   - Category: {product['dress_category']}\n"
             response += f"   - Occasion: {product['occasion']}\n"
             response += f"   - Available in: {product['colors']}\n"
+            if product['id'] in similar:
+                response += "   - Popular with shoppers who liked items you've viewed or bought\n"
             if product['stock'] > 0:
                 response += f"   - ✅ In stock ({product['stock']} available)\n"
             else:
@@ -45,6 +67,27 @@ class RecommendationAgent:
         
         return response
     
+    def _similar_product_scores(self, user_context: Dict[str, Any]) -> Dict[int, float]:
+        """Blend the precomputed neighbours of the user's recent purchases, cart and views"""
+        seeds = []
+        for order in user_context.get("past_orders", [])[:5]:
+            seeds.extend(item.get("product_id") for item in order.get("items", []))
+        seeds.extend(item.get("product_id") for item in user_context.get("cart_snapshot", []))
+        seeds.extend(
+            view.get("product_id")
+            for view in user_context.get("activity_summary", {}).get("top_product_views", [])
+        )
+        seed_ids = []
+        for product_id in seeds:
+            try:
+                seed_ids.append(int(product_id))
+            except (TypeError, ValueError):
+                continue
+        seed_ids = list(dict.fromkeys(seed_ids))[:SIMILARITY_SEED_LIMIT]
+        if not seed_ids:
+            return {}
+        return blend_scores(db.get_item_neighbours(seed_ids), exclude=seed_ids)
+
     def _parse_intent(self, message: str) -> Dict[str, Any]:
         """Parse user intent from message"""
         message_lower = message.lower()
@@ -1,25 +1,37 @@
 import os
 import re
 import logging
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Optional, Tuple
 
+import numpy as np
 import requests
 from dotenv import load_dotenv
 
+from catalog import ProductRecord
 from database import db
+from prompt_budget import PromptBudget, fold_turns_into_summary
 from schemas import Channel
+from trending import trending
 
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "").strip()
 MODEL = os.getenv("OPENROUTER_MODEL", "openrouter/sfree")
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+MAX_HISTORY_TURNS = 12
+# Messages folded into the rolling summary per request at most; the rest follow on later turns.
+SUMMARY_FOLD_BATCH = 50
+RETRIEVAL_TOP_K = 6
+# Products re-scored with live stock after the snapshot pass.
+RETRIEVAL_CANDIDATES = 200
 logger = logging.getLogger(__name__)
 
 
 class SalesAgent:
     def __init__(self):
         self.system_prompt = self._create_system_prompt()
+        self.prompt_budget = PromptBudget()
 
     def _create_system_prompt(self) -> str:
         return """You are Clara, an elite omnichannel fashion sales strategist.
@@ -61,6 +73,7 @@ Response quality bar:
         user_context: Dict[str, Any],
         channel: Channel,
         tool_outputs: List[Dict[str, Any]],
+        session_id: Optional[str] = None,
     ) -> str:
         rag_context = self._build_rag_context(user_message, user_context)
         merged_outputs = tool_outputs + [{"source": "rag_context", "content": rag_context}]
@@ -71,6 +84,7 @@ Response quality bar:
             channel=channel,
             tool_outputs=merged_outputs,
             rag_context=rag_context,
+            session_id=session_id,
         )
 
     def _generate_response(
@@ -81,16 +95,69 @@ Response quality bar:
         channel: Channel,
         tool_outputs: List[Dict[str, Any]],
         rag_context: Dict[str, Any],
+        session_id: Optional[str] = None,
     ) -> str:
-        prompt = self._build_prompt(user_context, channel, tool_outputs, rag_context)
-        messages = [{"role": "system", "content": prompt}] + history[-12:] + [{"role": "user", "content": user_message}]
+        sections = self._build_prompt_sections(user_context, channel, tool_outputs, rag_context)
+        summary_state = db.get_chat_session_summary(session_id) if session_id else {}
+        older_turns, recent_turns = history[:-MAX_HISTORY_TURNS], history[-MAX_HISTORY_TURNS:]
 
-        llm_reply = self._call_openrouter(messages)
+        assembly = self.prompt_budget.assemble(
+            sections,
+            recent_turns,
+            user_message,
+            summary=summary_state.get("conversation_summary"),
+        )
+        if session_id:
+            self._roll_summary(session_id, summary_state, history, len(older_turns) + len(assembly.dropped_turns))
+
+        started = time.perf_counter()
+        llm_reply = self._call_openrouter(assembly.messages)
+        logger.info(
+            "SalesAgent prompt | session=%s | prompt_tokens=%s | sections=%s | llm_ms=%.1f",
+            session_id,
+            assembly.total_tokens,
+            assembly.section_tokens,
+            (time.perf_counter() - started) * 1000,
+        )
         if llm_reply:
             return llm_reply
 
         return self._rule_based_response(user_message, user_context, rag_context)
 
+    def _roll_summary(
+        self,
+        session_id: str,
+        summary_state: Dict[str, Any],
+        history: List[Dict[str, Any]],
+        dropped_count: int,
+    ) -> None:
+        # History is oldest-first and the dropped turns are its prefix. Folding
+        # resumes from the stored marker in the session itself rather than in
+        # this window, so turns that left the window while deterministic replies
+        # skipped this path are still summarized.
+        if not history:
+            return
+        kept = {turn.get("id") for turn in history[dropped_count:]}
+        last_dropped = history[dropped_count - 1].get("id") if dropped_count else None
+
+        new_turns = []
+        for message in db.get_chat_messages_after(session_id, summary_state.get("summarized_until"), SUMMARY_FOLD_BATCH):
+            message_id = str(message["_id"])
+            if message_id in kept:
+                break
+            new_turns.append({"id": message_id, "role": message.get("message_type"), "content": message.get("content")})
+            if message_id == last_dropped:
+                break
+        if not new_turns:
+            return
+
+        summary = fold_turns_into_summary(
+            summary_state.get("conversation_summary", ""),
+            new_turns,
+            self.prompt_budget.section_budgets["summary"],
+        )
+        db.update_chat_session_summary(session_id, summary, new_turns[-1]["id"])
+
     def _build_prompt(
         self,
         user_context: Dict[str, Any],
@@ -98,43 +165,61 @@ Response quality bar:
         tool_outputs: List[Dict[str, Any]],
         rag_context: Dict[str, Any],
     ) -> str:
-        prompt = self.system_prompt
-        prompt += "\nCustomer Profile:\n"
-        prompt += f"- Name: {user_context.get('name', 'Customer')}\n"
-        prompt += f"- Loyalty Score: {user_context.get('loyalty_score', 0)}\n"
-        prompt += f"- Past Order Count: {len(user_context.get('past_orders', []))}\n"
-        prompt += f"- Channel: {channel.value}\n"
+        return "".join(text for _, text in self._build_prompt_sections(user_context, channel, tool_outputs, rag_context))
 
+    def _build_prompt_sections(
+        self,
+        user_context: Dict[str, Any],
+        channel: Channel,
+        tool_outputs: List[Dict[str, Any]],
+        rag_context: Dict[str, Any],
+    ) -> List[Tuple[str, str]]:
+        profile = "\nCustomer Profile:\n"
+        profile += f"- Name: {user_context.get('name', 'Customer')}\n"
+        profile += f"- Loyalty Score: {user_context.get('loyalty_score', 0)}\n"
+        profile += f"- Past Order Count: {len(user_context.get('past_orders', []))}\n"
+        profile += f"- Channel: {channel.value}\n"
+
+        memory = ""
         if user_context.get("cross_channel_memory"):
-            prompt += "\nCross-channel memory snippets:\n"
+            memory += "\nCross-channel memory snippets:\n"
             for item in user_context["cross_channel_memory"][:8]:
-                prompt += f"- {item}\n"
+                memory += f"- {item}\n"
 
-        prompt += "\nRAG Context:\n"
-        prompt += f"- Parsed Intent: {rag_context.get('intent')}\n"
-        prompt += f"- Parsed Preferences: {rag_context.get('preferences')}\n"
-        prompt += "- Matched Products:\n"
+        products = "\nRAG Context:\n"
+        products += f"- Parsed Intent: {rag_context.get('intent')}\n"
+        products += f"- Parsed Preferences: {rag_context.get('preferences')}\n"
+        products += "- Matched Products:\n"
         for product in rag_context.get("matched_products", [])[:5]:
-            prompt += (
+            products += (
                 f"  * {product['product_name']} | ${product['price']} | occasion={product['occasion']} "
                 f"| category={product['dress_category']} | stock={product['stock']} "
                 f"| colors={product.get('colors', '')} | sizes={product.get('available_sizes', '')} "
                 f"| material={product.get('material', '')} | description={product.get('description', '')[:120]}\n"
             )
 
+        tools = ""
         if tool_outputs:
-            prompt += "\nSpecialist agent outputs (may be verbose; summarize smartly):\n"
+            tools += "\nSpecialist agent outputs (may be verbose; summarize smartly):\n"
             for idx, output in enumerate(tool_outputs[:4], 1):
-                prompt += f"{idx}. {output.get('source')}: {str(output.get('content'))[:1000]}\n"
-
-        prompt += "\nHow to answer:\n"
-        prompt += "1) Start with a strong direct answer and recommendations.\n"
-        prompt += "2) Use specific products from matched products if available.\n"
-        prompt += "2a) If matched products exist, never say the catalog has no relevant items.\n"
-        prompt += "2b) Respect gender/category intent strictly when products are matched, especially men/women/kids.\n"
-        prompt += "3) If something critical is missing, ask at most 1-2 focused questions.\n"
-        prompt += "4) End with a clear next step the user can take now.\n"
-        return prompt
+                tools += f"{idx}. {output.get('source')}: {str(output.get('content'))[:1000]}\n"
+
+        instructions = "\nHow to answer:\n"
+        instructions += "1) Start with a strong direct answer and recommendations.\n"
+        instructions += "2) Use specific products from matched products if available.\n"
+        instructions += "2a) If matched products exist, never say the catalog has no relevant items.\n"
+        instructions += "2b) Respect gender/category intent strictly when products are matched, especially men/women/kids.\n"
+        instructions += "3) If something critical is missing, ask at most 1-2 focused questions.\n"
+        instructions += "4) End with a clear next step the user can take now.\n"
+
+        return [
+            ("system", self.system_prompt),
+            ("profile", profile),
+            ("memory", memory),
+            ("products", products),
+            ("tools", tools),
+            ("instructions", instructions),
+        ]
 
     def _call_openrouter(self, messages: List[Dict[str, str]]) -> str:
         if not OPENROUTER_API_KEY:
@@ -170,7 +255,7 @@ Response quality bar:
 
     def _build_rag_context(self, user_message: str, user_context: Dict[str, Any]) -> Dict[str, Any]:
         preferences = self._extract_preferences(user_message, user_context)
-        matched_products = self._retrieve_products(preferences)
+        matched_products = self._retrieve_products(preferences, user_context.get("recommendation_slate"))
         intent = self._infer_intent(user_message)
 
         logger.info(
@@ -286,9 +371,115 @@ Response quality bar:
 
         return preferences
 
-    def _retrieve_products(self, preferences: Dict[str, Any]) -> List[Dict[str, Any]]:
-        products = db.get_all_products()
-
+    def _retrieve_products(
+        self, preferences: Dict[str, Any], slate: Optional[List[Dict[str, Any]]] = None
+    ) -> List[Dict[str, Any]]:
+        """Top products for the preferences, scored over the catalog snapshot or, until it exists, product records.
+
+        Products trending overall or in their category get +1, like featured ones.
+        When the user's precomputed slate has enough products that fit the message,
+        only the slate is re-ranked; see _rerank_slate.
+
+        Everything except stock is scored from data built once per catalog version.
+        Stock changes do not bump that version, so the RETRIEVAL_CANDIDATES leaders
+        by build-time stock are re-scored with live stock levels; a product restocked
+        since the build can be missed when more candidates than that tie.
+        """
+        hot = trending.hot_products()
+        if slate:
+            products = self._rerank_slate(slate, preferences, hot)
+            if len(products) >= RETRIEVAL_TOP_K:
+                return products
+
+        snapshot = db.catalog_snapshot()
+        if snapshot is not None:
+            ids: Any = snapshot.array("id")
+            score = self._score_snapshot(snapshot, preferences)
+            hot_positions = [snapshot.position(product_id) for product_id in hot]
+            score[[position for position in hot_positions if position is not None]] += 1
+            stale_stock = snapshot.array("stock")
+        else:
+            records = list(db.iter_product_records())
+            ids = [record.id for record in records]
+            score = np.fromiter(
+                (self._score_record(record, preferences) + (record.id in hot) for record in records),
+                np.int64,
+                len(records),
+            )
+            stale_stock = np.fromiter((record.stock for record in records), np.int64, len(records))
+
+        filtered = self._is_filtered(preferences)
+        # Stock adds +1 or -2, so only products within 3 points of the k-th best can still make the cut.
+        provisional = score + np.where(stale_stock > 0, 1, -2)
+        positions = np.flatnonzero(score >= 0) if filtered else np.arange(len(score))
+        positions = positions[np.lexsort((positions, -stale_stock[positions], -provisional[positions]))]
+        if len(positions) > RETRIEVAL_TOP_K:
+            floor = provisional[positions[RETRIEVAL_TOP_K - 1]] - 3
+            positions = positions[provisional[positions] >= floor][:RETRIEVAL_CANDIDATES]
+
+        candidates = sorted(int(position) for position in positions)
+        product_ids = [ids[position].item() if snapshot is not None else ids[position] for position in candidates]
+        stock = db.get_stock_levels(product_ids)
+        scored: List[tuple[int, int, int, Any]] = []
+        for position, product_id in zip(candidates, product_ids):
+            if product_id not in stock:
+                continue  # deleted since the build
+            final = int(score[position]) + (1 if stock[product_id] > 0 else -2)
+            if not filtered or final > 0:
+                scored.append((final, stock[product_id], position, product_id))
+        scored.sort(key=lambda row: (row[0], row[1]), reverse=True)
+        scored = scored[:RETRIEVAL_TOP_K]
+
+        if snapshot is None:
+            return db.get_products_by_ids([row[3] for row in scored])
+        products = snapshot.rows(row[2] for row in scored)
+        for product in products:
+            product["stock"] = stock[product["id"]]
+        return products
+
+    def _rerank_slate(
+        self, slate: List[Dict[str, Any]], preferences: Dict[str, Any], hot: set[int]
+    ) -> List[Dict[str, Any]]:
+        """Top products of the user's slate that fit the category, occasion and price asked for.
+
+        Colors and search terms only re-rank them; ties keep the slate order.
+        """
+        by_id = db.product_records(entry.get("product_id") for entry in slate)
+        records = [by_id[entry.get("product_id")] for entry in slate if entry.get("product_id") in by_id]
+        records = [record for record in records if self._slate_matches(record, preferences)]
+        stock = db.get_stock_levels([record.id for record in records])
+        filtered = self._is_filtered(preferences)
+        scored: List[tuple[int, int, Any]] = []
+        for rank, record in enumerate(records):
+            if record.id not in stock:
+                continue
+            final = self._score_record(record, preferences) + (record.id in hot) + (1 if stock[record.id] > 0 else -2)
+            if not filtered or final > 0:
+                scored.append((final, -rank, record.id))
+        scored.sort(reverse=True)
+        return db.get_products_by_ids([row[2] for row in scored[:RETRIEVAL_TOP_K]])
+
+    def _slate_matches(self, record: ProductRecord, preferences: Dict[str, Any]) -> bool:
+        occasion = preferences.get("occasion")
+        category_prefix = preferences.get("category_prefix")
+        category_terms = preferences.get("category_terms", [])
+        if occasion and record.occasion_lower != occasion.lower():
+            return False
+        if category_prefix and not record.category_lower.startswith(f"{category_prefix}-"):
+            return False
+        if category_terms and not any(term in record.category_lower or term in record.name_lower for term in category_terms):
+            return False
+        if preferences.get("min_price") is not None and not record.price >= preferences["min_price"]:
+            return False
+        return preferences.get("max_price") is None or record.price <= preferences["max_price"]
+
+    def _is_filtered(self, preferences: Dict[str, Any]) -> bool:
+        return any(
+            preferences.get(key) for key in ("occasion", "colors", "category_prefix", "category_terms", "search_terms")
+        ) or preferences.get("min_price") is not None or preferences.get("max_price") is not None
+
+    def _score_record(self, record: ProductRecord, preferences: Dict[str, Any]) -> int:
+        """Preference score of one product, without the stock term."""
         occasion = preferences.get("occasion")
         min_price = preferences.get("min_price")
         max_price = preferences.get("max_price")
@@ -297,46 +488,67 @@ Response quality bar:
         category_terms = preferences.get("category_terms", [])
         search_terms = preferences.get("search_terms", [])
 
-        scored: List[tuple[int, Dict[str, Any]]] = []
-        for product in products:
-            score = 0
-            product_name = str(product.get("product_name", "")).lower()
-            product_category = str(product.get("dress_category", "")).lower()
-            product_description = str(product.get("description", "")).lower()
-
-            if occasion and str(product.get("occasion", "")).lower() == occasion.lower():
+        score = 0
+        if occasion and record.occasion_lower == occasion.lower():
+            score += 4
+        if category_prefix and record.category_lower.startswith(f"{category_prefix}-"):
+            score += 6
+        if category_terms:
+            if any(term in record.category_lower or term in record.name_lower for term in category_terms):
                 score += 4
-            if category_prefix and product_category.startswith(f"{category_prefix}-"):
-                score += 6
-            if category_terms:
-                if any(term in product_category or term in product_name for term in category_terms):
-                    score += 4
-            if min_price is not None and product.get("price", 0) >= min_price:
-                score += 1
-            if max_price is not None and product.get("price", 0) <= max_price:
+        if min_price is not None and record.price >= min_price:
+            score += 1
+        if max_price is not None and record.price <= max_price:
+            score += 2
+        if colors:
+            if any(color in record.colors_lower for color in colors):
                 score += 2
-            if colors:
-                product_colors = product.get("colors", "").lower()
-                if any(color in product_colors for color in colors):
-                    score += 2
-            if search_terms:
-                for term in search_terms:
-                    if term in product_name:
-                        score += 3
-                    elif term in product_category or term in product_description:
-                        score += 1
-
-            score += 1 if product.get("stock", 0) > 0 else -2
-            score += 1 if product.get("featured_dress") else 0
-
-            if occasion or min_price is not None or max_price is not None or colors or category_prefix or category_terms or search_terms:
-                if score > 0:
-                    scored.append((score, product))
-            else:
-                scored.append((score, product))
-
-        scored.sort(key=lambda row: (row[0], row[1].get("stock", 0)), reverse=True)
-        return [row[1] for row in scored[:6]]
+        for term in search_terms:
+            if term in record.name_lower:
+                score += 3
+            elif term in record.category_lower or term in record.description_lower:
+                score += 1
+        score += 1 if record.featured else 0
+        return score
+
+    def _score_snapshot(self, snapshot: Any, preferences: Dict[str, Any]) -> np.ndarray:
+        """_score_record vectorised over the memory-mapped catalog columns."""
+        occasion = preferences.get("occasion")
+        min_price = preferences.get("min_price")
+        max_price = preferences.get("max_price")
+        colors = preferences.get("colors", [])
+        category_prefix = preferences.get("category_prefix")
+        category_terms = preferences.get("category_terms", [])
+        search_terms = preferences.get("search_terms", [])
+
+        def category_contains(term: str) -> np.ndarray:
+            return snapshot.codes_where("dress_category", lambda value: term in value.lower())
+
+        score = np.zeros(len(snapshot), dtype=np.int64)
+        if occasion:
+            score += 4 * snapshot.codes_where("occasion", lambda value: value.lower() == occasion.lower())
+        if category_prefix:
+            score += 6 * snapshot.codes_where("dress_category", lambda value: value.lower().startswith(f"{category_prefix}-"))
+        if category_terms:
+            matches = np.zeros(len(snapshot), dtype=bool)
+            for term in category_terms:
+                matches |= category_contains(term) | snapshot.contains("product_name", term)
+            score += 4 * matches
+        prices = snapshot.array("price")
+        if min_price is not None:
+            score += prices >= min_price
+        if max_price is not None:
+            score += 2 * (prices <= max_price)
+        if colors:
+            matches = np.zeros(len(snapshot), dtype=bool)
+            for color in colors:
+                matches |= snapshot.contains("colors", color)
+            score += 2 * matches
+        for term in search_terms:
+            in_name = snapshot.contains("product_name", term)
+            score += np.where(in_name, 3, category_contains(term) | snapshot.contains("description", term))
+        score += snapshot.array("featured_dress")
+        return score
 
     def _infer_intent(self, message: str) -> str:
         lower = message.lower()
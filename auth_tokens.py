@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+import jwt
+
+from agents.loyalty_agent import loyalty_tier
+from cache import TTLCache
+from database import Database, db
+
+logger = logging.getLogger(__name__)
+
+JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_TTL_SECONDS = int(os.getenv("ACCESS_TOKEN_TTL_SECONDS", "900"))
+REFRESH_TOKEN_TTL_SECONDS = int(os.getenv("REFRESH_TOKEN_TTL_SECONDS", str(14 * 24 * 3600)))
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+
+
+class TokenError(ValueError):
+    """Raised for tokens that are malformed, expired, revoked or of the wrong type."""
+
+
+def _load_secret() -> str:
+    secret = os.getenv("JWT_SECRET")
+    if secret:
+        return secret
+    logger.warning(
+        "JWT_SECRET is not set; using a random per-process secret. Tokens will not survive restarts "
+        "or be accepted by other workers."
+    )
+    return secrets.token_urlsafe(48)
+
+
+class TokenService:
+    """Issue and verify signed access/refresh tokens.
+
+    Access tokens carry the user id, name and loyalty tier, so routes can trust
+    the claims after a local HMAC check instead of reading the user document.
+    Verified tokens are cached until they expire. Revoked token ids live in the
+    ``revoked_tokens`` collection and are mirrored into a local set that is
+    refreshed at most every REVOCATION_SYNC_SECONDS.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        secret: Optional[str] = None,
+        access_ttl: int = ACCESS_TOKEN_TTL_SECONDS,
+        refresh_ttl: int = REFRESH_TOKEN_TTL_SECONDS,
+        sync_interval: float = REVOCATION_SYNC_SECONDS,
+    ) -> None:
+        self._database = database
+        self._secret = secret or _load_secret()
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.sync_interval = sync_interval
+        self._verified = TTLCache("verified_tokens", maxsize=10000, ttl=access_ttl)
+        self._revoked: Set[str] = set()
+        self._revoked_synced_at = 0.0
+        self._lock = threading.Lock()
+
+    def _encode(self, claims: Dict[str, Any], token_type: str, ttl: int) -> str:
+        now = int(time.time())
+        payload = {**claims, "type": token_type, "jti": uuid.uuid4().hex, "iat": now, "exp": now + ttl}
+        return jwt.encode(payload, self._secret, algorithm=JWT_ALGORITHM)
+
+    def issue_access_token(self, user: Dict[str, Any]) -> str:
+        loyalty_score = int(user.get("loyalty_score", 0) or 0)
+        claims = {
+            "sub": str(user.get("id") or user.get("_id")),
+            "name": f"{user.get('first_name', '')} {user.get('last_name', '')}".strip(),
+            "loyalty_score": loyalty_score,
+            "tier": loyalty_tier(loyalty_score),
+        }
+        return self._encode(claims, "access", self.access_ttl)
+
+    def issue_refresh_token(self, user: Dict[str, Any]) -> str:
+        return self._encode({"sub": str(user.get("id") or user.get("_id"))}, "refresh", self.refresh_ttl)
+
+    def issue_pair(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "token": self.issue_access_token(user),
+            "refresh_token": self.issue_refresh_token(user),
+            "expires_in": self.access_ttl,
+        }
+
+    def verify(self, token: str, token_type: str = "access") -> Dict[str, Any]:
+        self._sync_revocations()
+        claims = self._verified.get(token)
+        if claims is None:
+            try:
+                claims = jwt.decode(
+                    token,
+                    self._secret,
+                    algorithms=[JWT_ALGORITHM],
+                    options={"require": ["exp", "sub", "jti", "type"]},
+                )
+            except jwt.PyJWTError as error:
+                raise TokenError(str(error)) from error
+            self._verified.set(token, claims)
+        elif claims["exp"] <= time.time():
+            self._verified.pop(token)
+            raise TokenError("Signature has expired")
+
+        if claims.get("type") != token_type:
+            raise TokenError(f"Expected a {token_type} token")
+        if claims["jti"] in self._revoked:
+            raise TokenError("Token has been revoked")
+        return claims
+
+    def revoke(self, token: str) -> None:
+        try:
+            claims = jwt.decode(token, self._secret, algorithms=[JWT_ALGORITHM], options={"verify_exp": False})
+        except jwt.PyJWTError as error:
+            raise TokenError(str(error)) from error
+        self._database.revoke_token(claims["jti"], datetime.utcfromtimestamp(claims["exp"]))
+        self._verified.pop(token)
+        with self._lock:
+            self._revoked.add(claims["jti"])
+
+    def refresh(self, refresh_token: str) -> Dict[str, Any]:
+        """Rotate a refresh token: revoke it and issue a new pair from the current user document."""
+        claims = self.verify(refresh_token, token_type="refresh")
+        user = self._database.get_user_by_id(claims["sub"])
+        if not user or not user.get("is_active", True):
+            raise TokenError("User no longer exists")
+        self.revoke(refresh_token)
+        return self.issue_pair(user)
+
+    def _sync_revocations(self) -> None:
+        now = time.monotonic()
+        if now - self._revoked_synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if now - self._revoked_synced_at < self.sync_interval:
+                return
+            self._revoked_synced_at = now
+            try:
+                self._revoked = set(self._database.get_revoked_token_ids())
+            except Exception:
+                logger.exception("Could not refresh revoked tokens; using the local list")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._verified.stats(), "revoked": len(self._revoked)}
+
+
+token_service = TokenService(db)
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the sales assistant backend.
+Run `python benchmark.py <name> --help` for the options of each benchmark.
+"""
+
+import argparse
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def print_latency(label: str, samples_ms: List[float]) -> None:
+    print(
+        f"  {label}: n={len(samples_ms)} mean={statistics.fmean(samples_ms):.3f}ms "
+        f"p50={percentile(samples_ms, 50):.3f}ms p99={percentile(samples_ms, 99):.3f}ms"
+    )
+
+
+def _synthetic_session(turns: int) -> List[Dict[str, Any]]:
+    phrases = [
+        "I need a navy dress for a wedding next month, something under $300",
+        "Do you have it in size M and is the silk version in stock?",
+        "What about something more casual for a beach vacation with my family",
+        "Can you compare the fabric and delivery time of the first two options",
+        "Add the second one to my cart and tell me about loyalty discounts",
+    ]
+    messages = []
+    for index in range(turns):
+        role = "user" if index % 2 == 0 else "assistant"
+        content = random.choice(phrases)
+        if role == "assistant":
+            content = " ".join([content] * random.randint(4, 10))
+        messages.append({"id": f"msg_{index:06d}", "role": role, "content": content})
+    return messages
+
+
+def _load_session(session_id: str) -> List[Dict[str, Any]]:
+    from database import db
+
+    messages = db.db.chat_messages.find({"session_id": session_id}).sort([("created_at", 1), ("_id", 1)])
+    return [
+        {"id": str(message["_id"]), "role": message["message_type"], "content": message["content"]}
+        for message in messages
+    ]
+
+
+def _bench_database(args: argparse.Namespace):
+    from database import Database
+
+    return Database(db_name=args.db_name)
+
+
+def bench_chat_tail(args: argparse.Namespace) -> None:
+    """Time tail-window reads and backwards paging as a session grows."""
+    database = _bench_database(args)
+    messages = database.db.chat_messages
+    started_at = datetime(2024, 1, 1)
+    for size in args.sizes:
+        session_id = f"bench_tail_{size}"
+        messages.delete_many({"session_id": session_id})
+        for start in range(0, size, 1000):
+            messages.insert_many(
+                [
+                    {
+                        "session_id": session_id,
+                        "message_type": "user" if index % 2 == 0 else "assistant",
+                        "content": f"message {index}",
+                        "created_at": started_at + timedelta(seconds=index // 10),
+                    }
+                    for index in range(start, min(size, start + 1000))
+                ]
+            )
+
+        tail_ms: List[float] = []
+        page_ms: List[float] = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            _, cursor = database.get_chat_history_page(session_id, limit=14)
+            tail_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            database.get_chat_history_page(session_id, limit=100, before=cursor)
+            page_ms.append((time.perf_counter() - started) * 1000)
+
+        print(f"Session with {size} messages")
+        print_latency("tail window (14)", tail_ms)
+        print_latency("previous page (100)", page_ms)
+        messages.delete_many({"session_id": session_id})
+
+
+def bench_prompt_replay(args: argparse.Namespace) -> None:
+    """Replay a long session turn by turn and report prompt tokens with and without the budget."""
+    from agents.sales_agent import MAX_HISTORY_TURNS, SalesAgent
+    from prompt_budget import count_tokens, fold_turns_into_summary
+    from schemas import Channel
+
+    session = _load_session(args.session_id) if args.session_id else _synthetic_session(args.turns)
+    agent = SalesAgent()
+    products = [
+        {
+            "product_name": f"Product {index}",
+            "price": 99.0 + index,
+            "occasion": "Formal",
+            "dress_category": "women-dresses",
+            "stock": 10,
+            "colors": "Black, Navy Blue",
+            "available_sizes": "XS,S,M,L",
+            "material": "Silk",
+            "description": "Floor-length gown with hand-sewn beading and a dramatic low back. " * 3,
+        }
+        for index in range(6)
+    ]
+    rag_context = {"intent": "recommendation", "preferences": {"occasion": "Formal"}, "matched_products": products}
+    user_context = {
+        "name": "Replay Customer",
+        "loyalty_score": 240,
+        "past_orders": [],
+        "cross_channel_memory": [f"user: {turn['content'][:180]}" for turn in session[:6]],
+    }
+    tool_outputs = [{"source": f"agent_{index}", "content": "x " * 800} for index in range(3)]
+    tool_outputs.append({"source": "rag_context", "content": rag_context})
+    sections = agent._build_prompt_sections(user_context, Channel.WEB, tool_outputs, rag_context)
+    unbudgeted_system = agent._build_prompt(user_context, Channel.WEB, tool_outputs, rag_context)
+
+    naive_tokens: List[int] = []
+    budget_tokens: List[int] = []
+    assemble_ms: List[float] = []
+    summary, summarized = "", 0
+    for turn_index in range(0, len(session), 2):
+        window = session[max(0, turn_index - 14):turn_index]
+        user_message = session[turn_index]["content"]
+        naive_tokens.append(
+            count_tokens(unbudgeted_system)
+            + sum(count_tokens(turn["content"]) for turn in window[-12:])
+            + count_tokens(user_message)
+        )
+
+        started = time.perf_counter()
+        recent = window[-MAX_HISTORY_TURNS:]
+        assembly = agent.prompt_budget.assemble(sections, recent, user_message, summary=summary)
+        dropped = len(window) - len(recent) + len(assembly.dropped_turns)
+        position = max(0, turn_index - 14)
+        new_turns = session[max(summarized, position):position + dropped]
+        if new_turns:
+            summary = fold_turns_into_summary(summary, new_turns, agent.prompt_budget.section_budgets["summary"])
+            summarized = position + dropped
+        assemble_ms.append((time.perf_counter() - started) * 1000)
+        budget_tokens.append(assembly.total_tokens)
+
+    print(f"Prompt replay over {len(session)} messages ({len(budget_tokens)} user turns)")
+    print(f"  budget: {agent.prompt_budget.total_tokens} tokens")
+    print(f"  unbudgeted prompt tokens: mean={statistics.fmean(naive_tokens):.0f} max={max(naive_tokens)}")
+    print(f"  budgeted prompt tokens:   mean={statistics.fmean(budget_tokens):.0f} max={max(budget_tokens)}")
+    print_latency("assembly latency", assemble_ms)
+
+
+def bench_login_storm(args: argparse.Namespace) -> None:
+    """Fire concurrent logins at a running server and probe another endpoint's latency meanwhile."""
+    import requests
+
+    base_url = args.base_url.rstrip("/")
+    email = f"bench_login_{uuid.uuid4().hex[:8]}@example.com"
+    password = "benchmark-password"
+    response = requests.post(
+        f"{base_url}/auth/register",
+        json={"email": email, "password": password, "first_name": "Bench", "last_name": "Login"},
+        timeout=30,
+    )
+    response.raise_for_status()
+
+    def probe(count: int) -> List[float]:
+        samples = []
+        with requests.Session() as session:
+            for _ in range(count):
+                started = time.perf_counter()
+                session.get(f"{base_url}/products/meta", timeout=30).raise_for_status()
+                samples.append((time.perf_counter() - started) * 1000)
+                time.sleep(0.01)
+        return samples
+
+    def login(_: int) -> float:
+        started = time.perf_counter()
+        requests.post(f"{base_url}/auth/login", json={"email": email, "password": password}, timeout=60).raise_for_status()
+        return (time.perf_counter() - started) * 1000
+
+    baseline_ms = probe(args.probes)
+    with ThreadPoolExecutor(max_workers=args.concurrency + 1) as pool:
+        storm_probe = pool.submit(probe, args.probes)
+        started = time.perf_counter()
+        login_ms = list(pool.map(login, range(args.logins)))
+        storm_seconds = time.perf_counter() - started
+        during_ms = storm_probe.result()
+
+    print(f"Login storm: {args.logins} logins, {args.concurrency} concurrent, {storm_seconds:.1f}s")
+    print(f"  throughput: {args.logins / storm_seconds:.1f} logins/s")
+    print_latency("/auth/login", login_ms)
+    print_latency("/products/meta idle", baseline_ms)
+    print_latency("/products/meta during storm", during_ms)
+
+
+def bench_oversell(args: argparse.Namespace) -> None:
+    """Let many buyers race for a few units and verify that no reservation oversells."""
+    database = _bench_database(args)
+    product_id = 900002
+    database.upsert_product(product_id, {"product_name": "Limited Drop", "price": 120.0, "stock": args.units})
+    database.db.stock_holds.delete_many({"product_id": product_id})
+
+    def buy(index: int) -> bool:
+        return database.reserve_stock(product_id, 1, user_id=f"bench_buyer_{index}", order_number=f"BENCH-{index}") is not None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.buyers) as pool:
+        outcomes = list(pool.map(buy, range(args.buyers)))
+    elapsed = time.perf_counter() - started
+
+    reserved = sum(outcomes)
+    remaining = database.db.products.find_one({"id": product_id}, {"stock": 1})["stock"]
+    held = database.db.stock_holds.count_documents({"product_id": product_id, "status": "held"})
+    oversold = max(0, reserved - args.units)
+    print(f"Oversell: {args.buyers} buyers for {args.units} units in {elapsed:.2f}s")
+    print(f"  reservations granted: {reserved}, holds stored: {held}, stock left: {remaining}")
+    print(f"  oversold units: {oversold}")
+    database.db.stock_holds.delete_many({"product_id": product_id})
+    database.delete_products({"id": product_id})
+    if oversold or remaining < 0 or held != reserved:
+        raise SystemExit(1)
+
+
+def _synthetic_products(count: int, first_id: int) -> List[Dict[str, Any]]:
+    rng = random.Random(count)
+    categories = ["women-dresses", "women-sarees", "women-kurtas", "men-shirts", "men-blazers", "kids-frocks"]
+    occasions = ["Wedding", "Party", "Casual", "Office", "Festive", "Beach"]
+    colors = ["Navy Blue", "Maroon", "Emerald", "Ivory", "Black", "Mustard", "Blush Pink", "Teal"]
+    materials = ["Silk", "Cotton", "Linen", "Georgette", "Chiffon", "Velvet", "Rayon"]
+    styles = ["Embroidered", "Printed", "Pleated", "Wrap", "Anarkali", "Slim Fit", "Tiered", "Handloom"]
+    products = []
+    for offset in range(count):
+        category = rng.choice(categories)
+        material = rng.choice(materials)
+        style = rng.choice(styles)
+        garment = category.split("-", 1)[1]
+        garment = (garment[:-2] if garment.endswith("sses") else garment.rstrip("s")).title()
+        product_colors = rng.sample(colors, 3)
+        products.append(
+            {
+                "id": first_id + offset,
+                "product_name": f"{style} {material} {garment} {offset}",
+                "description": f"{style.lower()} {garment.lower()} in soft {material.lower()} for {rng.choice(occasions).lower()} wear",
+                "dress_category": category,
+                "occasion": rng.choice(occasions),
+                "colors": ",".join(product_colors),
+                "material": material,
+                "price": round(rng.uniform(15, 900), 2),
+                "stock": rng.randint(0, 50),
+                "bench_catalog": True,
+            }
+        )
+    return products
+
+
+def bench_search(args: argparse.Namespace) -> None:
+    """Compare the ranked in-memory search with the old regex scan on a large synthetic catalog."""
+    import re
+
+    from catalog import ProductSearchIndex
+
+    database = _bench_database(args)
+    products = database.db.products
+    database.delete_products({"bench_catalog": True})
+    started = time.perf_counter()
+    for start in range(0, args.products, 5000):
+        database.insert_products(_synthetic_products(min(5000, args.products - start), 1_000_000 + start))
+    database.normalize_catalog_keys()
+    print(f"Search: {args.products} products loaded in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    database.product_search_index()
+    print(f"  index build: {(time.perf_counter() - started) * 1000:.0f}ms, {database.product_search_index().stats()}")
+
+    queries = ["silk saree", "embroidered navy", "weding", "chifon", "pleat", "velvet blazer party"]
+    index: ProductSearchIndex = database.product_search_index()
+    for query in queries:
+        memory_ms, ranked_ms, regex_ms = [], [], []
+        hits = legacy_hits = 0
+        escaped = re.escape(query)
+        legacy_filter = {
+            "$or": [
+                {field: {"$regex": escaped, "$options": "i"}}
+                for field in ("product_name", "description", "dress_category", "occasion")
+            ]
+        }
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            index.search(query, limit=20)
+            memory_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            hits = len(database.search_products(category=args.category, query=query))
+            ranked_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            legacy_hits = sum(1 for _ in products.find(legacy_filter, {"_id": 1}))
+            regex_ms.append((time.perf_counter() - started) * 1000)
+        print(f"Query {query!r}: {hits} ranked hits, {legacy_hits} regex hits")
+        print_latency("index only (top 20)", memory_ms)
+        print_latency("search_products", ranked_ms)
+        print_latency("regex scan (ids only)", regex_ms)
+
+    database.delete_products({"bench_catalog": True})
+
+
+def bench_suggest(args: argparse.Namespace) -> None:
+    """Build the autocomplete index over a synthetic catalog and time prefix lookups."""
+    from catalog import SuggestionIndex
+
+    products = _synthetic_products(args.products, 1)
+    rng = random.Random(7)
+    views = {rng.randint(1, args.products): rng.randint(1, 50) for _ in range(args.products // 5)}
+    index = SuggestionIndex()
+    started = time.perf_counter()
+    index.update(products, views, 1)
+    print(f"Suggest: {args.products} products, built in {time.perf_counter() - started:.2f}s")
+    print(f"  {index.stats()}")
+
+    prefixes = ["s", "si", "silk", "silk s", "emb", "navy b", "wed", "anark", "pleated ch", "xyz"]
+    samples_ms: List[float] = []
+    for _ in range(args.repeat):
+        for prefix in prefixes:
+            started = time.perf_counter()
+            index.suggest(prefix)
+            samples_ms.append((time.perf_counter() - started) * 1000)
+    print_latency("suggest", samples_ms)
+
+    added = _synthetic_products(args.added, args.products + 1)
+    started = time.perf_counter()
+    index.update(products + added, views, 2)
+    print(f"  +{args.added} products merged in {time.perf_counter() - started:.2f}s ({index.stats()['incremental_updates']} incremental)")
+
+
+def bench_pagination(args: argparse.Namespace) -> None:
+    """Walk the product listing page by page and compare keyset cursors with skip/limit."""
+    import json
+
+    from bson import json_util
+
+    from database import PRODUCT_LIST_PROJECTION
+
+    database = _bench_database(args)
+    products = database.db.products
+    database.delete_products({"bench_catalog": True})
+    total = args.pages * args.limit + args.limit
+    for start in range(0, total, 5000):
+        database.insert_products(_synthetic_products(min(5000, total - start), 2_000_000 + start))
+    print(f"Pagination: {total} products, {args.limit} per page")
+
+    checkpoints = {1, 10, 100, args.pages}
+    cursor = None
+    for page in range(1, args.pages + 1):
+        started = time.perf_counter()
+        documents, next_cursor = database.list_products_page(limit=args.limit, cursor=cursor)
+        keyset_ms = (time.perf_counter() - started) * 1000
+        if page in checkpoints:
+            started = time.perf_counter()
+            list(products.find({}, PRODUCT_LIST_PROJECTION).sort("_id", 1).skip((page - 1) * args.limit).limit(args.limit))
+            skip_ms = (time.perf_counter() - started) * 1000
+            size = len(json.dumps({"products": documents, "next_cursor": next_cursor}, default=json_util.default))
+            print(f"  page {page}: keyset {keyset_ms:.2f}ms, skip {skip_ms:.2f}ms, {size} bytes")
+        cursor = next_cursor
+
+    database.delete_products({"bench_catalog": True})
+
+
+def bench_product_records(args: argparse.Namespace) -> None:
+    """Bytes per product held as raw documents versus ProductRecord."""
+    import gc
+    import tracemalloc
+
+    from catalog import ProductRecord
+
+    def measure(build: Any) -> tuple[Any, float]:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            held = build()
+            gc.collect()
+            allocated, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return held, allocated
+
+    def documents() -> List[Dict[str, Any]]:
+        # Shaped like a pymongo result: every field, strings freshly decoded per document.
+        products = _synthetic_products(args.products, 1)
+        for product in products:
+            product["available_sizes"] = "XS,S,M,L,XL"
+            product["image_url"] = f"https://cdn.example.com/catalog/{product['id']}/front-1200x1600.jpg"
+            product["description"] = (product["description"] + " ") * 3
+        return products
+
+    products, document_bytes = measure(documents)
+    records, record_bytes = measure(lambda: [ProductRecord(product) for product in products])
+    started = time.perf_counter()
+    [ProductRecord(product) for product in products]
+    build_ms = (time.perf_counter() - started) * 1000
+    print(f"Product records: {args.products} products, records built in {build_ms:.0f}ms")
+    print(f"  raw documents:  {document_bytes / args.products:,.0f} bytes/product")
+    print(f"  ProductRecord:  {record_bytes / len(records):,.0f} bytes/product")
+
+
+def bench_trending(args: argparse.Namespace) -> None:
+    """Update throughput and top-N latency of the in-memory trending index."""
+    from trending import TRENDING_WEIGHTS, TrendingIndex
+
+    rng = random.Random(11)
+    categories = [f"category-{number}" for number in range(args.categories)]
+    product_categories = {product_id: rng.choice(categories) for product_id in range(1, args.products + 1)}
+    # Skewed towards a hot head of the catalog, like real traffic.
+    product_ids = [min(int(rng.paretovariate(0.5)), args.products) for _ in range(args.events)]
+    activity_types = rng.choices(list(TRENDING_WEIGHTS), weights=[20, 4, 1], k=args.events)
+    index = TrendingIndex()
+    start_at = time.time()
+    spacing = args.hours * 3600 / args.events
+
+    started = time.perf_counter()
+    for number, (product_id, activity_type) in enumerate(zip(product_ids, activity_types)):
+        index.record(product_id, product_categories[product_id], TRENDING_WEIGHTS[activity_type], start_at + number * spacing)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Trending: {args.events} events over {args.products} products in {args.categories} categories "
+        f"spanning {args.hours}h: {args.events / elapsed:,.0f} updates/s ({elapsed / args.events * 1e6:.1f}us each)"
+    )
+    print(f"  {index.stats()}")
+
+    samples_ms: List[float] = []
+    for _ in range(args.repeat):
+        category = rng.choice(categories + [None])
+        started = time.perf_counter()
+        index.top(category, 20)
+        samples_ms.append((time.perf_counter() - started) * 1000)
+    print_latency("top 20", samples_ms)
+
+
+def _snapshot_rss_worker(mode: str, path: str, products: int, barrier: Any, results: Any) -> None:
+    from catalog_snapshot import CatalogSnapshot, process_memory
+
+    catalog: Any = None
+    if mode == "dicts":
+        catalog = _synthetic_products(products, 1)
+        sum(1 for product in catalog if "silk" in product["description"])
+    elif mode == "snapshot":
+        catalog = CatalogSnapshot(path)
+        # Touch every column a request would: filters, substring scans and a few rows.
+        matches = catalog.filter_mask("women", max_price=500) & catalog.contains("description", "silk")
+        catalog.contains("product_name", "embroidered")
+        catalog.contains("colors", "navy")
+        catalog.rows(matches.nonzero()[0][:6])
+    barrier.wait()
+    results.put((mode, process_memory()))
+    barrier.wait()  # keep every worker alive until all have measured, so PSS splits the shared pages
+
+
+def bench_snapshot_rss(args: argparse.Namespace) -> None:
+    """Per-worker memory with the catalog loaded as dicts versus mapped from one shared snapshot."""
+    import multiprocessing
+    import os
+    import tempfile
+
+    from catalog_snapshot import write_snapshot
+
+    directory = tempfile.mkdtemp(prefix="catalog_snapshot_bench_")
+    path = os.path.join(directory, "catalog.snap")
+    started = time.perf_counter()
+    write_snapshot(_synthetic_products(args.products, 1), path, 1)
+    print(
+        f"Snapshot: {args.products} products, {os.path.getsize(path) / 2**20:.1f}MB written "
+        f"in {time.perf_counter() - started:.2f}s; {args.workers} workers per mode"
+    )
+
+    context = multiprocessing.get_context("spawn")
+    for mode in ("baseline", "dicts", "snapshot"):
+        barrier = context.Barrier(args.workers + 1)
+        results = context.Queue()
+        workers = [
+            context.Process(target=_snapshot_rss_worker, args=(mode, path, args.products, barrier, results))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        memory = [results.get()[1] for _ in workers]
+        barrier.wait()
+        for worker in workers:
+            worker.join()
+        rss = [entry.get("rss_mb", 0.0) for entry in memory]
+        pss = [entry.get("pss_mb", 0.0) for entry in memory]
+        print(
+            f"  {mode:<8} RSS per worker {statistics.mean(rss):.1f}MB (anon {statistics.mean(entry.get('rss_anon_mb', 0.0) for entry in memory):.1f}MB), "
+            f"PSS per worker {statistics.mean(pss):.1f}MB, PSS total {sum(pss):.1f}MB"
+        )
+
+    os.unlink(path)
+    os.rmdir(directory)
+
+
+def bench_checkout(args: argparse.Namespace) -> None:
+    """Run concurrent checkouts against a disposable database and report latency percentiles."""
+    import os
+
+    # The commerce service uses the module-level Database, so point it at the benchmark database.
+    os.environ["MONGODB_DB_NAME"] = args.db_name
+    if args.mongodb_uri:
+        os.environ["MONGODB_URI"] = args.mongodb_uri
+    from commerce_service import commerce_service
+    from database import db
+
+    product_id = 900001
+    db.upsert_product(product_id, {"product_name": "Benchmark Tee", "price": 49.0, "stock": 10**9})
+    users = [f"bench_checkout_{index}" for index in range(args.checkouts)]
+    db.db.carts.delete_many({"user_id": {"$in": users}})
+    db.db.carts.insert_many(
+        [{"user_id": user_id, "items": [{"product_id": product_id, "quantity": 1, "price": 49.0}]} for user_id in users]
+    )
+
+    def checkout(user_id: str) -> float:
+        started = time.perf_counter()
+        commerce_service.create_checkout(user_id, "1 Bench Street", "1 Bench Street", "card", "success")
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        samples = list(pool.map(checkout, users))
+    elapsed = time.perf_counter() - started
+
+    mode = "transaction" if db.supports_transactions else "ordered writes with rollback"
+    print(f"Checkout: {len(samples)} orders, {args.concurrency} concurrent, {mode}")
+    print(f"  throughput: {len(samples) / elapsed:.1f} checkouts/s")
+    print_latency("create_checkout", samples)
+
+    for collection_name in ("orders", "payments", "user_activity", "commerce_events", "notifications", "call_workflows"):
+        db.db[collection_name].delete_many({"user_id": {"$in": users}})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    replay = subparsers.add_parser("prompt-replay", help="Prompt size for a replayed long session")
+    replay.add_argument("--turns", type=int, default=400)
+    replay.add_argument("--session-id", help="Replay a stored session instead of a synthetic one")
+    replay.set_defaults(func=bench_prompt_replay)
+
+    tail = subparsers.add_parser("chat-tail", help="Chat history tail latency as sessions grow")
+    tail.add_argument("--db-name", default="abfrl_fashion_benchmark")
+    tail.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    tail.add_argument("--repeat", type=int, default=200)
+    tail.set_defaults(func=bench_chat_tail)
+
+    checkout = subparsers.add_parser(
+        "checkout",
+        help="Concurrent checkout latency; point --mongodb-uri at a single-node replica set to use transactions",
+    )
+    checkout.add_argument("--db-name", default="abfrl_fashion_benchmark")
+    checkout.add_argument("--mongodb-uri", help="e.g. mongodb://localhost:27017/?replicaSet=rs0")
+    checkout.add_argument("--checkouts", type=int, default=1000)
+    checkout.add_argument("--concurrency", type=int, default=100)
+    checkout.set_defaults(func=bench_checkout)
+
+    oversell = subparsers.add_parser("oversell", help="Concurrent stock reservations for a scarce product")
+    oversell.add_argument("--db-name", default="abfrl_fashion_benchmark")
+    oversell.add_argument("--buyers", type=int, default=500)
+    oversell.add_argument("--units", type=int, default=10)
+    oversell.set_defaults(func=bench_oversell)
+
+    search = subparsers.add_parser("search", help="Free-text product search latency on a large catalog")
+    search.add_argument("--db-name", default="abfrl_fashion_benchmark")
+    search.add_argument("--products", type=int, default=100_000)
+    search.add_argument("--repeat", type=int, default=20)
+    search.add_argument("--category", help="Also apply a category filter, e.g. women")
+    search.set_defaults(func=bench_search)
+
+    suggest = subparsers.add_parser("suggest", help="Autocomplete lookup latency on a large in-memory catalog")
+    suggest.add_argument("--products", type=int, default=100_000)
+    suggest.add_argument("--added", type=int, default=1000)
+    suggest.add_argument("--repeat", type=int, default=1000)
+    suggest.set_defaults(func=bench_suggest)
+
+    pagination = subparsers.add_parser("pagination", help="Keyset vs skip/limit page latency deep into a listing")
+    pagination.add_argument("--db-name", default="abfrl_fashion_benchmark")
+    pagination.add_argument("--pages", type=int, default=1000)
+    pagination.add_argument("--limit", type=int, default=20)
+    pagination.set_defaults(func=bench_pagination)
+
+    records = subparsers.add_parser("product-records", help="Bytes per product for raw documents vs ProductRecord")
+    records.add_argument("--products", type=int, default=100_000)
+    records.set_defaults(func=bench_product_records)
+
+    trending_bench = subparsers.add_parser("trending", help="Trending index update throughput and top-N latency")
+    trending_bench.add_argument("--events", type=int, default=1_000_000)
+    trending_bench.add_argument("--products", type=int, default=100_000)
+    trending_bench.add_argument("--categories", type=int, default=30)
+    trending_bench.add_argument("--hours", type=float, default=24 * 30, help="Time span the events are spread over")
+    trending_bench.add_argument("--repeat", type=int, default=1000)
+    trending_bench.set_defaults(func=bench_trending)
+
+    snapshot_rss = subparsers.add_parser("snapshot-rss", help="Per-worker memory for dict-loaded vs memory-mapped catalog")
+    snapshot_rss.add_argument("--products", type=int, default=100_000)
+    snapshot_rss.add_argument("--workers", type=int, default=4)
+    snapshot_rss.set_defaults(func=bench_snapshot_rss)
+
+    storm = subparsers.add_parser("login-storm", help="Endpoint latency while /auth/login is under load")
+    storm.add_argument("--base-url", default="http://127.0.0.1:8000")
+    storm.add_argument("--logins", type=int, default=200)
+    storm.add_argument("--concurrency", type=int, default=32)
+    storm.add_argument("--probes", type=int, default=100)
+    storm.set_defaults(func=bench_login_storm)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
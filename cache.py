@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache with an optional per-entry time-to-live.
+
+    Entries are evicted least-recently-used first once ``maxsize`` is reached;
+    with ``ttl`` set, entries older than ``ttl`` seconds are treated as misses.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class FrequencyLRUCache:
+    """Cache that evicts the entry with the lowest recency-weighted access frequency.
+
+    Every access adds one to an entry's weight after decaying the old weight
+    by half per ``half_life`` seconds, so entries that are hit often stay even
+    if a burst of one-off keys arrives, while entries that stopped being hit
+    fade out. Ties go to the least recently used entry. ``maxsize`` is meant
+    to stay small (hundreds), as eviction scans all entries.
+    """
+
+    def __init__(self, name: str, maxsize: int = 256, ttl: Optional[float] = None, half_life: float = 300.0) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.half_life = half_life
+        # key -> [stored_at, last_access, weight, value]
+        self._entries: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _weight(self, entry: list, now: float) -> float:
+        return entry[2] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and now - entry[0] > self.ttl):
+                self.misses += 1
+                return default
+            entry[2] = self._weight(entry, now) + 1
+            entry[1] = now
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Read without counting an access, e.g. for background refreshes."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[0] > self.ttl):
+                return default
+            return entry[3]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Refreshing a value keeps the frequency it earned.
+                entry[0], entry[3] = now, value
+                self._entries.move_to_end(key)
+                return
+            while len(self._entries) >= self.maxsize:
+                victim = min(self._entries, key=lambda item: self._weight(self._entries[item], now))
+                del self._entries[victim]
+                self.evictions += 1
+            self._entries[key] = [now, now, 1.0, value]
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "half_life_seconds": self.half_life,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class BroadcastInvalidator:
+    """Share cache invalidations between worker processes through one Mongo document.
+
+    Each invalidation bumps ``version`` and appends the key to a bounded
+    ``recent`` list on the ``cache_versions`` document for the namespace.
+    Workers poll that document at most every ``poll_interval`` seconds and drop
+    the keys published since the version they last saw, or clear the whole
+    cache when they fell too far behind.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        collection_getter,
+        cache: TTLCache,
+        poll_interval: float = 2.0,
+        history: int = 200,
+    ) -> None:
+        self.namespace = namespace
+        self._collection_getter = collection_getter
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.history = history
+        self._seen_version: Optional[int] = None
+        self._last_poll = 0.0
+        self._lock = threading.Lock()
+        self.remote_invalidations = 0
+
+    def publish(self, key: Hashable) -> None:
+        self.cache.pop(key)
+        self._collection_getter().update_one(
+            {"_id": self.namespace},
+            {"$inc": {"version": 1}, "$push": {"recent": {"$each": [key], "$slice": -self.history}}},
+            upsert=True,
+        )
+
+    def sync(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_poll < self.poll_interval:
+            return
+        with self._lock:
+            if not force and now - self._last_poll < self.poll_interval:
+                return
+            self._last_poll = now
+            state = self._collection_getter().find_one({"_id": self.namespace}) or {}
+            version = int(state.get("version", 0))
+            if self._seen_version is None or version == self._seen_version:
+                self._seen_version = version
+                return
+
+            recent = state.get("recent", [])
+            missed = version - self._seen_version
+            if 0 < missed <= len(recent):
+                for key in recent[-missed:]:
+                    self.cache.pop(key)
+            else:
+                self.cache.clear()
+            self.remote_invalidations += max(missed, 0)
+            self._seen_version = version
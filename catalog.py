@@ -0,0 +1,583 @@
+"""
+In-process inverted index for free-text product search.
+
+The index maps lowercase tokens from the searchable product fields to the
+product ids that contain them, weighted by field. A query term matches its
+exact token, any token it is a prefix of, and (when neither exists) tokens one
+edit away, so "dres", "weding" and "dress" all find dresses. Results are
+ranked by a field-weighted idf score. Structured filters (category, occasion,
+price) are left to MongoDB, which applies them to the returned ids.
+
+The index is rebuilt when the catalog version in ``catalog_meta`` changes, and
+searches keep using the previous snapshot while a rebuild is running.
+
+SuggestionIndex serves search-box autocomplete from a sorted prefix array over
+the same catalog, ranked by product views.
+
+ProductRecord is the compact, pre-normalized form of a product used by the
+in-memory scorers, so hot loops don't re-lowercase and re-split raw documents.
+"""
+
+from __future__ import annotations
+
+import bisect
+import heapq
+import logging
+import math
+import re
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+FIELD_WEIGHTS: Dict[str, float] = {
+    "product_name": 3.0,
+    "dress_category": 2.0,
+    "occasion": 2.0,
+    "colors": 1.5,
+    "description": 1.0,
+    "material": 0.5,
+}
+SEARCH_PROJECTION: Dict[str, int] = {"_id": 0, "id": 1, **{field: 1 for field in FIELD_WEIGHTS}}
+
+PREFIX_FACTOR = 0.7
+TYPO_FACTOR = 0.5
+MIN_PREFIX_LENGTH = 2
+MIN_TYPO_LENGTH = 4
+MAX_PREFIX_EXPANSIONS = 50
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: Any) -> List[str]:
+    return _TOKEN_PATTERN.findall(str(text or "").lower())
+
+
+def normalize_key(value: Any) -> Optional[str]:
+    """Lowercase key stored next to category/occasion so exact filters can use an index."""
+    key = str(value or "").strip().lower()
+    return key or None
+
+
+RECORD_PROJECTION: Dict[str, int] = {
+    "_id": 0,
+    **{
+        field: 1
+        for field in (
+            "id", "product_name", "dress_category", "occasion", "colors", "available_sizes",
+            "description", "price", "stock", "featured_dress",
+        )
+    },
+}
+
+
+def _split_list(value: Any) -> Tuple[str, ...]:
+    return tuple(sys.intern(part.strip()) for part in str(value or "").split(",") if part.strip())
+
+
+class ProductRecord:
+    """The fields the scorers read, normalized once per catalog version.
+
+    Category, occasion, color and size strings repeat across the catalog and
+    are interned, so each distinct value is stored once per worker.
+    """
+
+    __slots__ = (
+        "id", "name", "category", "occasion", "price", "stock", "featured", "colors", "sizes",
+        "name_lower", "category_lower", "occasion_lower", "colors_lower", "description_lower",
+    )
+
+    def __init__(self, product: Dict[str, Any]) -> None:
+        price = product.get("price")
+        stock = product.get("stock")
+        self.id = product.get("id")
+        self.name = str(product.get("product_name") or "")
+        self.category = sys.intern(str(product.get("dress_category") or ""))
+        self.occasion = sys.intern(str(product.get("occasion") or ""))
+        # NaN fails every price comparison, like a missing price in a MongoDB range query.
+        self.price = price if isinstance(price, (int, float)) and not isinstance(price, bool) else math.nan
+        self.stock = stock if isinstance(stock, int) else 0
+        self.featured = bool(product.get("featured_dress"))
+        self.colors = _split_list(product.get("colors"))
+        self.sizes = _split_list(product.get("available_sizes"))
+        self.name_lower = self.name.lower()
+        self.category_lower = sys.intern(self.category.lower())
+        self.occasion_lower = sys.intern(self.occasion.lower())
+        self.colors_lower = sys.intern(str(product.get("colors") or "").lower())
+        self.description_lower = str(product.get("description") or "").lower()
+
+    def matches(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> bool:
+        """The structured part of Database._catalog_filters, on normalized keys."""
+        if category:
+            category_key = normalize_key(category)
+            if category_key in {"women", "men", "kids"}:
+                if not self.category_lower.strip().startswith(f"{category_key}-"):
+                    return False
+            elif self.category_lower.strip() != category_key:
+                return False
+        if occasion and self.occasion_lower.strip() != normalize_key(occasion):
+            return False
+        if min_price is not None and not self.price >= min_price:
+            return False
+        if max_price is not None and not self.price <= max_price:
+            return False
+        return True
+
+    def __repr__(self) -> str:
+        return f"ProductRecord(id={self.id!r}, name={self.name!r})"
+
+
+def _deletes(token: str) -> Set[str]:
+    return {token[:index] + token[index + 1 :] for index in range(len(token))}
+
+
+def _within_one_edit(left: str, right: str) -> bool:
+    """Damerau-Levenshtein distance <= 1 (one insert, delete, substitution or adjacent swap)."""
+    if left == right:
+        return True
+    if abs(len(left) - len(right)) > 1:
+        return False
+    if len(left) == len(right):
+        diffs = [index for index, (a, b) in enumerate(zip(left, right)) if a != b]
+        if len(diffs) == 1:
+            return True
+        return (
+            len(diffs) == 2
+            and diffs[1] == diffs[0] + 1
+            and left[diffs[0]] == right[diffs[1]]
+            and left[diffs[1]] == right[diffs[0]]
+        )
+    shorter, longer = (left, right) if len(left) < len(right) else (right, left)
+    return any(longer[:index] + longer[index + 1 :] == shorter for index in range(len(longer)))
+
+
+class _Snapshot:
+    __slots__ = ("version", "postings", "vocabulary", "variants", "idf", "size")
+
+    def __init__(
+        self,
+        version: Any,
+        postings: Dict[str, Dict[int, float]],
+        variants: Dict[str, Set[str]],
+        size: int,
+    ) -> None:
+        self.version = version
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+        self.variants = variants
+        self.size = size
+        self.idf = {token: math.log(1 + size / len(ids)) for token, ids in postings.items()}
+
+
+class ProductSearchIndex:
+    """Ranked, typo-tolerant free-text search over product ids."""
+
+    def __init__(self) -> None:
+        self._snapshot: Optional[_Snapshot] = None
+        self._rebuild_lock = threading.Lock()
+        self.builds = 0
+        self.last_build_seconds = 0.0
+
+    @property
+    def version(self) -> Any:
+        return self._snapshot.version if self._snapshot is not None else None
+
+    def __len__(self) -> int:
+        return self._snapshot.size if self._snapshot is not None else 0
+
+    def build(self, products: Iterable[Dict[str, Any]], version: Any = None) -> None:
+        started = time.perf_counter()
+        postings: Dict[str, Dict[int, float]] = {}
+        size = 0
+        for product in products:
+            product_id = product.get("id")
+            if product_id is None:
+                continue
+            size += 1
+            for field, weight in FIELD_WEIGHTS.items():
+                for token in tokenize(product.get(field)):
+                    ids = postings.setdefault(token, {})
+                    ids[product_id] = ids.get(product_id, 0.0) + weight
+
+        variants: Dict[str, Set[str]] = {}
+        for token in postings:
+            if len(token) >= MIN_TYPO_LENGTH - 1:
+                for variant in _deletes(token) | {token}:
+                    variants.setdefault(variant, set()).add(token)
+
+        self._snapshot = _Snapshot(version, postings, variants, size)
+        self.builds += 1
+        self.last_build_seconds = time.perf_counter() - started
+        logger.info(
+            "Built product search index v%s: %s products, %s tokens in %.2fs",
+            version,
+            size,
+            len(postings),
+            self.last_build_seconds,
+        )
+
+    def ensure(self, version: Any, loader: Callable[[], Iterable[Dict[str, Any]]]) -> None:
+        """Rebuild from ``loader()`` when ``version`` moved on.
+
+        Only one thread rebuilds; the others keep searching the previous
+        snapshot, and only block when there is no snapshot at all yet.
+        """
+        if self.version == version:
+            return
+        blocking = self._snapshot is None
+        if not self._rebuild_lock.acquire(blocking=blocking):
+            return
+        try:
+            if self.version != version:
+                self.build(loader(), version)
+        finally:
+            self._rebuild_lock.release()
+
+    def _expand(self, snapshot: _Snapshot, term: str) -> Dict[str, float]:
+        expansions: Dict[str, float] = {}
+        if term in snapshot.postings:
+            expansions[term] = 1.0
+        if len(term) >= MIN_PREFIX_LENGTH:
+            start = bisect.bisect_left(snapshot.vocabulary, term)
+            end = bisect.bisect_left(snapshot.vocabulary, term + "\uffff")
+            completions = [token for token in snapshot.vocabulary[start:end] if token != term]
+            if len(completions) > MAX_PREFIX_EXPANSIONS:
+                completions.sort(key=lambda token: len(snapshot.postings[token]), reverse=True)
+                completions = completions[:MAX_PREFIX_EXPANSIONS]
+            for token in completions:
+                expansions[token] = PREFIX_FACTOR
+        if not expansions and len(term) >= MIN_TYPO_LENGTH:
+            candidates: Set[str] = set()
+            for variant in _deletes(term) | {term}:
+                candidates |= snapshot.variants.get(variant, set())
+            for token in candidates:
+                if _within_one_edit(term, token):
+                    expansions[token] = TYPO_FACTOR
+        return expansions
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Return ``(product_id, score)`` pairs, best first.
+
+        Every query term that matches something must match the product; terms
+        that match nothing at all (stop words, gibberish) are ignored.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+
+        matched: Optional[Set[int]] = None
+        scores: Dict[int, float] = {}
+        for term in dict.fromkeys(tokenize(query)):
+            term_scores: Dict[int, float] = {}
+            for token, factor in self._expand(snapshot, term).items():
+                idf = snapshot.idf[token]
+                for product_id, weight in snapshot.postings[token].items():
+                    score = idf * weight * factor
+                    if score > term_scores.get(product_id, 0.0):
+                        term_scores[product_id] = score
+            if not term_scores:
+                continue
+            matched = set(term_scores) if matched is None else matched & term_scores.keys()
+            for product_id, score in term_scores.items():
+                scores[product_id] = scores.get(product_id, 0.0) + score
+
+        if not matched:
+            return []
+        # Ties break on product id so cursors over the ranking are stable.
+        ranked = sorted(
+            ((product_id, scores[product_id]) for product_id in matched),
+            key=lambda item: (-item[1], item[0]),
+        )
+        return ranked[:limit] if limit is not None else ranked
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "version": self.version,
+            "products": len(self),
+            "tokens": len(snapshot.postings) if snapshot is not None else 0,
+            "builds": self.builds,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+        }
+
+
+SUGGEST_FIELDS: Dict[str, str] = {
+    "product_name": "product",
+    "dress_category": "category",
+    "occasion": "occasion",
+    "colors": "color",
+    "material": "material",
+}
+SUGGEST_PROJECTION: Dict[str, int] = {"_id": 0, "id": 1, **{field: 1 for field in SUGGEST_FIELDS}}
+SUGGEST_TOP_K = 10
+# Prefixes matching more keys than this get their top-k precomputed; smaller ranges are scanned.
+SUGGEST_SCAN_LIMIT = 128
+
+
+def _suggest_values(product: Dict[str, Any], field: str) -> List[str]:
+    value = product.get(field)
+    if not value:
+        return []
+    if field in {"colors", "material"}:
+        return [part.strip() for part in str(value).split(",") if part.strip()]
+    return [str(value).strip()]
+
+
+def _suggest_keys(text: str) -> List[str]:
+    """Lookup keys for a suggestion: the normalized text from each word start, skipping bare numbers."""
+    words = tokenize(text)
+    return [" ".join(words[index:]) for index, word in enumerate(words) if not word.isdigit()]
+
+
+class _SuggestSnapshot:
+    __slots__ = ("version", "keys", "sids", "heads", "texts", "kinds", "product_ids", "scores", "lookup")
+
+    def __init__(self, version: Any) -> None:
+        self.version = version
+        self.keys: List[str] = []
+        self.sids: List[int] = []
+        self.heads: Dict[str, List[int]] = {}
+        self.texts: List[str] = []
+        self.kinds: List[str] = []
+        self.product_ids: List[Optional[int]] = []
+        self.scores: List[float] = []
+        # (kind, normalized text) -> suggestion id for the shared, non-product suggestions
+        self.lookup: Dict[Tuple[str, str], int] = {}
+
+
+class SuggestionIndex:
+    """Prefix autocomplete over product names, categories, occasions, colours and materials.
+
+    Every suggestion is stored under the normalized text starting at each of
+    its words, in one sorted key array. A prefix maps to a contiguous range of
+    that array; ranges larger than SUGGEST_SCAN_LIMIT have their top-k
+    suggestions precomputed, smaller ones are ranked on the fly, so a lookup
+    never touches more than SUGGEST_SCAN_LIMIT keys.
+
+    Suggestions are ranked by product views (summed over the products that
+    carry a category, colour, etc.). When the catalog only gained products the
+    new entries are merged into the existing arrays; removals and edits
+    trigger a full rebuild. ``rerank`` refreshes popularity from the indexed
+    fields without reloading the catalog. Updates are made by a background
+    refresher (Database.refresh_suggestion_index); lookups read whichever
+    snapshot is current and never wait for a build.
+    """
+
+    def __init__(self, top_k: int = SUGGEST_TOP_K, scan_limit: int = SUGGEST_SCAN_LIMIT) -> None:
+        self.top_k = top_k
+        self.scan_limit = scan_limit
+        self._snapshot: Optional[_SuggestSnapshot] = None
+        self._fingerprints: Dict[Any, Tuple[Any, ...]] = {}
+        self.builds = 0
+        self.reranks = 0
+        self.incremental_updates = 0
+        self.last_build_seconds = 0.0
+
+    @property
+    def version(self) -> Any:
+        return self._snapshot.version if self._snapshot is not None else None
+
+    def rerank(self, views: Dict[Any, int]) -> None:
+        """Re-rank the current suggestions by fresh view counts, from the products already indexed."""
+        if self._snapshot is None:
+            return
+        started = time.perf_counter()
+        products = [
+            {"id": product_id, **dict(zip(SUGGEST_FIELDS, fingerprint))}
+            for product_id, fingerprint in self._fingerprints.items()
+        ]
+        self._snapshot = self._build(products, views, self._snapshot.version)
+        self.reranks += 1
+        self.last_build_seconds = time.perf_counter() - started
+
+    def update(self, products: Iterable[Dict[str, Any]], views: Dict[Any, int], version: Any) -> None:
+        started = time.perf_counter()
+        products = [product for product in products if product.get("id") is not None]
+        fingerprints = {
+            product["id"]: tuple(product.get(field) for field in SUGGEST_FIELDS) for product in products
+        }
+        added = [product for product in products if product["id"] not in self._fingerprints]
+        # An update that added nothing (edits and removals only) rebuilds in full.
+        incremental = (
+            self._snapshot is not None
+            and bool(added)
+            and len(fingerprints) - len(added) == len(self._fingerprints)
+            and all(fingerprints.get(key) == fingerprint for key, fingerprint in self._fingerprints.items())
+        )
+        if incremental:
+            self._snapshot = self._extend(self._snapshot, added, views, version)
+            self.incremental_updates += 1
+        else:
+            self._snapshot = self._build(products, views, version)
+            self.builds += 1
+        self._fingerprints = fingerprints
+        self.last_build_seconds = time.perf_counter() - started
+        logger.info(
+            "%s suggestion index v%s: %s keys, %s precomputed prefixes in %.2fs",
+            "Extended" if incremental else "Built",
+            version,
+            len(self._snapshot.keys),
+            len(self._snapshot.heads),
+            self.last_build_seconds,
+        )
+
+    def _add_product(
+        self,
+        snapshot: _SuggestSnapshot,
+        product: Dict[str, Any],
+        views: Dict[Any, int],
+        bumped: Optional[Set[str]] = None,
+    ) -> List[Tuple[str, int]]:
+        """Register the product's suggestions and return the (key, sid) entries that are new.
+
+        Keys of existing shared suggestions whose score went up are added to ``bumped``.
+        """
+        entries: List[Tuple[str, int]] = []
+        popularity = views.get(product["id"], 0)
+        for field, kind in SUGGEST_FIELDS.items():
+            for text in _suggest_values(product, field):
+                normalized = " ".join(tokenize(text))
+                if not normalized:
+                    continue
+                sid = None if kind == "product" else snapshot.lookup.get((kind, normalized))
+                if sid is not None:
+                    # Shared suggestions rank by the views of all their products, then by product count.
+                    snapshot.scores[sid] += popularity + 0.01
+                    if bumped is not None:
+                        bumped.update(_suggest_keys(text))
+                    continue
+                sid = len(snapshot.texts)
+                snapshot.texts.append(text if kind != "category" else text.replace("-", " ").title())
+                snapshot.kinds.append(kind)
+                snapshot.product_ids.append(product["id"] if kind == "product" else None)
+                # Shorter texts win ties so "Silk" outranks "Silk Saree 123" with equal views.
+                snapshot.scores.append(popularity + 0.01 + 1 / (10 + len(text)))
+                if kind != "product":
+                    snapshot.lookup[(kind, normalized)] = sid
+                entries.extend((key, sid) for key in _suggest_keys(text))
+        return entries
+
+    def _build(self, products: List[Dict[str, Any]], views: Dict[Any, int], version: Any) -> _SuggestSnapshot:
+        snapshot = _SuggestSnapshot(version)
+        entries: List[Tuple[str, int]] = []
+        for product in products:
+            entries.extend(self._add_product(snapshot, product, views))
+        entries.sort()
+        snapshot.keys = [key for key, _ in entries]
+        snapshot.sids = [sid for _, sid in entries]
+        self._precompute(snapshot, "", 0, len(snapshot.keys))
+        return snapshot
+
+    def _extend(
+        self, current: _SuggestSnapshot, products: List[Dict[str, Any]], views: Dict[Any, int], version: Any
+    ) -> _SuggestSnapshot:
+        snapshot = _SuggestSnapshot(version)
+        snapshot.texts = list(current.texts)
+        snapshot.kinds = list(current.kinds)
+        snapshot.product_ids = list(current.product_ids)
+        snapshot.scores = list(current.scores)
+        snapshot.lookup = dict(current.lookup)
+        snapshot.heads = dict(current.heads)
+
+        new_entries: List[Tuple[str, int]] = []
+        bumped: Set[str] = set()
+        for product in products:
+            new_entries.extend(self._add_product(snapshot, product, views, bumped))
+        new_entries.sort()
+        merged = list(heapq.merge(zip(current.keys, current.sids), new_entries))
+        snapshot.keys = [key for key, _ in merged]
+        snapshot.sids = [sid for _, sid in merged]
+
+        # Refresh every precomputed prefix the new keys and the re-scored shared
+        # suggestions fall under, and precompute prefixes that just outgrew the scan limit.
+        touched: Set[str] = set()
+        for key in sorted(bumped.union(key for key, _ in new_entries)):
+            for length in range(len(key) + 1):
+                prefix = key[:length]
+                if prefix in touched:
+                    continue
+                low, high = self._range(snapshot, prefix)
+                if high - low <= self.scan_limit:
+                    break
+                touched.add(prefix)
+                snapshot.heads[prefix] = self._top(snapshot, low, high)
+        return snapshot
+
+    def _precompute(self, snapshot: _SuggestSnapshot, prefix: str, low: int, high: int) -> None:
+        if high - low <= self.scan_limit:
+            return
+        snapshot.heads[prefix] = self._top(snapshot, low, high)
+        depth = len(prefix)
+        keys = snapshot.keys
+        start = low
+        # Keys equal to the prefix sort first and have no next character.
+        while start < high and len(keys[start]) == depth:
+            start += 1
+        while start < high:
+            char = keys[start][depth]
+            end = bisect.bisect_left(keys, prefix + char + "\uffff", start, high)
+            self._precompute(snapshot, prefix + char, start, end)
+            start = end
+
+    def _top(self, snapshot: _SuggestSnapshot, low: int, high: int) -> List[int]:
+        scores = snapshot.scores
+        candidates = heapq.nlargest(
+            self.top_k * 3, set(snapshot.sids[low:high]), key=lambda sid: (scores[sid], -sid)
+        )
+        top: List[int] = []
+        seen: Set[Tuple[str, str]] = set()
+        for sid in candidates:
+            label = (snapshot.kinds[sid], snapshot.texts[sid].lower())
+            if label in seen:
+                continue
+            seen.add(label)
+            top.append(sid)
+            if len(top) == self.top_k:
+                break
+        return top
+
+    @staticmethod
+    def _range(snapshot: _SuggestSnapshot, prefix: str) -> Tuple[int, int]:
+        low = bisect.bisect_left(snapshot.keys, prefix)
+        return low, bisect.bisect_left(snapshot.keys, prefix + "\uffff", low)
+
+    def suggest(self, query: str, limit: int = SUGGEST_TOP_K) -> List[Dict[str, Any]]:
+        snapshot = self._snapshot
+        prefix = " ".join(tokenize(query))
+        if snapshot is None or not prefix:
+            return []
+        if query[-1:].isspace():
+            prefix += " "
+        sids = snapshot.heads.get(prefix)
+        if sids is None:
+            low, high = self._range(snapshot, prefix)
+            sids = self._top(snapshot, low, high) if high > low else []
+        return [
+            {
+                "text": snapshot.texts[sid],
+                "kind": snapshot.kinds[sid],
+                "product_id": snapshot.product_ids[sid],
+            }
+            for sid in sids[:limit]
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "version": self.version,
+            "suggestions": len(snapshot.texts) if snapshot is not None else 0,
+            "keys": len(snapshot.keys) if snapshot is not None else 0,
+            "precomputed_prefixes": len(snapshot.heads) if snapshot is not None else 0,
+            "builds": self.builds,
+            "incremental_updates": self.incremental_updates,
+            "reranks": self.reranks,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+        }
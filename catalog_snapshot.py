@@ -0,0 +1,434 @@
+"""
+Columnar, memory-mapped snapshot of the products collection.
+
+One process writes the catalog to a single file; every worker maps that file
+read-only, so the catalog occupies page cache once instead of once per worker.
+The file holds:
+
+* numeric columns (id, price, stock, featured_dress) as little-endian NumPy arrays;
+  a missing or non-numeric price is NaN so it fails every price comparison,
+  as it does in MongoDB,
+* low-cardinality text (category, occasion, material) as int32 codes plus a
+  value table in the header,
+* free text as a UTF-8 blob plus an int64 offsets array, with lowercase copies
+  of the searchable columns for substring matching,
+* every remaining field as a JSON (extended JSON) blob per product, so rows
+  round-trip to the original documents.
+
+Snapshots are published by writing a new file and atomically replacing the
+``CURRENT`` pointer; readers notice the pointer change and remap, while views
+into the previous file stay valid until they are dropped.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from bson import ObjectId, json_util
+
+from catalog import normalize_key
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv("CATALOG_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "catalog_snapshot"))
+SNAPSHOT_KEEP = 2
+POINTER_CHECK_SECONDS = 1.0
+
+MAGIC = b"CATSNAP1"
+ALIGNMENT = 64
+
+NUMERIC_COLUMNS: Dict[str, str] = {"id": "<i8", "price": "<f8", "stock": "<i8", "featured_dress": "u1"}
+CATEGORICAL_COLUMNS = ("dress_category", "occasion", "category_key", "occasion_key", "material")
+TEXT_COLUMNS = ("_id", "product_name", "description", "colors", "available_sizes", "image_url")
+SEARCHABLE_COLUMNS = ("product_name", "description", "colors")
+STORED_COLUMNS = (*NUMERIC_COLUMNS, *CATEGORICAL_COLUMNS, *TEXT_COLUMNS)
+_STORED = set(STORED_COLUMNS)
+# Extras entry listing the stored fields a product does not have at all.
+MISSING_KEY = "__missing__"
+
+
+def _pad(length: int) -> int:
+    return -length % ALIGNMENT
+
+
+def _fits(name: str, value: Any) -> bool:
+    """Whether ``value`` round-trips through column ``name``; anything else also goes to the extras blob."""
+    if name == "featured_dress":
+        return isinstance(value, bool)
+    if name == "price":
+        return isinstance(value, float)
+    if name in NUMERIC_COLUMNS:
+        return isinstance(value, int) and not isinstance(value, bool)
+    if name == "_id":
+        return isinstance(value, ObjectId)
+    return isinstance(value, str)
+
+
+def _number(value: Any, fill: Any) -> Any:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else fill
+
+
+def _extras(product: Dict[str, Any]) -> str:
+    extras = {key: value for key, value in product.items() if key not in _STORED or not _fits(key, value)}
+    missing = [name for name in STORED_COLUMNS if name not in product]
+    if missing:
+        extras[MISSING_KEY] = missing
+    return json_util.dumps(extras)
+
+
+def write_snapshot(products: Iterable[Dict[str, Any]], path: str, version: Any) -> int:
+    """Write ``products`` to ``path`` in the snapshot format and return the row count.
+
+    Products without an integer ``id`` cannot be addressed and are skipped.
+    """
+    rows = [product for product in products if _fits("id", product.get("id"))]
+    segments: List[tuple[str, bytes, str, int]] = []
+
+    for name, dtype in NUMERIC_COLUMNS.items():
+        values = [product.get(name) for product in rows]
+        if name == "featured_dress":
+            array = np.array([bool(value) for value in values], dtype=dtype)
+        elif name == "price":
+            array = np.array([_number(value, np.nan) for value in values], dtype=dtype)
+        else:
+            array = np.array([_number(value, 0) for value in values], dtype=dtype)
+        segments.append((name, array.tobytes(), dtype, len(array)))
+    # Row positions sorted by id, for position() lookups.
+    id_order = np.argsort(np.array([product["id"] for product in rows], dtype="<i8"), kind="stable").astype("<i8")
+    segments.append(("id_order", id_order.tobytes(), "<i8", len(id_order)))
+
+    categories: Dict[str, List[Optional[str]]] = {}
+    for name in CATEGORICAL_COLUMNS:
+        table: Dict[Optional[str], int] = {None: 0}
+        codes = np.array(
+            [table.setdefault(value if isinstance(value, str) else None, len(table)) for value in (product.get(name) for product in rows)],
+            dtype="<i4",
+        )
+        categories[name] = list(table)
+        segments.append((name, codes.tobytes(), "<i4", len(codes)))
+
+    def add_text(name: str, values: Sequence[str]) -> None:
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        segments.append((f"{name}.offsets", offsets.tobytes(), "<i8", len(offsets)))
+        segments.append((f"{name}.data", b"".join(encoded), "u1", int(offsets[-1])))
+
+    for name in TEXT_COLUMNS:
+        add_text(name, [str(product[name]) if _fits(name, product.get(name)) else "" for product in rows])
+    for name in SEARCHABLE_COLUMNS:
+        add_text(f"lower:{name}", [str(product.get(name) or "").lower() for product in rows])
+    add_text("extra", [_extras(product) for product in rows])
+
+    header: Dict[str, Any] = {"version": version, "rows": len(rows), "categories": categories, "columns": {}}
+    # Segment offsets depend on the header length, which depends on the offsets:
+    # pad the header to whole pages and lay out again until the length settles.
+    header_length = 0
+    while True:
+        position = len(MAGIC) + 8 + header_length
+        position += _pad(position)
+        for name, data, dtype, count in segments:
+            header["columns"][name] = {"offset": position, "dtype": dtype, "count": count}
+            position += len(data) + _pad(len(data))
+        header_bytes = json.dumps(header, default=json_util.default).encode("utf-8")
+        header_bytes += b" " * (-len(header_bytes) % 4096)
+        if len(header_bytes) == header_length:
+            break
+        header_length = len(header_bytes)
+
+    with open(path, "wb") as handle:
+        handle.write(MAGIC)
+        handle.write(len(header_bytes).to_bytes(8, "little"))
+        handle.write(header_bytes)
+        handle.write(b"\0" * _pad(handle.tell()))
+        for name, data, _, _ in segments:
+            assert handle.tell() == header["columns"][name]["offset"]
+            handle.write(data)
+            handle.write(b"\0" * _pad(len(data)))
+        handle.flush()
+        os.fsync(handle.fileno())
+    return len(rows)
+
+
+class CatalogSnapshot:
+    """Read-only view of one snapshot file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        header_length = int.from_bytes(self._map[len(MAGIC) : len(MAGIC) + 8], "little")
+        start = len(MAGIC) + 8
+        header = json.loads(self._map[start : start + header_length], object_hook=json_util.object_hook)
+        self.version = header["version"]
+        self.size = header["rows"]
+        self.categories: Dict[str, List[Optional[str]]] = header["categories"]
+        self._columns: Dict[str, Dict[str, Any]] = header["columns"]
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def array(self, name: str) -> np.ndarray:
+        array = self._arrays.get(name)
+        if array is None:
+            spec = self._columns[name]
+            array = np.frombuffer(self._map, dtype=spec["dtype"], count=spec["count"], offset=spec["offset"])
+            self._arrays[name] = array
+        return array
+
+    def text(self, name: str, position: int) -> str:
+        offsets = self.array(f"{name}.offsets")
+        base = self._columns[f"{name}.data"]["offset"]
+        return self._map[base + int(offsets[position]) : base + int(offsets[position + 1])].decode("utf-8")
+
+    def category(self, name: str, position: int) -> Optional[str]:
+        return self.categories[name][int(self.array(name)[position])]
+
+    def position(self, product_id: Any) -> Optional[int]:
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return None
+        ids = self.array("id")
+        order = self.array("id_order")
+        index = int(np.searchsorted(ids[order], product_id)) if self.size else 0
+        if index < self.size and ids[order[index]] == product_id:
+            return int(order[index])
+        return None
+
+    def row(self, position: int) -> Dict[str, Any]:
+        extras: Dict[str, Any] = json_util.loads(self.text("extra", position))
+        skip = set(extras.pop(MISSING_KEY, ())) | set(extras)
+        product: Dict[str, Any] = {}
+        for name in STORED_COLUMNS:
+            if name in skip:
+                continue
+            if name in TEXT_COLUMNS:
+                value: Any = self.text(name, position)
+                product[name] = ObjectId(value) if name == "_id" else value
+            elif name in CATEGORICAL_COLUMNS:
+                product[name] = self.category(name, position)
+            elif name == "featured_dress":
+                product[name] = bool(self.array(name)[position])
+            else:
+                product[name] = self.array(name)[position].item()
+        product.update(extras)
+        return product
+
+    def rows(self, positions: Iterable[int]) -> List[Dict[str, Any]]:
+        return [self.row(int(position)) for position in positions]
+
+    def codes_where(self, name: str, predicate: Callable[[str], bool]) -> np.ndarray:
+        """Row mask for a categorical column, evaluating ``predicate`` once per distinct value."""
+        matching = [code for code, value in enumerate(self.categories[name]) if value is not None and predicate(value)]
+        return np.isin(self.array(name), np.array(matching, dtype="<i4"))
+
+    def contains(self, name: str, term: str) -> np.ndarray:
+        """Row mask of products whose lowercase ``name`` column contains ``term``."""
+        mask = np.zeros(self.size, dtype=bool)
+        needle = term.lower().encode("utf-8")
+        if not needle or not self.size:
+            return mask
+        offsets = self.array(f"lower:{name}.offsets")
+        base = self._columns[f"lower:{name}.data"]["offset"]
+        end = base + int(offsets[-1])
+        found = self._map.find(needle, base, end)
+        while found != -1:
+            position = int(np.searchsorted(offsets, found - base, side="right")) - 1
+            # Values are stored back to back, so a hit can run into the next row's
+            # value; any later hit starting in this row would too. Either way the
+            # search resumes at the next product, as one hit per row is enough.
+            if found - base + len(needle) <= offsets[position + 1]:
+                mask[position] = True
+            found = self._map.find(needle, base + int(offsets[position + 1]), end)
+        return mask
+
+    def filter_mask(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> np.ndarray:
+        """Database._catalog_filters evaluated over the columns, matching on normalized keys."""
+        mask = np.ones(self.size, dtype=bool)
+        if category:
+            category_key = normalize_key(category)
+            if category_key in {"women", "men", "kids"}:
+                mask &= self.codes_where("dress_category", lambda value: normalize_key(value).startswith(f"{category_key}-"))
+            else:
+                mask &= self.codes_where("dress_category", lambda value: normalize_key(value) == category_key)
+        if occasion:
+            occasion_key = normalize_key(occasion)
+            mask &= self.codes_where("occasion", lambda value: normalize_key(value) == occasion_key)
+        prices = self.array("price")
+        if min_price is not None:
+            mask &= prices >= min_price
+        if max_price is not None:
+            mask &= prices <= max_price
+        return mask
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "rows": self.size,
+            "path": self.path,
+            "bytes": len(self._map),
+        }
+
+
+class SnapshotStore:
+    """Publishes snapshots into a directory and hands out the current one.
+
+    Whichever process first notices that the catalog version moved on takes a
+    file lock and rebuilds in a background thread; all processes pick up the
+    result through the ``CURRENT`` pointer file.
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIR, keep: int = SNAPSHOT_KEEP) -> None:
+        self.directory = directory
+        self.keep = keep
+        self._current: Optional[CatalogSnapshot] = None
+        self._pointer_mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._building = False
+        self.builds = 0
+        self.last_build_seconds = 0.0
+
+    @property
+    def _pointer(self) -> str:
+        return os.path.join(self.directory, "CURRENT")
+
+    def current(self) -> Optional[CatalogSnapshot]:
+        now = time.monotonic()
+        if now - self._checked_at < POINTER_CHECK_SECONDS:
+            return self._current
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self._pointer).st_mtime
+            except FileNotFoundError:
+                return self._current
+            if mtime != self._pointer_mtime:
+                try:
+                    with open(self._pointer, encoding="utf-8") as handle:
+                        name = json.load(handle)["file"]
+                    self._current = CatalogSnapshot(os.path.join(self.directory, name))
+                    self._pointer_mtime = mtime
+                except (OSError, ValueError, KeyError):
+                    logger.exception("Could not map the catalog snapshot; keeping the previous one")
+        return self._current
+
+    def publish(self, products: Iterable[Dict[str, Any]], version: Any) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        name = f"catalog-{version}-{os.getpid()}-{int(time.time() * 1000)}.snap"
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(descriptor)
+        try:
+            rows = write_snapshot(products, temporary, version)
+            os.replace(temporary, os.path.join(self.directory, name))
+            pointer_temporary = f"{self._pointer}.{os.getpid()}.tmp"
+            with open(pointer_temporary, "w", encoding="utf-8") as handle:
+                json.dump({"file": name, "version": version}, handle, default=json_util.default)
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(pointer_temporary, self._pointer)
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+        self._prune(keep_name=name)
+        self._checked_at = 0.0
+        self.builds += 1
+        self.last_build_seconds = time.perf_counter() - started
+        logger.info("Published catalog snapshot v%s: %s products in %.2fs", version, rows, self.last_build_seconds)
+        return name
+
+    def _prune(self, keep_name: str) -> None:
+        snapshots = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".snap")),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in snapshots[self.keep :]:
+            if entry.name != keep_name:
+                # Workers still mapping the file keep its pages until they remap.
+                os.unlink(entry.path)
+
+    def ensure(self, version: Any, loader: Callable[[], Iterable[Dict[str, Any]]]) -> Optional[CatalogSnapshot]:
+        """Return the snapshot for ``version``, starting a rebuild if none exists yet.
+
+        Never blocks on a build: callers get None until the new snapshot is
+        published and should fall back to MongoDB meanwhile.
+        """
+        snapshot = self.current()
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            if self._building:
+                return None
+            self._building = True
+        threading.Thread(target=self._build, args=(version, loader), name="catalog-snapshot", daemon=True).start()
+        return None
+
+    def _build(self, version: Any, loader: Callable[[], Iterable[Dict[str, Any]]]) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, "build.lock"), "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # another worker is building it
+                try:
+                    self._checked_at = 0.0
+                    snapshot = self.current()
+                    if snapshot is None or snapshot.version != version:
+                        self.publish(loader(), version)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except Exception:
+            logger.exception("Catalog snapshot build for v%s failed", version)
+        finally:
+            with self._lock:
+                self._building = False
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._current
+        return {
+            "directory": self.directory,
+            "current": snapshot.stats() if snapshot is not None else None,
+            "builds": self.builds,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+        }
+
+
+def process_memory() -> Dict[str, Any]:
+    """Resident and proportional set size of this process, from /proc (Linux only)."""
+    memory: Dict[str, Any] = {"pid": os.getpid()}
+    for path, fields in (
+        ("/proc/self/status", {"VmRSS": "rss_mb", "RssAnon": "rss_anon_mb", "RssFile": "rss_file_mb"}),
+        ("/proc/self/smaps_rollup", {"Pss": "pss_mb"}),
+    ):
+        try:
+            with open(path, encoding="ascii") as handle:
+                for line in handle:
+                    key, _, value = line.partition(":")
+                    if key in fields:
+                        memory[fields[key]] = round(int(value.split()[0]) / 1024, 1)
+        except OSError:
+            continue
+    return memory
+
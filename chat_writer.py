@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import ObjectId
+
+from database import Database, db, parse_dt
+
+logger = logging.getLogger(__name__)
+
+CHAT_WRITE_MAX_BACKOFF_SECONDS = float(os.getenv("CHAT_WRITE_MAX_BACKOFF_SECONDS", "30"))
+CHAT_STOP_TIMEOUT_SECONDS = float(os.getenv("CHAT_STOP_TIMEOUT_SECONDS", "30"))
+
+
+class ChatMessageWriter:
+    """Write-behind persistence for chat messages.
+
+    ``enqueue`` returns as soon as the message is queued; a single background
+    task drains the queue in batches, so messages of a session are stored in
+    the order they were produced. Messages that are queued but not yet stored
+    are available through ``pending_messages`` so the current turn can still
+    see them. A batch that cannot be written stays pending and is retried with
+    backoff until it lands; later batches wait behind it so order is kept.
+    Set CHAT_PERSISTENCE_MODE=sync to write every message inline.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        batch_size: int = 100,
+        max_retries: int = 3,
+        mode: Optional[str] = None,
+    ) -> None:
+        self._database = database
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.mode = (mode or os.getenv("CHAT_PERSISTENCE_MODE", "write_behind")).lower()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.mode == "sync" or self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything still queued, then stop the background task.
+
+        Waits at most CHAT_STOP_TIMEOUT_SECONDS; messages still unsaved by then
+        are logged, not dropped silently.
+        """
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), CHAT_STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            unsaved = sum(len(messages) for messages in self._pending.values())
+            logger.error(
+                "Stopping with %s chat messages in %s sessions not yet stored: %s",
+                unsaved,
+                len(self._pending),
+                [str(message["_id"]) for messages in self._pending.values() for message in messages],
+            )
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def enqueue(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        agent_type: Optional[str] = None,
+    ) -> str:
+        if not self.running:
+            return self._database.add_chat_message(session_id, role, content, agent_type)
+
+        message = self._database.build_chat_message(session_id, role, content, agent_type)
+        self._pending.setdefault(session_id, []).append(message)
+        self._queue.put_nowait(message)
+        return str(message["_id"])
+
+    def pending_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        return list(self._pending.get(session_id, []))
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        # Both steps are idempotent, so each is retried on its own: a fold that
+        # failed after the messages were stored does not re-insert them, and the
+        # batch id stops a fold that did land from being applied twice. The
+        # batch leaves the pending view only once both have landed.
+        batch_id = ObjectId()
+        await self._write("store", self._database.store_chat_messages, batch)
+        await self._write("fold", self._database.fold_chat_messages, batch, batch_id)
+
+        flushed = {message["_id"] for message in batch}
+        for session_id in {message["session_id"] for message in batch}:
+            remaining = [message for message in self._pending.get(session_id, []) if message["_id"] not in flushed]
+            if remaining:
+                self._pending[session_id] = remaining
+            else:
+                self._pending.pop(session_id, None)
+
+    async def _write(self, step: str, write: Callable[..., None], batch: List[Dict[str, Any]], *args: Any) -> None:
+        """Run one write step until it succeeds, backing off exponentially up to CHAT_WRITE_MAX_BACKOFF_SECONDS."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await asyncio.to_thread(write, batch, *args)
+                return
+            except Exception:
+                delay = min(CHAT_WRITE_MAX_BACKOFF_SECONDS, 0.2 * 2 ** (attempt - 1))
+                if attempt % self.max_retries == 0:
+                    logger.exception(
+                        "Chat message %s of %s messages failed %s times; keeping them pending and retrying in %.1fs",
+                        step,
+                        len(batch),
+                        attempt,
+                        delay,
+                    )
+                else:
+                    logger.warning("Chat message %s failed (attempt %s); retrying", step, attempt)
+                await asyncio.sleep(delay)
+
+
+def merge_pending(messages: List[Dict[str, Any]], pending: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Append queued messages that are not yet visible in a stored history read."""
+    stored_ids = {message.get("_id") for message in messages}
+    merged = messages + [message for message in pending if message["_id"] not in stored_ids]
+    merged.sort(key=lambda message: (parse_dt(message.get("created_at")), message.get("_id") or ObjectId("0" * 24)))
+    return merged
+
+
+chat_writer = ChatMessageWriter(db)
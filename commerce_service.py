@@ -2,10 +2,17 @@ from __future__ import annotations
 
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple
+import logging
 import random
 import uuid
 
-from database import db
+from bson import ObjectId
+
+from database import db, find_page, parse_dt, utc_now
+from recommendation_slates import SLATE_ACTIVITY_TYPES, recommendation_slates
+from trending import trending
+
+logger = logging.getLogger(__name__)
 
 ORDER_STATUS_FLOW = [
     "order_placed",
@@ -36,6 +43,9 @@ ORDER_EVENT_MAP = {
     "payment_failed": "payment_failed",
 }
 
+# List views leave out the per-order history; GET /orders/{order_number} returns it in full.
+ORDER_LIST_PROJECTION = {"timeline": 0, "scheduled_transitions": 0}
+
 PAYMENT_SCENARIO_TIMINGS = {
     "success": {
         "payment_updates": [("success", 10)],
@@ -73,6 +83,8 @@ STATUS_CHAIN_DELAYS = {
     "payment_failed": [],
 }
 
+STOCK_LAPSED_NOTE = "Payment settled after the stock reservation lapsed and the items are no longer available."
+
 NOTIFICATION_TEMPLATE_MAP = {
     "order_created": "order_confirmation",
     "payment_confirmed": "payment_status",
@@ -82,6 +94,14 @@ NOTIFICATION_TEMPLATE_MAP = {
     "order_delivered": "delivery_complete",
 }
 
+ACTIVITY_EVENT_MAP = {
+    "product_view": "product_viewed",
+    "cart_add": "cart_updated",
+    "cart_remove": "cart_updated",
+    "cart_update": "cart_updated",
+    "checkout_started": "checkout_started",
+}
+
 CALL_SCENARIO_TONES = {
     "cart_abandonment": "persuasive",
     "product_interest": "informative",
@@ -90,27 +110,6 @@ CALL_SCENARIO_TONES = {
 }
 
 
-def utc_now() -> datetime:
-    return datetime.utcnow().replace(microsecond=0)
-
-
-def to_iso(value: datetime) -> str:
-    return value.replace(microsecond=0).isoformat()
-
-
-def parse_dt(value: Any) -> datetime:
-    if isinstance(value, datetime):
-        return value
-    if not value:
-        return utc_now()
-    if isinstance(value, str):
-        try:
-            return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
-        except ValueError:
-            return utc_now()
-    return utc_now()
-
-
 class CommerceSimulationService:
     def __init__(self):
         self._database = db
@@ -137,7 +136,7 @@ class CommerceSimulationService:
             "description": description,
             "source": source,
             "metadata": metadata or {},
-            "created_at": to_iso(timestamp),
+            "created_at": timestamp,
         }
 
     def _build_payment_timeline_entry(
@@ -154,7 +153,7 @@ class CommerceSimulationService:
             "description": description,
             "source": source,
             "metadata": metadata or {},
-            "created_at": to_iso(timestamp),
+            "created_at": timestamp,
         }
 
     def _build_scheduled_transitions(self, scenario: str, created_at: datetime) -> List[Dict[str, Any]]:
@@ -163,7 +162,7 @@ class CommerceSimulationService:
             {
                 "transition_id": self._new_id("ordtr"),
                 "target_status": status,
-                "due_at": to_iso(created_at + timedelta(seconds=offset)),
+                "due_at": created_at + timedelta(seconds=offset),
                 "processed_at": None,
             }
             for status, offset in config["order_updates"]
@@ -175,7 +174,7 @@ class CommerceSimulationService:
             {
                 "update_id": self._new_id("payup"),
                 "target_status": status,
-                "due_at": to_iso(created_at + timedelta(seconds=offset)),
+                "due_at": created_at + timedelta(seconds=offset),
                 "processed_at": None,
             }
             for status, offset in config["payment_updates"]
@@ -267,7 +266,7 @@ class CommerceSimulationService:
             "order_number": order_number,
             "payment_id": payment_id,
             "payload": payload or {},
-            "created_at": to_iso(now),
+            "created_at": now,
         }
 
     def _emit_event(
@@ -356,8 +355,8 @@ class CommerceSimulationService:
             "status": "simulated_sent",
             "dedupe_key": dedupe_key,
             "metadata": metadata or {},
-            "created_at": to_iso(now),
-            "sent_at": to_iso(now),
+            "created_at": now,
+            "sent_at": now,
         }
         self.mongo.notifications.insert_one(notification)
         return notification
@@ -388,21 +387,35 @@ class CommerceSimulationService:
             "transcript": [],
             "dedupe_key": dedupe_key,
             "metadata": metadata or {},
-            "scheduled_for": to_iso(scheduled_for or now),
-            "created_at": to_iso(now),
-            "updated_at": to_iso(now),
+            "scheduled_for": scheduled_for or now,
+            "created_at": now,
+            "updated_at": now,
         }
         self.mongo.call_workflows.insert_one(workflow)
         return workflow
 
-    def _dispatch_event_side_effects(self, event: Dict[str, Any]) -> None:
+    def _dispatch_event_side_effects(
+        self,
+        event: Dict[str, Any],
+        user: Optional[Dict[str, Any]] = None,
+        order: Optional[Dict[str, Any]] = None,
+        payment: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Create notifications and call workflows for an event.
+
+        Callers that already hold the user, order or payment documents pass
+        them in; anything missing is loaded here.
+        """
         user_id = event.get("user_id")
         if not user_id:
             return
 
-        user = db.get_user_flexible(user_id)
-        order = self.get_order(event.get("order_number")) if event.get("order_number") else None
-        payment = self.get_payment(event.get("payment_id")) if event.get("payment_id") else None
+        if user is None:
+            user = db.get_user_flexible(user_id)
+        if order is None and event.get("order_number"):
+            order = self.get_order(event["order_number"])
+        if payment is None and event.get("payment_id"):
+            payment = self.get_payment(event["payment_id"])
         event_type = event.get("event_type")
 
         whatsapp = (user or {}).get("whatsapp_connection") or {}
@@ -463,14 +476,40 @@ class CommerceSimulationService:
             order["payments"] = list(self.mongo.payments.find({"order_number": order["order_number"]}).sort("created_at", 1))
         return orders
 
-    def list_admin_orders(self) -> List[Dict[str, Any]]:
-        orders = list(self.mongo.orders.find().sort("created_at", -1).limit(100))
+    def list_admin_orders(
+        self,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        projection: Optional[Dict[str, int]] = ORDER_LIST_PROJECTION,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        orders, next_cursor = find_page(
+            self.mongo.orders, {}, [("created_at", -1), ("_id", -1)], limit, cursor, projection
+        )
+        order_numbers = [order.get("order_number") for order in orders]
+        payments = self._group_by_order(
+            self.mongo.payments.find({"order_number": {"$in": order_numbers}}).sort("created_at", 1)
+        )
+        notifications = self._group_by_order(
+            self.mongo.notifications.find({"order_number": {"$in": order_numbers}}).sort("created_at", -1), per_order=10
+        )
+        call_workflows = self._group_by_order(
+            self.mongo.call_workflows.find({"order_number": {"$in": order_numbers}}).sort("created_at", -1), per_order=10
+        )
         for order in orders:
             order_number = order.get("order_number")
-            order["payments"] = list(self.mongo.payments.find({"order_number": order_number}).sort("created_at", 1))
-            order["notifications"] = list(self.mongo.notifications.find({"order_number": order_number}).sort("created_at", -1).limit(10))
-            order["call_workflows"] = list(self.mongo.call_workflows.find({"order_number": order_number}).sort("created_at", -1).limit(10))
-        return orders
+            order["payments"] = payments.get(order_number, [])
+            order["notifications"] = notifications.get(order_number, [])
+            order["call_workflows"] = call_workflows.get(order_number, [])
+        return orders, next_cursor
+
+    @staticmethod
+    def _group_by_order(documents, per_order: Optional[int] = None) -> Dict[str, List[Dict[str, Any]]]:
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for document in documents:
+            bucket = grouped.setdefault(document.get("order_number"), [])
+            if per_order is None or len(bucket) < per_order:
+                bucket.append(document)
+        return grouped
 
     def create_checkout(
         self,
@@ -513,7 +552,7 @@ class CommerceSimulationService:
             "simulation": {
                 "auto_progress": True,
                 "payment_scenario": payment_scenario,
-                "created_at": to_iso(created_at),
+                "created_at": created_at,
             },
             "fulfillment": {
                 "carrier": "SimShip",
@@ -525,8 +564,8 @@ class CommerceSimulationService:
                 "phone": (user or {}).get("phone"),
                 "email": (user or {}).get("email"),
             },
-            "created_at": to_iso(created_at),
-            "updated_at": to_iso(created_at),
+            "created_at": created_at,
+            "updated_at": created_at,
             **totals,
         }
         payment_doc = {
@@ -547,31 +586,85 @@ class CommerceSimulationService:
                 )
             ],
             "scheduled_updates": self._build_payment_updates(payment_scenario, created_at),
-            "created_at": to_iso(created_at),
-            "updated_at": to_iso(created_at),
+            "created_at": created_at,
+            "updated_at": created_at,
         }
 
-        self.mongo.orders.insert_one(order_doc)
-        self.mongo.payments.insert_one(payment_doc)
-        db.clear_user_cart(user_id)
-        self.record_user_activity(
+        activity = self._build_activity(
             user_id,
             "checkout_started",
             {
                 "order_number": order_number,
                 "payment_scenario": payment_scenario,
                 "payment_method": payment_method,
+                "product_ids": [item.get("product_id") for item in resolved_items],
             },
         )
-        self._emit_event("order_created", user_id, {"payment_scenario": payment_scenario}, order_number=order_number)
-        self._emit_event("payment_initiated", user_id, {"method": payment_method}, order_number=order_number, payment_id=payment_id)
-        return self.get_order(order_number) or order_doc
+        events = [
+            self._build_event(ACTIVITY_EVENT_MAP["checkout_started"], user_id, activity["metadata"], order_number=order_number),
+            self._build_event("order_created", user_id, {"payment_scenario": payment_scenario}, order_number=order_number),
+            self._build_event("payment_initiated", user_id, {"method": payment_method}, order_number=order_number, payment_id=payment_id),
+        ]
+        holds = db.reserve_items(resolved_items, user_id=user_id, order_number=order_number)
+        order_doc["stock_hold_ids"] = [hold["_id"] for hold in holds]
+        try:
+            self._write_checkout(user_id, order_doc, payment_doc, activity, events)
+        except Exception:
+            db.release_stock_holds(order_number)
+            raise
+
+        # Side effects run only once the checkout is durable, from the documents
+        # already in hand instead of reading them back.
+        order_doc["payments"] = [payment_doc]
+        trending.record_activity(activity)
+        recommendation_slates.mark_stale(user_id)
+        for event in events:
+            self._dispatch_event_side_effects(event, user=user or {}, order=order_doc, payment=payment_doc)
+        return order_doc
+
+    def _write_checkout(
+        self,
+        user_id: str,
+        order_doc: Dict[str, Any],
+        payment_doc: Dict[str, Any],
+        activity: Dict[str, Any],
+        events: List[Dict[str, Any]],
+    ) -> None:
+        """Persist a checkout atomically.
+
+        On a replica set every write happens in one transaction. On a
+        standalone server the writes run in order with the cart delete last,
+        and the inserted documents are removed again if any step fails.
+        """
+        for document in (order_doc, payment_doc, activity, *events):
+            document.setdefault("_id", ObjectId())
+
+        def write(session=None) -> None:
+            self.mongo.orders.insert_one(order_doc, session=session)
+            self.mongo.payments.insert_one(payment_doc, session=session)
+            self.mongo.user_activity.insert_one(activity, session=session)
+            self.mongo.commerce_events.insert_many(events, ordered=True, session=session)
+            self.mongo.carts.delete_one({"user_id": user_id}, session=session)
+
+        if self._database.supports_transactions:
+            self._database.run_in_transaction(write)
+            return
+
+        try:
+            write()
+        except Exception:
+            logger.exception("Checkout %s failed part-way; rolling back", order_doc["order_number"])
+            self.mongo.orders.delete_one({"_id": order_doc["_id"]})
+            self.mongo.payments.delete_one({"_id": payment_doc["_id"]})
+            self.mongo.user_activity.delete_one({"_id": activity["_id"]})
+            self.mongo.commerce_events.delete_many({"_id": {"$in": [event["_id"] for event in events]}})
+            raise
 
     def _update_payment_status(self, payment: Dict[str, Any], status: str, source: str = "worker") -> Dict[str, Any]:
         now = utc_now()
         update_fields = {
             "status": status,
-            "updated_at": to_iso(now),
+            "updated_at": now,
         }
         timeline_entry = self._build_payment_timeline_entry(
             status,
@@ -600,7 +693,7 @@ class CommerceSimulationService:
         update_fields: Dict[str, Any] = {
             "order_status": status,
             "status": status,
-            "updated_at": to_iso(now),
+            "updated_at": now,
         }
         if status == "shipped":
             tracking_number = ((order.get("fulfillment") or {}).get("tracking_number")) or self._build_tracking_number(order["order_number"])
@@ -608,7 +701,7 @@ class CommerceSimulationService:
                 **(order.get("fulfillment") or {}),
                 "carrier": "SimShip",
                 "tracking_number": tracking_number,
-                "delivery_eta": to_iso(now + timedelta(minutes=2)),
+                "delivery_eta": now + timedelta(minutes=2),
             }
             update_fields["tracking_number"] = tracking_number
         elif status == "out_for_delivery":
@@ -616,12 +709,12 @@ class CommerceSimulationService:
                 **(order.get("fulfillment") or {}),
                 "carrier": (order.get("fulfillment") or {}).get("carrier", "SimShip"),
                 "tracking_number": (order.get("fulfillment") or {}).get("tracking_number") or order.get("tracking_number"),
-                "delivery_eta": to_iso(now + timedelta(minutes=1)),
+                "delivery_eta": now + timedelta(minutes=1),
             }
         elif status == "delivered":
             update_fields["fulfillment"] = {
                 **(order.get("fulfillment") or {}),
-                "delivered_at": to_iso(now),
+                "delivered_at": now,
             }
 
         timeline_entry = self._build_order_timeline_entry(
@@ -643,55 +736,123 @@ class CommerceSimulationService:
     def _mark_payment_update_processed(self, payment_id: str, update_id: str) -> None:
         self.mongo.payments.update_one(
             {"payment_id": payment_id, "scheduled_updates.update_id": update_id},
-            {"$set": {"scheduled_updates.$.processed_at": to_iso(utc_now())}},
+            {"$set": {"scheduled_updates.$.processed_at": utc_now()}},
         )
 
     def _mark_order_transition_processed(self, order_number: str, transition_id: str) -> None:
         self.mongo.orders.update_one(
             {"order_number": order_number, "scheduled_transitions.transition_id": transition_id},
-            {"$set": {"scheduled_transitions.$.processed_at": to_iso(utc_now())}},
+            {"$set": {"scheduled_transitions.$.processed_at": utc_now()}},
+        )
+
+    def _due_filter(self, field: str, now: datetime) -> Dict[str, Any]:
+        # Only fetch documents with an unprocessed entry that is already due. String
+        # due_at values predate the datetime migration and are compared in Python.
+        return {
+            "$or": [
+                {field: {"$elemMatch": {"processed_at": None, "due_at": {"$lte": now}}}},
+                {field: {"$elemMatch": {"processed_at": None, "due_at": {"$type": "string"}}}},
+            ]
+        }
+
+    def _settle_stock(self, order_number: str, status: str) -> bool:
+        """Commit the order's stock holds once it is paid; return them to stock when payment fails.
+
+        Only an order moving out of an unpaid ``payment_status`` takes stock;
+        the commitment is recorded on the order as ``stock_committed``, since
+        committed hold documents are purged after STOCK_HOLD_RETENTION_SECONDS
+        and orders from before stock holds never had any. Returns False when a
+        paid order's holds had already lapsed and its items can no longer be
+        reserved again; the caller then fails the order instead of confirming
+        stock it does not have.
+        """
+        if status not in {"success", "payment_confirmed", "failed", "payment_failed"}:
+            return True
+        order = self.mongo.orders.find_one(
+            {"order_number": order_number},
+            {"items": 1, "user_id": 1, "payment_status": 1, "stock_committed": 1},
+        ) or {}
+        if order.get("stock_committed") or order.get("payment_status") == "success":
+            return True
+        if status in {"failed", "payment_failed"}:
+            db.release_stock_holds(order_number)
+            return True
+
+        if not db.commit_stock_holds(order_number) and not db.has_active_stock_holds(order_number):
+            try:
+                db.reserve_items(order.get("items", []), user_id=order.get("user_id"), order_number=order_number)
+            except ValueError:
+                return False
+            db.commit_stock_holds(order_number)
+        self.mongo.orders.update_one({"order_number": order_number}, {"$set": {"stock_committed": True}})
+        return True
+
+    def _fail_order_out_of_stock(self, order_number: str) -> None:
+        self.advance_order(order_number, "payment_failed", note=STOCK_LAPSED_NOTE, source="system")
+
+    def _reserve_order_stock(self, order: Dict[str, Any]) -> None:
+        if order.get("stock_committed") or db.has_active_stock_holds(order["order_number"]):
+            return
+        holds = db.reserve_items(order.get("items", []), user_id=order.get("user_id"), order_number=order["order_number"])
+        self.mongo.orders.update_one(
+            {"order_number": order["order_number"]},
+            {"$set": {"stock_hold_ids": [hold["_id"] for hold in holds]}},
         )
 
     def process_due_simulations(self) -> None:
+        # Settle due payments first, so a stall longer than the hold TTL does not
+        # return stock that a payment arriving in this same pass still needs.
         self._process_due_payment_updates()
         self._process_due_order_transitions()
+        db.release_expired_stock_holds()
         self._process_cart_abandonment_calls()
         self._activate_due_call_workflows()
 
     def _process_due_payment_updates(self) -> None:
         now = utc_now()
-        payments = list(self.mongo.payments.find({"scheduled_updates.processed_at": None}))
+        payments = list(self.mongo.payments.find(self._due_filter("scheduled_updates", now)))
         for payment in payments:
-            for update in sorted(payment.get("scheduled_updates", []), key=lambda item: item.get("due_at", "")):
+            for update in sorted(payment.get("scheduled_updates", []), key=lambda item: parse_dt(item.get("due_at"))):
                 if update.get("processed_at"):
                     continue
                 if parse_dt(update.get("due_at")) > now:
                     continue
-                updated_payment = self._update_payment_status(payment, update["target_status"])
+                status = update["target_status"]
+                in_stock = self._settle_stock(payment["order_number"], status)
+                if not in_stock:
+                    status = "failed"
+                updated_payment = self._update_payment_status(payment, status)
                 self._mark_payment_update_processed(payment["payment_id"], update["update_id"])
                 self.mongo.orders.update_one(
                     {"order_number": payment["order_number"]},
-                    {"$set": {"payment_status": update["target_status"], "updated_at": to_iso(now)}},
+                    {"$set": {"payment_status": status, "updated_at": now}},
                 )
-                event_type = "payment_confirmed" if update["target_status"] == "success" else f"payment_{update['target_status']}"
+                event_type = "payment_confirmed" if status == "success" else f"payment_{status}"
                 self._emit_event(
                     event_type,
                     payment["user_id"],
-                    {"status": update["target_status"]},
+                    {"status": status},
                     order_number=payment["order_number"],
                     payment_id=payment["payment_id"],
                 )
                 payment = updated_payment
+                if not in_stock:
+                    self._fail_order_out_of_stock(payment["order_number"])
+                    break
 
     def _process_due_order_transitions(self) -> None:
         now = utc_now()
-        orders = list(self.mongo.orders.find({"scheduled_transitions.processed_at": None}))
+        orders = list(self.mongo.orders.find(self._due_filter("scheduled_transitions", now)))
         for order in orders:
-            for transition in sorted(order.get("scheduled_transitions", []), key=lambda item: item.get("due_at", "")):
+            for transition in sorted(order.get("scheduled_transitions", []), key=lambda item: parse_dt(item.get("due_at"))):
                 if transition.get("processed_at"):
                     continue
                 if parse_dt(transition.get("due_at")) > now:
                     continue
+                if not self._settle_stock(order["order_number"], transition["target_status"]):
+                    self._mark_order_transition_processed(order["order_number"], transition["transition_id"])
+                    self._fail_order_out_of_stock(order["order_number"])
+                    break
                 updated_order = self._update_order_status(
                     order,
                     transition["target_status"],
@@ -701,12 +862,12 @@ class CommerceSimulationService:
                 if transition["target_status"] == "payment_confirmed":
                     self.mongo.orders.update_one(
                         {"order_number": order["order_number"]},
-                        {"$set": {"payment_status": "success", "updated_at": to_iso(now)}},
+                        {"$set": {"payment_status": "success", "updated_at": now}},
                     )
                 if transition["target_status"] == "payment_failed":
                     self.mongo.orders.update_one(
                         {"order_number": order["order_number"]},
-                        {"$set": {"payment_status": "failed", "updated_at": to_iso(now)}},
+                        {"$set": {"payment_status": "failed", "updated_at": now}},
                     )
                 event_type = ORDER_EVENT_MAP.get(transition["target_status"])
                 if event_type:
@@ -720,7 +881,7 @@ class CommerceSimulationService:
                 order = updated_order
 
     def _product_interest_trigger(self, user_id: str, product_id: int) -> None:
-        since = to_iso(utc_now() - timedelta(hours=24))
+        since = utc_now() - timedelta(hours=24)
         views = list(
             self.mongo.user_activity.find(
                 {
@@ -800,31 +961,29 @@ class CommerceSimulationService:
     def _activate_due_call_workflows(self) -> None:
         now = utc_now()
         self.mongo.call_workflows.update_many(
-            {"status": "scheduled", "scheduled_for": {"$lte": to_iso(now)}},
-            {"$set": {"status": "ready", "updated_at": to_iso(now)}},
+            {"status": "scheduled", "scheduled_for": {"$lte": now}},
+            {"$set": {"status": "ready", "updated_at": now}},
         )
 
-    def record_user_activity(self, user_id: str, activity_type: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        now = utc_now()
-        activity = {
+    def _build_activity(self, user_id: str, activity_type: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return {
             "activity_id": self._new_id("act"),
             "user_id": user_id,
             "activity_type": activity_type,
             "product_id": (payload or {}).get("product_id"),
             "order_number": (payload or {}).get("order_number"),
             "metadata": payload or {},
-            "created_at": to_iso(now),
+            "created_at": utc_now(),
         }
+
+    def record_user_activity(self, user_id: str, activity_type: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        activity = self._build_activity(user_id, activity_type, payload)
         self.mongo.user_activity.insert_one(activity)
+        trending.record_activity(activity)
+        if activity_type in SLATE_ACTIVITY_TYPES:
+            recommendation_slates.mark_stale(user_id)
 
-        event_type_map = {
-            "product_view": "product_viewed",
-            "cart_add": "cart_updated",
-            "cart_remove": "cart_updated",
-            "cart_update": "cart_updated",
-            "checkout_started": "checkout_started",
-        }
-        event_type = event_type_map.get(activity_type)
+        event_type = ACTIVITY_EVENT_MAP.get(activity_type)
         if event_type:
             self._emit_event(
                 event_type,
@@ -873,13 +1032,26 @@ class CommerceSimulationService:
             ],
         }
 
-    def get_user_communications(self, user_id: str) -> Dict[str, List[Dict[str, Any]]]:
-        notifications = list(self.mongo.notifications.find({"user_id": user_id}).sort("created_at", -1).limit(50))
-        call_workflows = list(self.mongo.call_workflows.find({"user_id": user_id}).sort("created_at", -1).limit(50))
-        return {
-            "notifications": notifications,
-            "call_workflows": call_workflows,
-        }
+    def get_user_communications(
+        self,
+        user_id: str,
+        limit: int = 50,
+        cursors: Optional[Dict[str, Optional[str]]] = None,
+    ) -> Dict[str, Any]:
+        """Newest notifications and call workflows, each paged with its own cursor."""
+        cursors = cursors or {}
+        communications: Dict[str, Any] = {"next_cursors": {}}
+        for collection_name in ("notifications", "call_workflows"):
+            documents, next_cursor = find_page(
+                self.mongo[collection_name],
+                {"user_id": user_id},
+                [("created_at", -1), ("_id", -1)],
+                limit,
+                cursors.get(collection_name),
+            )
+            communications[collection_name] = documents
+            communications["next_cursors"][collection_name] = next_cursor
+        return communications
 
     def update_whatsapp_connection(
         self,
@@ -888,8 +1060,6 @@ class CommerceSimulationService:
         connected: bool,
         opt_in: bool = True,
     ) -> Optional[Dict[str, Any]]:
-        from bson import ObjectId
-
         now = utc_now()
         connection = {
             "provider": "openclaw",
@@ -897,21 +1067,23 @@ class CommerceSimulationService:
             "status": "connected" if connected else "disconnected",
             "phone_number": phone_number,
             "opt_in": opt_in,
-            "connected_at": to_iso(now) if connected else None,
-            "updated_at": to_iso(now),
+            "connected_at": now if connected else None,
+            "updated_at": now,
         }
         try:
-            self.mongo.users.update_one(
-                {"_id": ObjectId(user_id)},
+            updated = db.update_user_document(
+                user_id,
                 {
                     "$set": {
                         "whatsapp_connection": connection,
-                        "updated_at": to_iso(now),
+                        "updated_at": now,
                     }
                 },
             )
         except Exception:
             return None
+        if not updated:
+            return None
 
         self._emit_event(
             "whatsapp_connected" if connected else "whatsapp_disconnected",
@@ -932,10 +1104,15 @@ class CommerceSimulationService:
             return None
 
         now = utc_now()
+        # Stock is taken once, when an unpaid order first moves past order_placed.
+        paying = target_status in ORDER_STATUS_FLOW[1:] and order.get("payment_status") != "success"
+        if paying and not self._settle_stock(order_number, "payment_confirmed"):
+            target_status, note = "payment_failed", STOCK_LAPSED_NOTE
         updated_order = self._update_order_status(order, target_status, source=source, note=note or "Manual simulation override applied.")
 
         if target_status == "payment_failed":
             self.mongo.orders.update_one({"order_number": order_number}, {"$set": {"payment_status": "failed"}})
+            self._settle_stock(order_number, "payment_failed")
         elif target_status in ORDER_STATUS_FLOW[1:]:
             self.mongo.orders.update_one({"order_number": order_number}, {"$set": {"payment_status": "success"}})
 
@@ -943,14 +1120,14 @@ class CommerceSimulationService:
             {
                 "transition_id": self._new_id("ordtr"),
                 "target_status": status,
-                "due_at": to_iso(now + timedelta(seconds=delay)),
+                "due_at": now + timedelta(seconds=delay),
                 "processed_at": None,
             }
             for status, delay in STATUS_CHAIN_DELAYS.get(target_status, [])
         ]
         self.mongo.orders.update_one(
             {"order_number": order_number},
-            {"$set": {"scheduled_transitions": remaining, "updated_at": to_iso(now)}},
+            {"$set": {"scheduled_transitions": remaining, "updated_at": now}},
         )
         event_type = ORDER_EVENT_MAP.get(target_status)
         if event_type:
@@ -974,6 +1151,9 @@ class CommerceSimulationService:
         if not order or not payment:
             return None
 
+        # A failed payment released the order's stock; take it again before retrying.
+        self._reserve_order_stock(order)
+
         now = utc_now()
         new_payment_id = self._new_id("pay")
         attempt_number = int(payment.get("attempt_number", 1)) + 1
@@ -996,8 +1176,8 @@ class CommerceSimulationService:
                 )
             ],
             "scheduled_updates": self._build_payment_updates(scenario, now),
-            "created_at": to_iso(now),
-            "updated_at": to_iso(now),
+            "created_at": now,
+            "updated_at": now,
         }
         self.mongo.payments.insert_one(new_payment)
         self.mongo.orders.update_one(
@@ -1009,7 +1189,7 @@ class CommerceSimulationService:
                     "order_status": "order_placed",
                     "status": "order_placed",
                     "scheduled_transitions": self._build_scheduled_transitions(scenario, now),
-                    "updated_at": to_iso(now),
+                    "updated_at": now,
                 },
                 "$push": {
                     "timeline": self._build_order_timeline_entry(
@@ -1,49 +1,182 @@
 from __future__ import annotations
 
+import base64
+import copy
 import logging
 import os
 import re
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from bson import ObjectId
+import numpy as np
+from bson import ObjectId, json_util
 from dotenv import load_dotenv
-from passlib.context import CryptContext
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from cache import BroadcastInvalidator, TTLCache
+from catalog_snapshot import SNAPSHOT_DIR, CatalogSnapshot, SnapshotStore
+from catalog import (
+    RECORD_PROJECTION,
+    SEARCH_PROJECTION,
+    SUGGEST_PROJECTION,
+    ProductRecord,
+    ProductSearchIndex,
+    SuggestionIndex,
+    normalize_key,
+)
+from indexes import INDEX_MANIFEST, apply_index_manifest
+from security import hash_password, verify_password
+from singleflight import SingleFlight
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-
-def utc_iso() -> str:
-    return datetime.utcnow().replace(microsecond=0).isoformat()
+STOCK_HOLD_TTL_SECONDS = int(os.getenv("STOCK_HOLD_TTL_SECONDS", "900"))
+STOCK_HOLD_RETENTION_SECONDS = int(os.getenv("STOCK_HOLD_RETENTION_SECONDS", str(7 * 24 * 3600)))
+CATALOG_META_ID = "products"
+PRODUCT_LIST_PROJECTION = {"description": 0}
+PRICE_FACET_BOUNDARIES = [0, 50, 100, 200, 500, 1000]
+# Free-text hits beyond this rank are dropped before any MongoDB query sees them.
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "1000"))
+SUGGEST_POPULARITY_REFRESH_SECONDS = int(os.getenv("SUGGEST_POPULARITY_REFRESH_SECONDS", "600"))
+SUGGEST_POPULARITY_WINDOW_DAYS = int(os.getenv("SUGGEST_POPULARITY_WINDOW_DAYS", "30"))
+SUGGEST_SYNC_INTERVAL_SECONDS = float(os.getenv("SUGGEST_SYNC_INTERVAL_SECONDS", "5"))
+ITEM_SIMILARITY_WINDOW_DAYS = int(os.getenv("ITEM_SIMILARITY_WINDOW_DAYS", "90"))
+CHAT_FOLDED_BATCHES_KEPT = 20
+
+
+def utc_now() -> datetime:
+    """Naive UTC timestamp at second precision, stored by Mongo as a BSON date."""
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def coerce_datetime(value: Any) -> Optional[datetime]:
+    """Return ``value`` as a naive UTC datetime, or None when it is not a timestamp."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, str) and value:
+        try:
+            return coerce_datetime(datetime.fromisoformat(value.replace("Z", "+00:00")))
+        except ValueError:
+            return None
+    return None
+
+
+def parse_dt(value: Any) -> datetime:
+    return coerce_datetime(value) or utc_now()
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Pack keyset sort values (ObjectIds and datetimes included) into an opaque token."""
+    payload = json_util.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json_util.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception as error:
+        raise ValueError("Invalid cursor") from error
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def projection_for(fields: Optional[str], default: Optional[Dict[str, int]] = None) -> Optional[Dict[str, int]]:
+    """Turn a comma-separated ``fields`` query parameter into a projection.
+
+    Without ``fields`` the list view's ``default`` projection applies, which
+    usually excludes heavy fields such as descriptions and timelines.
+    """
+    if fields:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        if names:
+            return {name: 1 for name in names}
+    return default
+
+
+def find_page(
+    collection,
+    query: Dict[str, Any],
+    sort: List[Tuple[str, int]],
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, int]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Read one keyset page along ``sort`` and return it with the cursor for the next page.
+
+    ``sort`` must end in a unique key (normally ``_id``) and be covered by an
+    index led by the equality fields of ``query``; the cursor then resumes with
+    an index seek instead of skipping, so page 1000 costs the same as page 1.
+    """
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(sort):
+            raise ValueError("Invalid cursor")
+        branches = []
+        for position, (field, direction) in enumerate(sort):
+            branch = {sort[index][0]: values[index] for index in range(position)}
+            branch[field] = {"$gt" if direction > 0 else "$lt": values[position]}
+            branches.append(branch)
+        query = {"$and": [query, {"$or": branches}]} if query else {"$or": branches}
+
+    if projection and all(value for value in projection.values()):
+        # The sort keys are needed to build the next cursor.
+        projection = {**projection, **{field: 1 for field, _ in sort}}
+    documents = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor([documents[-1].get(field) for field, _ in sort])
+    return documents, next_cursor
 
 
 class DatabaseUnavailableError(RuntimeError):
     """Raised when MongoDB cannot be reached for an operation."""
 
 
+class CartVersionConflictError(RuntimeError):
+    """Raised when a cart changed since the version the caller based its update on."""
+
+    def __init__(self, current_version: int) -> None:
+        super().__init__(f"Cart was modified; current version is {current_version}")
+        self.current_version = current_version
+
+
 class Database:
-    COLLECTION_INDEXES = {
-        "users": [("email", 1), ("user_id", 1), ("id", 1)],
-        "products": [("id", 1), ("product_name", 1), ("dress_category", 1)],
-        "carts": [("user_id", 1)],
-        "wishlists": [("user_id", 1)],
-        "orders": [("order_number", 1), ("user_id", 1), ("created_at", -1)],
-        "payments": [("payment_id", 1), ("order_number", 1), ("user_id", 1), ("created_at", -1)],
-        "commerce_events": [("event_id", 1), ("event_type", 1), ("user_id", 1), ("order_number", 1), ("created_at", -1)],
-        "notifications": [("notification_id", 1), ("user_id", 1), ("order_number", 1), ("created_at", -1)],
-        "call_workflows": [("call_workflow_id", 1), ("user_id", 1), ("order_number", 1), ("scenario", 1), ("created_at", -1)],
-        "user_activity": [("activity_id", 1), ("user_id", 1), ("activity_type", 1), ("product_id", 1), ("created_at", -1)],
-        "order_items": [("order_id", 1)],
-        "chat_sessions": [("session_id", 1), ("user_id", 1), ("created_at", -1)],
-        "chat_messages": [("session_id", 1), ("created_at", 1)],
-        "agent_tasks": [("task_id", 1), ("status", 1)],
+    TIMESTAMP_FIELDS = {
+        "added_at",
+        "completed_at",
+        "connected_at",
+        "created_at",
+        "delivered_at",
+        "delivery_eta",
+        "due_at",
+        "last_message_at",
+        "processed_at",
+        "scheduled_for",
+        "sent_at",
+        "updated_at",
     }
+    USER_REFERENCE_COLLECTIONS = [
+        "carts",
+        "wishlists",
+        "orders",
+        "payments",
+        "commerce_events",
+        "notifications",
+        "call_workflows",
+        "user_activity",
+        "chat_sessions",
+    ]
 
     def __init__(
         self,
@@ -59,6 +192,39 @@ class Database:
         self.server_selection_timeout_ms = server_selection_timeout_ms
         self.client: Optional[MongoClient] = None
         self._db = None
+        self._search_flight = SingleFlight("product_search")
+        self._search_index = ProductSearchIndex()
+        self._suggest_index = SuggestionIndex()
+        self._suggest_ranked_at = 0.0
+        self._snapshots = SnapshotStore(os.path.join(SNAPSHOT_DIR, self.db_name))
+        self._product_records: Tuple[Any, Dict[Any, ProductRecord], Dict[Any, Optional[str]]] = (None, {}, {})
+        self._product_records_lock = threading.Lock()
+        self._canonical_user_ids = False
+        self._catalog_keys = False
+        self._transactions_supported: Optional[bool] = None
+        self._user_id_aliases = TTLCache("user_id_aliases", maxsize=10000)
+        self._user_cache = TTLCache(
+            "users",
+            maxsize=int(os.getenv("USER_CACHE_SIZE", "5000")),
+            ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", "60")),
+        )
+        self._catalog_meta_cache = TTLCache(
+            "catalog_meta",
+            maxsize=1,
+            ttl=float(os.getenv("CACHE_SYNC_INTERVAL_SECONDS", "2")),
+        )
+        self._ranking_cache = TTLCache("search_rankings", maxsize=int(os.getenv("SEARCH_RANKING_CACHE_SIZE", "256")))
+        self._neighbour_cache = TTLCache(
+            "item_neighbours",
+            maxsize=int(os.getenv("ITEM_NEIGHBOUR_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("ITEM_NEIGHBOUR_CACHE_TTL_SECONDS", "600")),
+        )
+        self._user_invalidator = BroadcastInvalidator(
+            "users",
+            lambda: self.db.cache_versions,
+            self._user_cache,
+            poll_interval=float(os.getenv("CACHE_SYNC_INTERVAL_SECONDS", "2")),
+        )
 
     def connect(self):
         if self._db is not None:
@@ -74,6 +240,10 @@ class Database:
             self.client = client
             self._db = database
             self._ensure_collections()
+            self._canonical_user_ids = bool(
+                database.schema_migrations.find_one({"_id": "canonical_user_ids"})
+            )
+            self._catalog_keys = bool(database.schema_migrations.find_one({"_id": "catalog_keys"}))
             logger.info("Connected to MongoDB database '%s'", self.db_name)
             return self._db
         except PyMongoError as error:
@@ -85,25 +255,32 @@ class Database:
         return self.connect()
 
     def _ensure_collections(self) -> None:
-        database = self._db
-        if database is None:
-            return
-
-        existing_collections = set(database.list_collection_names())
-        for collection_name, indexes in self.COLLECTION_INDEXES.items():
-            if collection_name not in existing_collections:
-                database.create_collection(collection_name)
-                logger.info("Created collection: %s", collection_name)
-
-            collection = database[collection_name]
-            for field, direction in indexes:
-                collection.create_index([(field, direction)])
+        if self._db is not None:
+            apply_index_manifest(self._db)
 
     def close(self) -> None:
         if self.client is not None:
             self.client.close()
         self.client = None
         self._db = None
+        self._transactions_supported = None
+
+    @property
+    def supports_transactions(self) -> bool:
+        """Multi-document transactions need a replica set member or a mongos router."""
+        if self._transactions_supported is None:
+            self.connect()
+            try:
+                hello = self.client.admin.command("hello")
+                self._transactions_supported = bool(hello.get("setName") or hello.get("msg") == "isdbgrid")
+            except PyMongoError:
+                self._transactions_supported = False
+        return self._transactions_supported
+
+    def run_in_transaction(self, callback: Callable[[Any], Any]) -> Any:
+        """Run ``callback(session)`` in a transaction; the caller handles the no-transaction case."""
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
 
     def get_collection(self, collection_name: str):
         return self.db[collection_name]
@@ -130,6 +307,37 @@ class Database:
 
         return filters
 
+    def _user_lookup_filter(self, user_id: str) -> Dict[str, Any]:
+        """Resolve any accepted user identifier to a single users query.
+
+        After the canonical id migration this is one equality match on
+        ``user_id``. Before it, aliases that were resolved once map straight to
+        ``_id``; unknown ones fall back to one $or over every legacy variant.
+        """
+        if self._canonical_user_ids:
+            return {"user_id": str(user_id)}
+
+        document_id = self._user_id_aliases.get(str(user_id))
+        if document_id is not None:
+            return {"_id": document_id}
+        return {"$or": self._user_document_filters(user_id)}
+
+    def _find_user_document(self, user_id: str) -> Optional[Dict[str, Any]]:
+        user = self.db.users.find_one(self._user_lookup_filter(user_id))
+        if user is None and self._canonical_user_ids:
+            user = self.db.users.find_one({"legacy_ids": {"$in": self._user_id_variants(user_id)}})
+        if user is not None:
+            self._user_id_aliases.set(str(user_id), user["_id"])
+        return user
+
+    def _user_id_variants(self, user_id: Any) -> List[Any]:
+        variants: List[Any] = [user_id, str(user_id)]
+        try:
+            variants.append(int(str(user_id)))
+        except (TypeError, ValueError):
+            pass
+        return variants
+
     def _user_reference_filters(self, user_id: Optional[str]) -> List[Dict[str, Any]]:
         filters: List[Dict[str, Any]] = []
         if user_id is None:
@@ -149,7 +357,7 @@ class Database:
 
         return filters
 
-    def _public_user(self, user: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    def public_user(self, user: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
         if not user:
             return None
 
@@ -175,19 +383,26 @@ class Database:
         return self.db.users.find_one({"email": email.lower()})
 
     def update_user(self, user_id: int, update_data: Dict[str, Any]) -> bool:
-        result = self.db.users.update_one(
-            {"$or": [{"user_id": user_id}, {"id": user_id}]},
-            {"$set": update_data},
-        )
-        return result.modified_count > 0
+        return self.update_user_document(user_id, {"$set": update_data})
 
-    def register_user(self, email: str, password: str, first_name: str, last_name: str) -> Optional[Dict[str, Any]]:
+    def register_user(
+        self,
+        email: str,
+        password: str,
+        first_name: str,
+        last_name: str,
+        password_hash: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Create a user; pass ``password_hash`` when it was computed off the event loop."""
         if self.db.users.find_one({"email": email.lower()}):
             return None
 
+        document_id = ObjectId()
         user_data = {
+            "_id": document_id,
+            "user_id": str(document_id),
             "email": email.lower(),
-            "password_hash": pwd_context.hash(password),
+            "password_hash": password_hash or hash_password(password),
             "first_name": first_name,
             "last_name": last_name,
             "phone": None,
@@ -199,11 +414,12 @@ class Database:
             "loyalty_score": 0,
             "is_active": True,
             "is_admin": False,
-            "created_at": utc_iso(),
-            "updated_at": utc_iso(),
+            "created_at": utc_now(),
+            "updated_at": utc_now(),
         }
 
         result = self.db.users.insert_one(user_data)
+        self.invalidate_user(str(result.inserted_id))
         user_data["id"] = str(result.inserted_id)
         user_data["_id"] = user_data["id"]
         return user_data
@@ -213,41 +429,223 @@ class Database:
         if not user:
             return None
 
-        if not pwd_context.verify(password, user.get("password_hash", "")):
+        valid, new_hash = verify_password(password, user.get("password_hash", ""))
+        if not valid:
             return None
+        if new_hash:
+            self.update_password_hash(user["_id"], new_hash)
 
-        return self._public_user(user)
+        return self.public_user(user)
+
+    def update_password_hash(self, document_id: Any, password_hash: str) -> bool:
+        result = self.db.users.update_one(
+            {"_id": document_id},
+            {"$set": {"password_hash": password_hash, "updated_at": utc_now()}},
+        )
+        return result.modified_count > 0
+
+    def revoke_token(self, token_id: str, expires_at: datetime) -> None:
+        """Record a revoked token id; the TTL index drops it once the token would have expired anyway."""
+        self.db.revoked_tokens.update_one(
+            {"_id": token_id},
+            {"$setOnInsert": {"expires_at": expires_at, "revoked_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    def get_revoked_token_ids(self) -> List[str]:
+        cursor = self.db.revoked_tokens.find({"expires_at": {"$gt": datetime.utcnow()}}, {"_id": 1})
+        return [document["_id"] for document in cursor]
 
     def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
-        for lookup in self._user_document_filters(user_id):
-            user = self.db.users.find_one(lookup)
-            if user:
-                return self._public_user(user)
+        """Read-through cached lookup of the public user document.
+
+        Entries are keyed by the stringified ``_id`` so every alias of a user
+        shares one entry and one invalidation.
+        """
+        self._user_invalidator.sync()
+        cache_key = str(self._user_id_aliases.get(str(user_id)) or user_id)
+        cached = self._user_cache.get(cache_key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+    def catalog_version(self) -> Any:
+        """The current catalog version, without copying the metadata document."""
+        cached = self._catalog_meta_cache.get(CATALOG_META_ID)
+        if cached is None:
+            return self.get_catalog_metadata().get("version", 0)
+        return cached.get("version", 0)
+
+        user = self.public_user(self._find_user_document(user_id))
+        if user is not None:
+            self._user_cache.set(user["id"], user)
+            return copy.deepcopy(user)
         return None
 
+    def invalidate_user(self, user_id: Any) -> None:
+        """Drop a user from this worker's cache and tell the other workers to do the same."""
+        document_id = self._user_id_aliases.get(str(user_id), user_id)
+        self._user_invalidator.publish(str(document_id))
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "users": {
+                **self._user_cache.stats(),
+                "remote_invalidations": self._user_invalidator.remote_invalidations,
+            },
+            "user_id_aliases": self._user_id_aliases.stats(),
+            "product_search": self._search_flight.stats(),
+            "catalog_meta": self._catalog_meta_cache.stats(),
+            "product_search_index": self._search_index.stats(),
+            "search_rankings": self._ranking_cache.stats(),
+            "product_suggestions": self._suggest_index.stats(),
+            "catalog_snapshot": self._snapshots.stats(),
+            "item_neighbours": self._neighbour_cache.stats(),
+            "product_records": {"version": self._product_records[0], "size": len(self._product_records[1])},
+        }
+
     def get_user_flexible(self, user_id: Optional[str]) -> Optional[Dict[str, Any]]:
         if not user_id:
             return None
         return self.get_user_by_id(str(user_id))
 
+    def update_user_document(self, user_id: Any, update: Dict[str, Any]) -> bool:
+        """Apply ``update`` to the user any accepted identifier resolves to.
+
+        The id is resolved like a read (alias cache, then _find_user_document,
+        which also knows ``legacy_ids``) and the write goes to ``_id``, so every
+        id that can read a user can also update it.
+        """
+        document_id = self._user_id_aliases.get(str(user_id))
+        if document_id is None:
+            user = self._find_user_document(user_id)
+            if user is None:
+                return False
+            document_id = user["_id"]
+        result = self.db.users.update_one({"_id": document_id}, update)
+        if result.matched_count == 0:
+            return False
+        self.invalidate_user(document_id)
+        return True
+
     def update_user_profile(self, user_id: str, **kwargs: Any) -> bool:
-        updates = {**kwargs, "updated_at": utc_iso()}
-        for lookup in self._user_document_filters(user_id):
-            result = self.db.users.update_one(lookup, {"$set": updates})
-            if result.modified_count > 0:
-                return True
-        return False
+        return self.update_user_document(user_id, {"$set": {**kwargs, "updated_at": utc_now()}})
 
     def update_user_loyalty(self, user_id: str, points_delta: int) -> bool:
-        updates = {
-            "$inc": {"loyalty_score": points_delta},
-            "$set": {"updated_at": utc_iso()},
-        }
-        for lookup in self._user_document_filters(user_id):
-            result = self.db.users.update_one(lookup, updates)
-            if result.modified_count > 0:
-                return True
-        return False
+        return self.update_user_document(
+            user_id,
+            {
+                "$inc": {"loyalty_score": points_delta},
+                "$set": {"updated_at": utc_now()},
+            },
+        )
+
+    def migrate_canonical_user_ids(self, batch_size: int = 500) -> Dict[str, int]:
+        """Rewrite every user to ``user_id == str(_id)`` and repoint references that used legacy ids.
+
+        Previous identifiers are kept in ``legacy_ids`` so old links still
+        resolve. The run is idempotent and is recorded in schema_migrations.
+        """
+        counts = {"users": 0, "references": 0}
+        users = self.db.users.find({}, {"_id": 1, "user_id": 1, "id": 1}).batch_size(batch_size)
+        user_updates: List[UpdateOne] = []
+        for user in users:
+            canonical_id = str(user["_id"])
+            legacy_ids = [
+                value
+                for value in (user.get("user_id"), user.get("id"))
+                if value is not None and str(value) != canonical_id
+            ]
+            user_updates.append(
+                UpdateOne(
+                    {"_id": user["_id"]},
+                    {
+                        "$set": {"user_id": canonical_id},
+                        "$addToSet": {"legacy_ids": {"$each": legacy_ids}},
+                    },
+                )
+            )
+
+            aliases = [variant for legacy_id in legacy_ids for variant in self._user_id_variants(legacy_id)]
+            aliases.append(user["_id"])
+            for collection_name in self.USER_REFERENCE_COLLECTIONS:
+                result = self.db[collection_name].update_many(
+                    {"user_id": {"$in": aliases}},
+                    {"$set": {"user_id": canonical_id}},
+                )
+                counts["references"] += result.modified_count
+
+            if len(user_updates) >= batch_size:
+                counts["users"] += self.db.users.bulk_write(user_updates, ordered=False).modified_count
+                user_updates = []
+        if user_updates:
+            counts["users"] += self.db.users.bulk_write(user_updates, ordered=False).modified_count
+
+        self.db.schema_migrations.update_one(
+            {"_id": "canonical_user_ids"},
+            {"$set": {"completed_at": utc_now(), **counts}},
+            upsert=True,
+        )
+        self._canonical_user_ids = True
+        self._user_cache.clear()
+        return counts
+
+    def _convert_timestamps(self, value: Any) -> Tuple[Any, bool]:
+        """Return ``value`` with string timestamps under TIMESTAMP_FIELDS keys turned into datetimes."""
+        if isinstance(value, list):
+            converted = [self._convert_timestamps(item) for item in value]
+            return [item for item, _ in converted], any(changed for _, changed in converted)
+        if not isinstance(value, dict):
+            return value, False
+
+        result, changed = {}, False
+        for key, item in value.items():
+            if key in self.TIMESTAMP_FIELDS and isinstance(item, str):
+                parsed = coerce_datetime(item)
+                if parsed is not None:
+                    result[key] = parsed
+                    changed = True
+                    continue
+            result[key], item_changed = self._convert_timestamps(item)
+            changed = changed or item_changed
+        return result, changed
+
+    def migrate_timestamps_to_datetime(self, batch_size: int = 500) -> Dict[str, int]:
+        """Convert ISO-string timestamps in every collection, including nested arrays, to BSON dates.
+
+        Only the top-level fields that contain a converted value are rewritten.
+        Strings that are not ISO timestamps are left untouched. The run is
+        idempotent and is recorded in schema_migrations.
+        """
+        counts: Dict[str, int] = {}
+        for collection_name in INDEX_MANIFEST:
+            collection = self.db[collection_name]
+            updates: List[UpdateOne] = []
+            modified = 0
+            for document in collection.find({}).batch_size(batch_size):
+                changes = {}
+                for key, value in document.items():
+                    if key == "_id":
+                        continue
+                    converted, changed = self._convert_timestamps({key: value})
+                    if changed:
+                        changes[key] = converted[key]
+                if changes:
+                    updates.append(UpdateOne({"_id": document["_id"]}, {"$set": changes}))
+                if len(updates) >= batch_size:
+                    modified += collection.bulk_write(updates, ordered=False).modified_count
+                    updates = []
+            if updates:
+                modified += collection.bulk_write(updates, ordered=False).modified_count
+            if modified:
+                counts[collection_name] = modified
+
+        self.db.schema_migrations.update_one(
+            {"_id": "bson_datetimes"},
+            {"$set": {"completed_at": utc_now(), "collections": counts}},
+            upsert=True,
+        )
+        self._user_cache.clear()
+        return counts
 
     # Product operations
     def get_all_products(self) -> List[Dict[str, Any]]:
@@ -256,15 +654,60 @@ class Database:
     def get_product(self, product_id: int) -> Optional[Dict[str, Any]]:
         return self.db.products.find_one({"id": product_id})
 
+    def get_catalog_product(self, product_id: Any) -> Optional[Dict[str, Any]]:
+        """A product for display: read from the catalog snapshot with live stock, else from MongoDB."""
+        snapshot = self.catalog_snapshot()
+        if snapshot is None:
+            return self.get_product(product_id)
+        position = snapshot.position(product_id)
+        if position is None:
+            return None
+        return self._with_live_stock(snapshot.rows([position]))[0]
+
+    def get_stock_levels(self, product_ids: Optional[List[Any]] = None) -> Dict[Any, int]:
+        """Current stock by product id; stock changes do not bump the catalog version."""
+        query = {} if product_ids is None else {"id": {"$in": list(product_ids)}}
+        return {
+            product["id"]: product.get("stock", 0)
+            for product in self.db.products.find(query, {"_id": 0, "id": 1, "stock": 1})
+        }
+
+    def _with_live_stock(self, products: List[Dict[str, Any]], all_products: bool = False) -> List[Dict[str, Any]]:
+        if not products:
+            return products
+        stock = self.get_stock_levels(None if all_products else [product["id"] for product in products])
+        for product in products:
+            product["stock"] = stock.get(product["id"], product["stock"])
+        return products
+
     def get_products_by_category(self, category: str) -> List[Dict[str, Any]]:
         return list(self.db.products.find({"dress_category": category}))
 
     def insert_products(self, products: List[Dict[str, Any]]) -> List[str]:
         if not products:
             return []
+        for product in products:
+            product.update(self._catalog_keys_for(product))
         result = self.db.products.insert_many(products)
+        self.refresh_catalog_metadata()
         return [str(inserted_id) for inserted_id in result.inserted_ids]
 
+    def upsert_product(self, product_id: int, fields: Dict[str, Any]) -> None:
+        """Create or edit one product and publish a new catalog version."""
+        update = dict(fields)
+        if "dress_category" in fields:
+            update["category_key"] = normalize_key(fields["dress_category"])
+        if "occasion" in fields:
+            update["occasion_key"] = normalize_key(fields["occasion"])
+        self.db.products.update_one({"id": product_id}, {"$set": update}, upsert=True)
+        self.refresh_catalog_metadata()
+
+    def delete_products(self, query: Dict[str, Any]) -> int:
+        """Delete the matching products and publish a new catalog version."""
+        deleted = self.db.products.delete_many(query).deleted_count
+        self.refresh_catalog_metadata()
+        return deleted
+
     def search_products(
         self,
         category: Optional[str] = None,
@@ -273,78 +716,789 @@ class Database:
         max_price: Optional[float] = None,
         query: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
+        key = (category, occasion, min_price, max_price, query)
+        products = self._search_flight.do(
+            key,
+            self._search_products,
+            category=category,
+            occasion=occasion,
+            min_price=min_price,
+            max_price=max_price,
+            query=query,
+        )
+        return products
+
+    def _search_products(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        query: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        snapshot = self.catalog_snapshot()
+        if snapshot is not None:
+            return self._search_snapshot(snapshot, category, occasion, min_price, max_price, query)
+
+        filters = self._catalog_filters(category, occasion, min_price, max_price)
+        if not query:
+            return list(self.db.products.find(filters))
+
+        # Free text is ranked in memory; MongoDB only applies the structured filters to the top hits.
+        _, ranked = self.rank_products(query)
+        if not ranked:
+            return []
+        scores = dict(ranked)
+        filters["id"] = {"$in": list(scores)}
+        products = list(self.db.products.find(filters))
+        products.sort(key=lambda product: scores.get(product.get("id"), 0.0), reverse=True)
+        return products
+
+    def _search_snapshot(
+        self,
+        snapshot: CatalogSnapshot,
+        category: Optional[str],
+        occasion: Optional[str],
+        min_price: Optional[float],
+        max_price: Optional[float],
+        query: Optional[str],
+    ) -> List[Dict[str, Any]]:
+        mask = snapshot.filter_mask(category, occasion, min_price, max_price)
+        if not query:
+            positions = np.flatnonzero(mask)
+            return self._with_live_stock(snapshot.rows(positions), all_products=len(positions) == len(snapshot))
+
+        positions = []
+        for product_id, _ in self.rank_products(query)[1]:
+            position = snapshot.position(product_id)
+            if position is not None and mask[position]:
+                positions.append(position)
+        return self._with_live_stock(snapshot.rows(positions))
+
+    def list_products_page(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        query: Optional[str] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        projection: Optional[Dict[str, int]] = PRODUCT_LIST_PROJECTION,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """One page of the catalog listing and the cursor for the next one.
+
+        Plain listings page along ``_id``. Free-text results page along the
+        ranking: the cursor holds the search index version and the rank to
+        resume from, and is rejected once the index has been rebuilt.
+        """
+        filters = self._catalog_filters(category, occasion, min_price, max_price)
+        if not query:
+            return find_page(self.db.products, filters, [("_id", 1)], limit, cursor, projection)
+
+        version, ranked = self.rank_products(query)
+        position = 0
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != 2 or not isinstance(values[1], int) or values[1] < 0:
+                raise ValueError("Invalid cursor")
+            if values[0] != version:
+                raise ValueError("The catalog changed since this cursor was issued; start again from the first page")
+            position = values[1]
+        if projection and all(value for value in projection.values()):
+            projection = {**projection, "id": 1}
+
+        page: List[Tuple[int, Dict[str, Any]]] = []
+        while position < len(ranked) and len(page) <= limit:
+            # Filters may drop some hits, so fetch a few pages' worth of ids per round trip.
+            chunk = ranked[position : position + 4 * (limit + 1)]
+            found = {
+                product.get("id"): product
+                for product in self.db.products.find({**filters, "id": {"$in": [pid for pid, _ in chunk]}}, projection)
+            }
+            page.extend(
+                (rank, found[product_id])
+                for rank, (product_id, _) in enumerate(chunk, position)
+                if product_id in found
+            )
+            position += len(chunk)
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor([version, page[-1][0] + 1])
+        return [product for _, product in page], next_cursor
+
+    def get_product_facets(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        query: Optional[str] = None,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Facet counts for the products matching the active filters, in one aggregation."""
+        match = self._catalog_filters(category, occasion, min_price, max_price)
+        if query:
+            match["id"] = {"$in": [product_id for product_id, _ in self.rank_products(query)[1]]}
+
+        def split_list(field: str) -> List[Dict[str, Any]]:
+            # colors and available_sizes are stored as comma-separated strings
+            return [
+                {"$match": {field: {"$type": "string"}}},
+                {"$project": {"value": {"$split": [f"${field}", ","]}}},
+                {"$unwind": "$value"},
+                {"$project": {"value": {"$trim": {"input": "$value"}}}},
+                {"$match": {"value": {"$ne": ""}}},
+                {"$group": {"_id": "$value", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+            ]
+
+        pipeline = [
+            {"$match": match},
+            {
+                "$facet": {
+                    "categories": [{"$group": {"_id": "$dress_category", "count": {"$sum": 1}}}],
+                    "occasions": [
+                        {"$match": {"occasion": {"$type": "string", "$ne": ""}}},
+                        {"$group": {"_id": "$occasion", "count": {"$sum": 1}}},
+                    ],
+                    "price_ranges": [
+                        {"$match": {"price": {"$type": "number"}}},
+                        {
+                            "$bucket": {
+                                "groupBy": "$price",
+                                "boundaries": PRICE_FACET_BOUNDARIES,
+                                "default": "above",
+                                "output": {"count": {"$sum": 1}},
+                            }
+                        },
+                    ],
+                    "colors": split_list("colors"),
+                    "sizes": split_list("available_sizes"),
+                }
+            },
+        ]
+        facets = next(self.db.products.aggregate(pipeline), {})
+
+        occasions: Dict[str, int] = {}
+        for group in facets.get("occasions", []):
+            occasion = group["_id"].strip()
+            if occasion:
+                occasions[occasion] = occasions.get(occasion, 0) + group["count"]
+
+        price_ranges = []
+        for bucket in facets.get("price_ranges", []):
+            if bucket["_id"] == "above":
+                price_ranges.append({"min": PRICE_FACET_BOUNDARIES[-1], "max": None, "count": bucket["count"]})
+            else:
+                upper = PRICE_FACET_BOUNDARIES[PRICE_FACET_BOUNDARIES.index(bucket["_id"]) + 1]
+                price_ranges.append({"min": bucket["_id"], "max": upper, "count": bucket["count"]})
+
+        return {
+            "categories": sorted(
+                (
+                    {
+                        "id": str(group["_id"] or "uncategorized"),
+                        "name": str(group["_id"] or "uncategorized").replace("-", " ").title(),
+                        "count": group["count"],
+                    }
+                    for group in facets.get("categories", [])
+                ),
+                key=lambda item: item["name"],
+            ),
+            "occasions": [
+                {"id": occasion.lower().replace(" ", "-"), "name": occasion, "count": count}
+                for occasion, count in sorted(occasions.items(), key=lambda item: item[0].lower())
+            ],
+            "price_ranges": sorted(price_ranges, key=lambda item: item["min"]),
+            "colors": [{"name": group["_id"], "count": group["count"]} for group in facets.get("colors", [])],
+            "sizes": [{"name": group["_id"], "count": group["count"]} for group in facets.get("sizes", [])],
+        }
+
+    def _catalog_filters(
+        self,
+        category: Optional[str],
+        occasion: Optional[str],
+        min_price: Optional[float],
+        max_price: Optional[float],
+    ) -> Dict[str, Any]:
         filters: Dict[str, Any] = {}
 
         if category:
-            escaped_category = re.escape(category)
-            if category in {"women", "men", "kids"}:
-                filters["dress_category"] = {"$regex": f"^{escaped_category}-", "$options": "i"}
+            if self._catalog_keys:
+                category_key = normalize_key(category)
+                if category_key in {"women", "men", "kids"}:
+                    # Anchored, case-sensitive prefix regexes are index range scans.
+                    filters["category_key"] = {"$regex": f"^{re.escape(category_key)}-"}
+                else:
+                    filters["category_key"] = category_key
             else:
-                filters["dress_category"] = {"$regex": f"^{escaped_category}$", "$options": "i"}
+                escaped_category = re.escape(category)
+                if category in {"women", "men", "kids"}:
+                    filters["dress_category"] = {"$regex": f"^{escaped_category}-", "$options": "i"}
+                else:
+                    filters["dress_category"] = {"$regex": f"^{escaped_category}$", "$options": "i"}
 
         if occasion:
-            filters["occasion"] = {"$regex": f"^{re.escape(occasion)}$", "$options": "i"}
+            if self._catalog_keys:
+                filters["occasion_key"] = normalize_key(occasion)
+            else:
+                filters["occasion"] = {"$regex": f"^{re.escape(occasion)}$", "$options": "i"}
 
         if min_price is not None:
             filters["price"] = {"$gte": min_price}
         if max_price is not None:
             filters.setdefault("price", {})
             filters["price"]["$lte"] = max_price
+        return filters
 
-        mongo_query: Dict[str, Any] = filters if filters else {}
-        if query:
-            escaped_query = re.escape(query)
-            text_match = {
-                "$or": [
-                    {"product_name": {"$regex": escaped_query, "$options": "i"}},
-                    {"description": {"$regex": escaped_query, "$options": "i"}},
-                    {"dress_category": {"$regex": escaped_query, "$options": "i"}},
-                    {"occasion": {"$regex": escaped_query, "$options": "i"}},
-                ]
+    def catalog_snapshot(self) -> Optional[CatalogSnapshot]:
+        """The memory-mapped catalog for the current version, or None while it is being built."""
+        version = self.get_catalog_metadata().get("version", 0)
+        return self._snapshots.ensure(version, lambda: self.db.products.find())
+
+    def _catalog_records(self) -> Tuple[Any, Dict[Any, ProductRecord], Dict[Any, Optional[str]]]:
+        """Records and normalized categories of the whole catalog, built once per catalog version.
+
+        Built from the mapped snapshot when it is on the current version, so a
+        version change costs no MongoDB scan once the snapshot is published.
+        Stock in the records is as of the build; use get_stock_levels for live values.
+        """
+        version = self.catalog_version()
+        if self._product_records[0] != version:
+            with self._product_records_lock:
+                if self._product_records[0] != version:
+                    snapshot = self.catalog_snapshot()
+                    if snapshot is not None and snapshot.version == version:
+                        products: Iterable[Dict[str, Any]] = (snapshot.row(position) for position in range(len(snapshot)))
+                    else:
+                        products = self.db.products.find({}, RECORD_PROJECTION)
+                    records = {record.id: record for record in map(ProductRecord, products)}
+                    categories = {product_id: normalize_key(record.category) for product_id, record in records.items()}
+                    self._product_records = (version, records, categories)
+        return self._product_records
+
+    def product_records(self, product_ids: Iterable[Any]) -> Dict[Any, ProductRecord]:
+        """Compact records of ``product_ids`` by id, from the per-version record cache."""
+        records = self._catalog_records()[1]
+        return {product_id: records[product_id] for product_id in product_ids if product_id in records}
+
+    def iter_product_records(self) -> Iterator[ProductRecord]:
+        """Every record of the current catalog version, from the per-version record cache."""
+        return iter(self._catalog_records()[1].values())
+
+    def product_categories(self) -> Dict[Any, Optional[str]]:
+        """Normalized dress_category by product id for the current catalog version."""
+        return self._catalog_records()[2]
+
+    def matching_product_ids(
+        self,
+        category: Optional[str] = None,
+        occasion: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> List[Any]:
+        """Ids of the products that pass the structured filters, from the snapshot columns when mapped."""
+        snapshot = self.catalog_snapshot()
+        if snapshot is not None:
+            mask = snapshot.filter_mask(category, occasion, min_price, max_price)
+            return snapshot.array("id")[mask].tolist()
+        return [
+            record.id
+            for record in self.iter_product_records()
+            if record.matches(category=category, occasion=occasion, min_price=min_price, max_price=max_price)
+        ]
+
+    def get_products_by_ids(
+        self, product_ids: List[Any], projection: Optional[Dict[str, int]] = None
+    ) -> List[Dict[str, Any]]:
+        """Product documents in the order of ``product_ids``."""
+        products = {
+            product["id"]: product
+            for product in self.db.products.find({"id": {"$in": list(product_ids)}}, projection)
+        }
+        return [products[product_id] for product_id in product_ids if product_id in products]
+
+    def product_search_index(self) -> ProductSearchIndex:
+        """The free-text index, rebuilt whenever the catalog version moves on."""
+        version = self.get_catalog_metadata().get("version", 0)
+        self._search_index.ensure(version, lambda: self.db.products.find({}, SEARCH_PROJECTION))
+        return self._search_index
+
+    def rank_products(self, query: str) -> Tuple[Any, List[Tuple[int, float]]]:
+        """The search index version and the ranking of ``query`` on it, capped at SEARCH_MAX_CANDIDATES.
+
+        Rankings are cached per version, so later pages of the same search
+        slice the cached list instead of searching again.
+        """
+        index = self.product_search_index()
+        version = index.version
+        ranked = self._ranking_cache.get((version, query))
+        if ranked is None:
+            ranked = index.search(query, limit=SEARCH_MAX_CANDIDATES)
+            self._ranking_cache.set((version, query), ranked)
+        return version, ranked
+
+    def product_suggestion_index(self) -> SuggestionIndex:
+        """The autocomplete index as last refreshed; empty until the first refresh. Never reads MongoDB."""
+        return self._suggest_index
+
+    def refresh_suggestion_index(self) -> None:
+        """Bring the autocomplete index to the catalog version, and re-rank it by views once per period.
+
+        Runs off the request path (see main.suggestion_index_loop); lookups keep
+        answering from the previous snapshot while this builds.
+        """
+        version = self.get_catalog_metadata().get("version", 0)
+        now = time.monotonic()
+        if self._suggest_index.version != version:
+            self._suggest_index.update(
+                self.db.products.find({}, SUGGEST_PROJECTION), self.get_product_view_counts(), version
+            )
+            self._suggest_ranked_at = now
+        elif now - self._suggest_ranked_at >= SUGGEST_POPULARITY_REFRESH_SECONDS:
+            self._suggest_index.rerank(self.get_product_view_counts())
+            self._suggest_ranked_at = now
+
+    def get_product_view_counts(self, days: int = SUGGEST_POPULARITY_WINDOW_DAYS) -> Dict[Any, int]:
+        pipeline = [
+            {"$match": {"activity_type": "product_view", "created_at": {"$gte": utc_now() - timedelta(days=days)}}},
+            {"$group": {"_id": "$product_id", "views": {"$sum": 1}}},
+        ]
+        return {row["_id"]: row["views"] for row in self.db.user_activity.aggregate(pipeline) if row["_id"] is not None}
+
+    def iter_purchase_baskets(self) -> Iterator[List[Any]]:
+        """Product ids bought together, one list per order (including legacy ``order_items`` rows)."""
+        for order in self.db.orders.find({}, {"_id": 0, "items.product_id": 1}):
+            yield [item.get("product_id") for item in order.get("items", [])]
+        pipeline = [{"$group": {"_id": "$order_id", "products": {"$push": "$product_id"}}}]
+        for order in self.db.order_items.aggregate(pipeline):
+            yield order["products"]
+
+    def iter_recent_views(self, days: int = ITEM_SIMILARITY_WINDOW_DAYS) -> Iterator[Dict[str, Any]]:
+        """Product views from the last ``days``, ordered by user and time for sessionizing."""
+        return self.db.user_activity.find(
+            {"activity_type": "product_view", "created_at": {"$gte": utc_now() - timedelta(days=days)}},
+            {"_id": 0, "user_id": 1, "product_id": 1, "created_at": 1},
+        ).sort([("user_id", 1), ("created_at", 1)])
+
+    def iter_activity_since(self, since: datetime, activity_types: List[str]) -> Iterator[Dict[str, Any]]:
+        """Activities of the given types whose ObjectId was generated at or after ``since``, oldest first."""
+        return (
+            self.db.user_activity.find(
+                {"_id": {"$gte": ObjectId.from_datetime(since)}, "activity_type": {"$in": activity_types}},
+                {"activity_type": 1, "product_id": 1, "metadata.product_ids": 1, "created_at": 1},
+            )
+            .sort("_id", 1)
+            .batch_size(1000)
+        )
+
+    def replace_item_similarity(self, documents: Iterable[Dict[str, Any]], batch_size: int = 1000) -> int:
+        """Store a new item similarity build, then drop the neighbour lists the build no longer has."""
+        built_at = utc_now()
+        written = 0
+        batch: List[UpdateOne] = []
+        for document in documents:
+            batch.append(UpdateOne({"_id": document["_id"]}, {"$set": {**document, "built_at": built_at}}, upsert=True))
+            if len(batch) >= batch_size:
+                written += len(batch)
+                self.db.item_similarity.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            written += len(batch)
+            self.db.item_similarity.bulk_write(batch, ordered=False)
+        self.db.item_similarity.delete_many({"built_at": {"$lt": built_at}})
+        self._neighbour_cache.clear()
+        return written
+
+    def get_item_neighbours(self, product_ids: Iterable[Any]) -> Dict[Any, List[Tuple[Any, float]]]:
+        """Precomputed similar products for each id, as (product_id, score) pairs, best first."""
+        neighbours: Dict[Any, List[Tuple[Any, float]]] = {}
+        missing = []
+        for product_id in dict.fromkeys(product_ids):
+            cached = self._neighbour_cache.get(product_id)
+            if cached is None:
+                missing.append(product_id)
+            else:
+                neighbours[product_id] = cached
+        if missing:
+            found = {
+                document["_id"]: list(zip(document.get("neighbours", []), document.get("scores", [])))
+                for document in self.db.item_similarity.find({"_id": {"$in": missing}})
             }
-            mongo_query = {"$and": [mongo_query, text_match]} if mongo_query else text_match
+            for product_id in missing:
+                neighbours[product_id] = found.get(product_id, [])
+                self._neighbour_cache.set(product_id, neighbours[product_id])
+        return neighbours
+
+    def get_active_user_ids(self, days: int, activity_types: Optional[List[str]] = None) -> List[str]:
+        """Users with activity of the given types (any by default) in the last ``days``."""
+        match: Dict[str, Any] = {"created_at": {"$gte": utc_now() - timedelta(days=days)}}
+        if activity_types:
+            match["activity_type"] = {"$in": activity_types}
+        pipeline = [{"$match": match}, {"$group": {"_id": "$user_id"}}]
+        return sorted({str(row["_id"]) for row in self.db.user_activity.aggregate(pipeline) if row["_id"] is not None})
+
+    def get_recommendation_signals(self, user_ids: List[str], days: int) -> Dict[str, Dict[str, Any]]:
+        """Recent view counts, cart, wishlist and purchased product ids for a batch of users.
+
+        Every source is read with one $in query for the whole batch; ids are
+        matched in their string, int and ObjectId forms like the per-user reads.
+        """
+        signals: Dict[str, Dict[str, Any]] = {
+            str(user_id): {"views": {}, "cart": [], "wishlist": [], "purchased": []} for user_id in user_ids
+        }
+        variants = [variant for user_id in signals for variant in self._user_id_variants(user_id)]
+        variants.extend(ObjectId(user_id) for user_id in signals if ObjectId.is_valid(user_id))
+
+        views = self.db.user_activity.find(
+            {
+                "user_id": {"$in": variants},
+                "activity_type": "product_view",
+                "created_at": {"$gte": utc_now() - timedelta(days=days)},
+            },
+            {"_id": 0, "user_id": 1, "product_id": 1},
+        )
+        for view in views:
+            user_signals = signals.get(str(view.get("user_id")))
+            if user_signals is not None and view.get("product_id") is not None:
+                counts = user_signals["views"]
+                counts[view["product_id"]] = counts.get(view["product_id"], 0) + 1
+
+        for cart in self.db.carts.find({"user_id": {"$in": variants}}, {"_id": 0, "user_id": 1, "items.product_id": 1}):
+            user_signals = signals.get(str(cart.get("user_id")))
+            if user_signals is not None:
+                user_signals["cart"].extend(item.get("product_id") for item in cart.get("items", []))
+        for wishlist in self.db.wishlists.find({"user_id": {"$in": variants}}, {"_id": 0, "user_id": 1, "product_ids": 1}):
+            user_signals = signals.get(str(wishlist.get("user_id")))
+            if user_signals is not None:
+                user_signals["wishlist"].extend(wishlist.get("product_ids", []))
+
+        legacy_orders: Dict[Any, str] = {}
+        orders = self.db.orders.find({"user_id": {"$in": variants}}, {"_id": 0, "id": 1, "user_id": 1, "items.product_id": 1})
+        for order in orders:
+            user_id = str(order.get("user_id"))
+            if user_id not in signals:
+                continue
+            signals[user_id]["purchased"].extend(item.get("product_id") for item in order.get("items", []))
+            if order.get("id") is not None:
+                legacy_orders[order["id"]] = user_id
+        if legacy_orders:
+            items = self.db.order_items.find({"order_id": {"$in": list(legacy_orders)}}, {"_id": 0, "order_id": 1, "product_id": 1})
+            for item in items:
+                signals[legacy_orders[item["order_id"]]]["purchased"].append(item.get("product_id"))
+
+        for user_signals in signals.values():
+            for key in ("cart", "wishlist", "purchased"):
+                user_signals[key] = [product_id for product_id in dict.fromkeys(user_signals[key]) if product_id is not None]
+        return signals
+
+    def save_user_recommendations(self, slates: Dict[str, List[Dict[str, Any]]]) -> int:
+        """Replace the stored slates of the given users in one bulk write."""
+        if not slates:
+            return 0
+        built_at = utc_now()
+        self.db.user_recommendations.bulk_write(
+            [
+                UpdateOne({"_id": user_id}, {"$set": {"products": products, "built_at": built_at}}, upsert=True)
+                for user_id, products in slates.items()
+            ],
+            ordered=False,
+        )
+        return len(slates)
 
-        return list(self.db.products.find(mongo_query))
+    def get_user_recommendations(self, user_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """The precomputed slate of a user, or None when none has been built yet."""
+        if not user_id:
+            return None
+        return self.db.user_recommendations.find_one({"_id": str(user_id)})
 
-    def get_catalog_metadata(self) -> Dict[str, Any]:
-        products = self.get_all_products()
-        categories: Dict[str, Dict[str, Any]] = {}
-        occasions: Dict[str, int] = {}
+    def record_search_queries(self, counts: Dict[str, Tuple[Dict[str, Any], int]]) -> None:
+        """Add locally counted searches to the shared ``search_queries`` frequency table."""
+        if not counts:
+            return
+        now = utc_now()
+        self.db.search_queries.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": key},
+                    {"$inc": {"count": count}, "$set": {"params": params, "last_seen": now}},
+                    upsert=True,
+                )
+                for key, (params, count) in counts.items()
+            ],
+            ordered=False,
+        )
 
-        for product in products:
-            category_id = str(product.get("dress_category") or "uncategorized")
-            category_entry = categories.setdefault(
-                category_id,
-                {
-                    "id": category_id,
-                    "name": category_id.replace("-", " ").title(),
-                    "count": 0,
-                    "image_url": product.get("image_url"),
-                },
-            )
-            category_entry["count"] += 1
-            if not category_entry.get("image_url") and product.get("image_url"):
-                category_entry["image_url"] = product.get("image_url")
+    def get_popular_search_queries(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return list(self.db.search_queries.find().sort([("count", -1)]).limit(limit))
 
-            occasion = str(product.get("occasion") or "").strip()
-            if occasion:
-                occasions[occasion] = occasions.get(occasion, 0) + 1
+    def normalize_catalog_keys(self, batch_size: int = 500) -> int:
+        """Backfill ``category_key``/``occasion_key`` on every product and switch filters over to them."""
+        modified = 0
+        updates: List[UpdateOne] = []
+        products = self.db.products.find({}, {"_id": 1, "dress_category": 1, "occasion": 1}).batch_size(batch_size)
+        for product in products:
+            updates.append(UpdateOne({"_id": product["_id"]}, {"$set": self._catalog_keys_for(product)}))
+            if len(updates) >= batch_size:
+                modified += self.db.products.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            modified += self.db.products.bulk_write(updates, ordered=False).modified_count
+
+        self.db.schema_migrations.update_one(
+            {"_id": "catalog_keys"},
+            {"$set": {"completed_at": utc_now(), "products": modified}},
+            upsert=True,
+        )
+        self._catalog_keys = True
+        if modified:
+            self.refresh_catalog_metadata()
+        return modified
 
+    @staticmethod
+    def _catalog_keys_for(product: Dict[str, Any]) -> Dict[str, Optional[str]]:
         return {
-            "categories": sorted(categories.values(), key=lambda item: item["name"]),
-            "occasions": [
-                {"id": occasion.lower().replace(" ", "-"), "name": occasion, "count": count}
-                for occasion, count in sorted(occasions.items(), key=lambda item: item[0].lower())
-            ],
+            "category_key": normalize_key(product.get("dress_category")),
+            "occasion_key": normalize_key(product.get("occasion")),
         }
 
+    def get_catalog_metadata(self) -> Dict[str, Any]:
+        """Return the materialized category and occasion counts.
+
+        The counts live in one ``catalog_meta`` document rebuilt on product
+        writes, and each worker keeps a copy for CACHE_SYNC_INTERVAL_SECONDS,
+        so serving them never touches the products collection. ``version``
+        increases with every rebuild and doubles as the HTTP ETag.
+        """
+        cached = self._catalog_meta_cache.get(CATALOG_META_ID)
+        if cached is None:
+            cached = self.db.catalog_meta.find_one({"_id": CATALOG_META_ID}) or self.refresh_catalog_metadata()
+            self._catalog_meta_cache.set(CATALOG_META_ID, cached)
+        return copy.deepcopy(cached)
+
+    def refresh_catalog_metadata(self) -> Dict[str, Any]:
+        """Recount the catalog in one aggregation pass and store the result as a new version."""
+        pipeline = [
+            {
+                "$facet": {
+                    "categories": [
+                        {
+                            "$group": {
+                                # Missing, null and blank categories all count as uncategorized.
+                                "_id": {
+                                    "$cond": [
+                                        {"$eq": [{"$type": "$dress_category"}, "string"]},
+                                        {"$cond": [{"$eq": [{"$trim": {"input": "$dress_category"}}, ""]}, "uncategorized", "$dress_category"]},
+                                        {"$ifNull": ["$dress_category", "uncategorized"]},
+                                    ]
+                                },
+                                "count": {"$sum": 1},
+                                "image_url": {"$max": "$image_url"},
+                            }
+                        }
+                    ],
+                    "occasions": [
+                        {"$match": {"occasion": {"$type": "string", "$ne": ""}}},
+                        {"$group": {"_id": "$occasion", "count": {"$sum": 1}}},
+                    ],
+                }
+            }
+        ]
+        facets = next(self.db.products.aggregate(pipeline), {"categories": [], "occasions": []})
+
+        categories = [
+            {
+                "id": str(group["_id"]),
+                "name": str(group["_id"]).replace("-", " ").title(),
+                "count": group["count"],
+                "image_url": group.get("image_url"),
+            }
+            for group in facets["categories"]
+        ]
+        occasions: Dict[str, int] = {}
+        for group in facets["occasions"]:
+            occasion = group["_id"].strip()
+            if occasion:
+                occasions[occasion] = occasions.get(occasion, 0) + group["count"]
+
+        meta = self.db.catalog_meta.find_one_and_update(
+            {"_id": CATALOG_META_ID},
+            {
+                "$set": {
+                    "categories": sorted(categories, key=lambda item: item["name"]),
+                    "occasions": [
+                        {"id": occasion.lower().replace(" ", "-"), "name": occasion, "count": count}
+                        for occasion, count in sorted(occasions.items(), key=lambda item: item[0].lower())
+                    ],
+                    "refreshed_at": utc_now(),
+                },
+                "$inc": {"version": 1},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._catalog_meta_cache.set(CATALOG_META_ID, meta)
+        return meta
+
     def update_stock(self, product_id: int, quantity: int) -> bool:
+        """Take ``quantity`` units out of stock, refusing to go below zero."""
         result = self.db.products.update_one(
-            {"id": product_id},
-            {"$inc": {"stock": -quantity}, "$set": {"updated_at": utc_iso()}},
+            {"id": product_id, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}, "$set": {"updated_at": utc_now()}},
         )
         return result.modified_count > 0
 
+    # Stock reservations
+    def reserve_stock(
+        self,
+        product_id: int,
+        quantity: int,
+        user_id: Optional[str] = None,
+        order_number: Optional[str] = None,
+        ttl_seconds: int = STOCK_HOLD_TTL_SECONDS,
+    ) -> Optional[Dict[str, Any]]:
+        """Atomically move ``quantity`` units into a hold; returns None when stock is short.
+
+        The decrement only matches while ``stock >= quantity``, so concurrent
+        reservations can never drive stock negative. A hold that is neither
+        committed nor released before ``expires_at`` is returned to stock by
+        release_expired_stock_holds.
+        """
+        now = utc_now()
+        product = self.db.products.find_one_and_update(
+            {"id": product_id, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}, "$set": {"updated_at": now}},
+            projection={"_id": 1},
+        )
+        if product is None:
+            return None
+
+        hold = {
+            "_id": f"hold_{uuid.uuid4().hex[:16]}",
+            "product_id": product_id,
+            "quantity": quantity,
+            "user_id": user_id,
+            "order_number": order_number,
+            "status": "held",
+            "expires_at": now + timedelta(seconds=ttl_seconds),
+            "created_at": now,
+            "updated_at": now,
+        }
+        try:
+            self.db.stock_holds.insert_one(hold)
+        except PyMongoError:
+            self.db.products.update_one({"id": product_id}, {"$inc": {"stock": quantity}})
+            raise
+        return hold
+
+    def reserve_items(
+        self,
+        items: List[Dict[str, Any]],
+        user_id: Optional[str] = None,
+        order_number: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Reserve every line item or none; raises ValueError naming the first short product."""
+        holds: List[Dict[str, Any]] = []
+        for item in items:
+            hold = self.reserve_stock(int(item["product_id"]), int(item["quantity"]), user_id, order_number)
+            if hold is None:
+                for taken in holds:
+                    self._release_stock_hold(taken["_id"])
+                name = item.get("product_name") or f"product {item['product_id']}"
+                raise ValueError(f"Insufficient stock for {name}")
+            holds.append(hold)
+        return holds
+
+    def _finalize_stock_hold(self, hold_id: str, status: str) -> Optional[Dict[str, Any]]:
+        # Only a live hold can change state, so a hold is committed or released exactly once.
+        now = utc_now()
+        return self.db.stock_holds.find_one_and_update(
+            {"_id": hold_id, "status": "held"},
+            {
+                "$set": {
+                    "status": status,
+                    "updated_at": now,
+                    "purge_at": now + timedelta(seconds=STOCK_HOLD_RETENTION_SECONDS),
+                }
+            },
+        )
+
+    def _release_stock_hold(self, hold_id: str) -> bool:
+        hold = self._finalize_stock_hold(hold_id, "released")
+        if hold is None:
+            return False
+        self.db.products.update_one({"id": hold["product_id"]}, {"$inc": {"stock": hold["quantity"]}})
+        return True
+
+    def commit_stock_holds(self, order_number: str) -> int:
+        """Make the order's holds permanent once payment succeeded."""
+        held = self.db.stock_holds.find({"order_number": order_number, "status": "held"}, {"_id": 1})
+        return sum(1 for hold in held if self._finalize_stock_hold(hold["_id"], "committed"))
+
+    def release_stock_holds(self, order_number: str) -> int:
+        """Return the order's held units to stock, e.g. after a failed payment."""
+        held = self.db.stock_holds.find({"order_number": order_number, "status": "held"}, {"_id": 1})
+        return sum(1 for hold in held if self._release_stock_hold(hold["_id"]))
+
+    def release_expired_stock_holds(self, limit: int = 500) -> int:
+        """Return lapsed holds to stock, except those of orders whose payment has not settled.
+
+        Holds of an order with a payment update or payment transition still
+        pending get another STOCK_HOLD_TTL_SECONDS instead, so a slow payment
+        does not find its stock already sold to someone else.
+        """
+        now = utc_now()
+        expired = list(
+            self.db.stock_holds.find(
+                {"status": "held", "expires_at": {"$lte": now}},
+                {"_id": 1, "order_number": 1},
+            ).limit(limit)
+        )
+        order_numbers = list({hold["order_number"] for hold in expired if hold.get("order_number")})
+        pending = set()
+        if order_numbers:
+            unsettled = {"$elemMatch": {"processed_at": None}}
+            pending.update(
+                payment["order_number"]
+                for payment in self.db.payments.find(
+                    {"order_number": {"$in": order_numbers}, "scheduled_updates": unsettled}, {"order_number": 1}
+                )
+            )
+            pending.update(
+                order["order_number"]
+                for order in self.db.orders.find(
+                    {
+                        "order_number": {"$in": order_numbers},
+                        "scheduled_transitions": {
+                            "$elemMatch": {
+                                "processed_at": None,
+                                "target_status": {"$in": ["payment_confirmed", "payment_failed"]},
+                            }
+                        },
+                    },
+                    {"order_number": 1},
+                )
+            )
+        if pending:
+            self.db.stock_holds.update_many(
+                {"order_number": {"$in": list(pending)}, "status": "held"},
+                {"$set": {"expires_at": now + timedelta(seconds=STOCK_HOLD_TTL_SECONDS), "updated_at": now}},
+            )
+        return sum(
+            1 for hold in expired if hold.get("order_number") not in pending and self._release_stock_hold(hold["_id"])
+        )
+
+    def has_active_stock_holds(self, order_number: str) -> bool:
+        return (
+            self.db.stock_holds.find_one(
+                {"order_number": order_number, "status": {"$in": ["held", "committed"]}},
+                {"_id": 1},
+            )
+            is not None
+        )
+
     # Cart operations
     def get_cart(self, user_id: str) -> Optional[Dict[str, Any]]:
         return self.db.carts.find_one({"user_id": user_id})
@@ -353,8 +1507,9 @@ class Database:
         result = self.db.carts.update_one(
             {"user_id": user_id},
             {
-                "$set": {"items": items, "updated_at": utc_iso()},
-                "$setOnInsert": {"created_at": utc_iso()},
+                "$set": {"items": items, "updated_at": utc_now()},
+                "$inc": {"version": 1},
+                "$setOnInsert": {"created_at": utc_now()},
             },
             upsert=True,
         )
@@ -372,17 +1527,97 @@ class Database:
                 cart_items.append({**item, "product": product})
         return cart_items
 
-    def add_to_cart(self, user_id: str, product_id: int, quantity: int = 1) -> bool:
-        cart = self.get_cart(user_id)
-        if cart:
-            for item in cart.get("items", []):
-                if item.get("product_id") == product_id:
-                    item["quantity"] += quantity
-                    return self.update_cart(user_id, cart["items"])
-            cart["items"].append({"product_id": product_id, "quantity": quantity})
-            return self.update_cart(user_id, cart["items"])
+    def _cart_filter(self, user_id: str, expected_version: Optional[int]) -> Dict[str, Any]:
+        cart_filter: Dict[str, Any] = {"user_id": user_id}
+        if expected_version is not None:
+            # Carts written before versioning have no counter and count as version 0.
+            cart_filter["version"] = {"$in": [0, None]} if expected_version == 0 else expected_version
+        return cart_filter
 
-        return self.update_cart(user_id, [{"product_id": product_id, "quantity": quantity}])
+    def _current_cart_version(self, user_id: str) -> int:
+        cart = self.db.carts.find_one({"user_id": user_id}, {"version": 1})
+        return (cart or {}).get("version") or 0
+
+    def _raise_if_cart_version_changed(self, user_id: str, expected_version: Optional[int]) -> None:
+        if expected_version is None:
+            return
+        current_version = self._current_cart_version(user_id)
+        if current_version != expected_version:
+            raise CartVersionConflictError(current_version)
+
+    def add_to_cart(
+        self,
+        user_id: str,
+        product_id: int,
+        quantity: int = 1,
+        price: Optional[float] = None,
+        size: Optional[str] = None,
+        color: Optional[str] = None,
+        expected_version: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Add ``quantity`` of a (product, size, color) line in one atomic update and return the cart.
+
+        An existing line is incremented in place through an array filter;
+        otherwise the line is pushed, guarded so that two concurrent adds can
+        never create duplicate lines. With ``expected_version`` the update only
+        applies to that cart version and CartVersionConflictError is raised
+        when the cart has moved on.
+        """
+        line_match = {"product_id": product_id, "size": size, "color": color}
+        for _ in range(3):
+            now = utc_now()
+            cart = self.db.carts.find_one_and_update(
+                {**self._cart_filter(user_id, expected_version), "items": {"$elemMatch": line_match}},
+                {"$inc": {"items.$[line].quantity": quantity, "version": 1}, "$set": {"updated_at": now}},
+                array_filters=[{f"line.{key}": value for key, value in line_match.items()}],
+                return_document=ReturnDocument.AFTER,
+            )
+            if cart is not None:
+                return cart
+
+            try:
+                cart = self.db.carts.find_one_and_update(
+                    {**self._cart_filter(user_id, expected_version), "items": {"$not": {"$elemMatch": line_match}}},
+                    {
+                        "$push": {"items": {**line_match, "quantity": quantity, "price": price}},
+                        "$inc": {"version": 1},
+                        "$set": {"updated_at": now},
+                        "$setOnInsert": {"created_at": now},
+                    },
+                    upsert=expected_version in (None, 0),
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # The cart exists but did not match: either the line appeared
+                # concurrently (retry the increment) or the version moved on.
+                cart = None
+            if cart is not None:
+                return cart
+            self._raise_if_cart_version_changed(user_id, expected_version)
+        raise CartVersionConflictError(self._current_cart_version(user_id))
+
+    def remove_from_cart(
+        self,
+        user_id: str,
+        product_id: int,
+        size: Optional[str] = None,
+        color: Optional[str] = None,
+        expected_version: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Pull the product's lines (optionally one size/color) and return the cart, or None if absent."""
+        line_match: Dict[str, Any] = {"product_id": product_id}
+        if size is not None:
+            line_match["size"] = size
+        if color is not None:
+            line_match["color"] = color
+        cart = self.db.carts.find_one_and_update(
+            {**self._cart_filter(user_id, expected_version), "items": {"$elemMatch": line_match}},
+            {"$pull": {"items": line_match}, "$inc": {"version": 1}, "$set": {"updated_at": utc_now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if cart is None:
+            self._raise_if_cart_version_changed(user_id, expected_version)
+        return cart
 
     def clear_user_cart(self, user_id: str) -> bool:
         result = self.db.carts.delete_one({"user_id": user_id})
@@ -409,8 +1644,8 @@ class Database:
             {"user_id": user_id},
             {
                 "$addToSet": {"product_ids": product_id},
-                "$set": {"updated_at": utc_iso()},
-                "$setOnInsert": {"created_at": utc_iso()},
+                "$set": {"updated_at": utc_now()},
+                "$setOnInsert": {"created_at": utc_now()},
             },
             upsert=True,
         )
@@ -421,7 +1656,7 @@ class Database:
             {"user_id": user_id},
             {
                 "$pull": {"product_ids": product_id},
-                "$set": {"updated_at": utc_iso()},
+                "$set": {"updated_at": utc_now()},
             },
         )
         return result.modified_count > 0
@@ -443,7 +1678,7 @@ class Database:
     def update_order_status(self, order_number: str, status: str) -> bool:
         result = self.db.orders.update_one(
             {"order_number": order_number},
-            {"$set": {"order_status": status, "status": status, "updated_at": utc_iso()}},
+            {"$set": {"order_status": status, "status": status, "updated_at": utc_now()}},
         )
         return result.modified_count > 0
 
@@ -456,8 +1691,8 @@ class Database:
             "channel": channel,
             "status": "active",
             "current_agent": "sales_agent",
-            "created_at": utc_iso(),
-            "updated_at": utc_iso(),
+            "created_at": utc_now(),
+            "updated_at": utc_now(),
         }
         self.db.chat_sessions.insert_one(session)
         return session_id
@@ -472,32 +1707,163 @@ class Database:
             return session_id
         return self.create_chat_session(user_id=user_id, channel=channel)
 
-    def add_chat_message(
+    def build_chat_message(
         self,
         session_id: str,
         role: str,
         content: str,
         agent_type: Optional[str] = None,
-    ) -> str:
-        message = {
+    ) -> Dict[str, Any]:
+        return {
+            "_id": ObjectId(),
             "session_id": session_id,
             "message_type": role,
             "agent_type": agent_type,
             "content": content,
             "metadata": {},
-            "created_at": utc_iso(),
+            "created_at": utc_now(),
         }
-        result = self.db.chat_messages.insert_one(message)
-        self.db.chat_sessions.update_one(
-            {"session_id": session_id},
-            {"$set": {"updated_at": utc_iso()}},
+
+    def add_chat_message(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        agent_type: Optional[str] = None,
+    ) -> str:
+        message = self.build_chat_message(session_id, role, content, agent_type)
+        self.insert_chat_messages([message])
+        return str(message["_id"])
+
+    def insert_chat_messages(self, messages: List[Dict[str, Any]], batch_id: Optional[ObjectId] = None) -> None:
+        """Store messages and fold them into their sessions; safe to repeat for the same ``batch_id``."""
+        if not messages:
+            return
+        self.store_chat_messages(messages)
+        self.fold_chat_messages(messages, batch_id or ObjectId())
+
+    def store_chat_messages(self, messages: List[Dict[str, Any]]) -> None:
+        """Insert messages, counting the ones an earlier attempt already stored as written.
+
+        Messages carry their ``_id`` from build_chat_message, so a retry after a
+        lost acknowledgement only hits duplicate keys for what is already stored.
+        """
+        if not messages:
+            return
+        try:
+            self.db.chat_messages.insert_many(messages, ordered=False)
+        except BulkWriteError as error:
+            details = error.details or {}
+            if details.get("writeConcernErrors") or any(
+                write_error.get("code") != 11000 for write_error in details.get("writeErrors", [])
+            ):
+                raise
+
+    def fold_chat_messages(self, messages: List[Dict[str, Any]], batch_id: ObjectId) -> None:
+        """Fold stored messages into their sessions with one bulk update, at most once per ``batch_id``."""
+        by_session: Dict[str, List[Dict[str, Any]]] = {}
+        for message in messages:
+            by_session.setdefault(message["session_id"], []).append(message)
+        if not by_session:
+            return
+        self.db.chat_sessions.bulk_write(
+            [
+                UpdateOne(
+                    {"session_id": session_id, "folded_batches": {"$ne": batch_id}},
+                    self._session_summary_update(session_messages, batch_id),
+                )
+                for session_id, session_messages in by_session.items()
+            ],
+            ordered=False,
         )
-        return str(result.inserted_id)
+
+    def _session_summary_update(self, messages: List[Dict[str, Any]], batch_id: ObjectId) -> List[Dict[str, Any]]:
+        """Pipeline update that folds newly stored messages into the session's listing fields.
+
+        Values are wrapped in $literal so message text starting with "$" is not
+        read as a field path. The last CHAT_FOLDED_BATCHES_KEPT batch ids are
+        kept on the session so a retried fold is not counted twice.
+        """
+        last_message = messages[-1]
+        summary: Dict[str, Any] = {
+            "message_count": {"$add": [{"$ifNull": ["$message_count", 0]}, len(messages)]},
+            "last_message_preview": {"$literal": str(last_message.get("content") or "")[:120]},
+            "last_message_at": {"$literal": last_message.get("created_at")},
+            "updated_at": {"$literal": utc_now()},
+            "folded_batches": {
+                "$slice": [
+                    {"$concatArrays": [{"$ifNull": ["$folded_batches", []]}, [batch_id]]},
+                    -CHAT_FOLDED_BATCHES_KEPT,
+                ]
+            },
+        }
+        first_user_message = next(
+            (
+                message
+                for message in messages
+                if message.get("message_type") == "user" and message.get("content")
+            ),
+            None,
+        )
+        if first_user_message:
+            summary["title"] = {"$ifNull": ["$title", {"$literal": str(first_user_message["content"])[:80]}]}
+        return [{"$set": summary}]
 
     def get_chat_history(self, session_id: str, limit: int = 10) -> List[Dict[str, Any]]:
-        return list(
-            self.db.chat_messages.find({"session_id": session_id}).sort("created_at", 1).limit(limit)
+        """Return the latest ``limit`` messages of a session, oldest first."""
+        messages, _ = self.get_chat_history_page(session_id, limit=limit)
+        return messages
+
+    def get_chat_history_page(
+        self,
+        session_id: str,
+        limit: int = 50,
+        before: Optional[str] = None,
+    ) -> tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return one page of a session's tail, oldest first, and a cursor for the page before it.
+
+        Pages walk backwards from the newest message along the
+        (session_id, created_at, _id) index, so the cost of a page does not
+        depend on how long the session is.
+        """
+        messages, next_cursor = find_page(
+            self.db.chat_messages,
+            {"session_id": session_id},
+            [("created_at", -1), ("_id", -1)],
+            limit,
+            cursor=before,
+        )
+        messages.reverse()
+        return messages, next_cursor
+
+    def get_chat_session_summary(self, session_id: str) -> Dict[str, Any]:
+        session = self.db.chat_sessions.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "conversation_summary": 1, "summarized_until": 1},
         )
+        return session or {}
+
+    def get_chat_messages_after(self, session_id: str, after: Optional[str], limit: int = 50) -> List[Dict[str, Any]]:
+        """Up to ``limit`` messages of a session after the message with id ``after`` (from the start without one), oldest first."""
+        marker = None
+        if after and ObjectId.is_valid(after):
+            marker = self.db.chat_messages.find_one({"_id": ObjectId(after)}, {"created_at": 1})
+        cursor = encode_cursor([marker.get("created_at"), marker["_id"]]) if marker else None
+        messages, _ = find_page(
+            self.db.chat_messages,
+            {"session_id": session_id},
+            [("created_at", 1), ("_id", 1)],
+            limit,
+            cursor=cursor,
+        )
+        return messages
+
+    def update_chat_session_summary(self, session_id: str, summary: str, summarized_until: str) -> bool:
+        result = self.db.chat_sessions.update_one(
+            {"session_id": session_id},
+            {"$set": {"conversation_summary": summary, "summarized_until": summarized_until}},
+        )
+        return result.modified_count > 0
 
     def get_user_recent_messages(
         self,
@@ -519,47 +1885,132 @@ class Database:
         )
         return list(reversed(messages))
 
-    def get_user_chat_sessions(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
-        sessions = list(
-            self.db.chat_sessions.find({"user_id": user_id}).sort("updated_at", -1).limit(limit)
-        )
-
-        session_summaries: List[Dict[str, Any]] = []
-        for session in sessions:
-            session_id = session.get("session_id")
-            if not session_id:
-                continue
+    def get_users_recent_messages(
+        self,
+        user_ids: List[str],
+        limit: int = 12,
+        days: Optional[int] = None,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """get_user_recent_messages for many users at once: one sessions query and one aggregation.
+
+        Each message keeps ``session_id``, ``message_type``, ``content`` and
+        ``created_at`` of the stored document. ``days`` bounds how far back
+        messages are read.
+        """
+        recent: Dict[str, List[Dict[str, Any]]] = {user_id: [] for user_id in user_ids}
+        sessions = self.db.chat_sessions.find({"user_id": {"$in": list(user_ids)}}, {"_id": 0, "session_id": 1, "user_id": 1})
+        owners = {session["session_id"]: session["user_id"] for session in sessions if session.get("session_id")}
+        if not owners:
+            return recent
+
+        match: Dict[str, Any] = {"session_id": {"$in": list(owners)}}
+        if days is not None:
+            match["created_at"] = {"$gte": utc_now() - timedelta(days=days)}
+        pipeline = [
+            {"$match": match},
+            # The session_created_at_id index walked backwards: newest messages of each session first.
+            {"$sort": {"session_id": -1, "created_at": -1, "_id": -1}},
+            {
+                "$group": {
+                    "_id": "$session_id",
+                    "messages": {
+                        "$push": {"message_type": "$message_type", "content": "$content", "created_at": "$created_at"}
+                    },
+                }
+            },
+            {"$project": {"messages": {"$slice": ["$messages", limit]}}},
+        ]
+        for row in self.db.chat_messages.aggregate(pipeline, allowDiskUse=True):
+            recent[owners[row["_id"]]].extend({**message, "session_id": row["_id"]} for message in row["messages"])
+        for user_id, messages in recent.items():
+            messages.sort(key=lambda message: message.get("created_at") or datetime.min, reverse=True)
+            recent[user_id] = list(reversed(messages[:limit]))
+        return recent
 
-            messages = list(
-                self.db.chat_messages.find({"session_id": session_id}).sort("created_at", 1)
-            )
-            if not messages:
-                continue
+    def get_user_chat_sessions(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        sessions = self.db.chat_sessions.find(
+            {"user_id": user_id, "message_count": {"$gt": 0}},
+            {
+                "_id": 0,
+                "session_id": 1,
+                "channel": 1,
+                "status": 1,
+                "created_at": 1,
+                "updated_at": 1,
+                "message_count": 1,
+                "title": 1,
+                "last_message_preview": 1,
+            },
+        ).sort("updated_at", -1).limit(limit)
 
-            first_user_message = next(
-                (
-                    message
-                    for message in messages
-                    if message.get("message_type") == "user" and message.get("content")
-                ),
-                messages[0],
+        return [
+            {
+                "session_id": session["session_id"],
+                "channel": session.get("channel", "web"),
+                "status": session.get("status", "active"),
+                "created_at": session.get("created_at"),
+                "updated_at": session.get("updated_at"),
+                "message_count": session["message_count"],
+                "title": session.get("title") or "New chat",
+                "last_message_preview": session.get("last_message_preview", ""),
+            }
+            for session in sessions
+            if session.get("session_id")
+        ]
+
+    def backfill_chat_session_summaries(self, batch_size: int = 500) -> int:
+        """Recompute message_count, title and last_message_preview for every session from its messages."""
+        ordered = [{"$sort": {"session_id": 1, "created_at": 1, "_id": 1}}]
+        titles = {
+            row["_id"]: row["title"]
+            for row in self.db.chat_messages.aggregate(
+                [
+                    {"$match": {"message_type": "user", "content": {"$nin": [None, ""]}}},
+                    *ordered,
+                    {"$group": {"_id": "$session_id", "title": {"$first": "$content"}}},
+                ],
+                allowDiskUse=True,
             )
-            last_message = messages[-1]
-
-            session_summaries.append(
+        }
+        totals = self.db.chat_messages.aggregate(
+            [
+                *ordered,
                 {
-                    "session_id": session_id,
-                    "channel": session.get("channel", "web"),
-                    "status": session.get("status", "active"),
-                    "created_at": session.get("created_at"),
-                    "updated_at": session.get("updated_at"),
-                    "message_count": len(messages),
-                    "title": str(first_user_message.get("content") or "New chat")[:80],
-                    "last_message_preview": str(last_message.get("content") or "")[:120],
-                }
-            )
+                    "$group": {
+                        "_id": "$session_id",
+                        "message_count": {"$sum": 1},
+                        "first_content": {"$first": "$content"},
+                        "last_content": {"$last": "$content"},
+                        "last_message_at": {"$last": "$created_at"},
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
 
-        return session_summaries
+        updated = 0
+        batch: List[UpdateOne] = []
+        for row in totals:
+            title = titles.get(row["_id"]) or row.get("first_content") or "New chat"
+            batch.append(
+                UpdateOne(
+                    {"session_id": row["_id"]},
+                    {
+                        "$set": {
+                            "message_count": row["message_count"],
+                            "title": str(title)[:80],
+                            "last_message_preview": str(row.get("last_content") or "")[:120],
+                            "last_message_at": row.get("last_message_at"),
+                        }
+                    },
+                )
+            )
+            if len(batch) >= batch_size:
+                updated += self.db.chat_sessions.bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if batch:
+            updated += self.db.chat_sessions.bulk_write(batch, ordered=False).modified_count
+        return updated
 
     # Agent task operations
     def create_agent_task(self, task_data: Dict[str, Any]) -> str:
@@ -0,0 +1,372 @@
+"""
+Versioned index manifest for the MongoDB collections.
+
+Every index below is derived from a query shape the code issues; the comment
+on each entry names the caller. The manifest is applied on connect only when
+its hash differs from the one recorded in ``schema_migrations``, so a normal
+startup costs a single ``find_one``. Bump INDEX_MANIFEST_VERSION whenever the
+manifest changes, and extend CANNED_QUERIES so ``maintenance.py
+check-indexes`` keeps covering the new shapes.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterator, List
+
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+INDEX_MANIFEST_VERSION = 11
+MANIFEST_MIGRATION_ID = "index_manifest"
+SEARCH_QUERY_RETENTION_SECONDS = 30 * 24 * 3600
+
+INDEX_MANIFEST: Dict[str, List[Dict[str, Any]]] = {
+    "users": [
+        # get_user_by_email, register_user
+        {"name": "email_unique", "keys": [("email", ASCENDING)], "unique": True},
+        # _user_lookup_filter after the canonical id migration
+        {"name": "user_id", "keys": [("user_id", ASCENDING)]},
+        # $or lookups over legacy numeric ids; only pre-migration users carry the field
+        {"name": "legacy_id", "keys": [("id", ASCENDING)], "partialFilterExpression": {"id": {"$exists": True}}},
+        {
+            "name": "legacy_ids",
+            "keys": [("legacy_ids", ASCENDING)],
+            "partialFilterExpression": {"legacy_ids": {"$exists": True}},
+        },
+    ],
+    "products": [
+        # get_product, update_stock
+        {"name": "id", "keys": [("id", ASCENDING)]},
+        # get_products_by_category
+        {"name": "dress_category_price", "keys": [("dress_category", ASCENDING), ("price", ASCENDING)]},
+        {"name": "product_name", "keys": [("product_name", ASCENDING)]},
+        # search_products category/occasion filters once catalog keys are normalized
+        {"name": "category_key_price", "keys": [("category_key", ASCENDING), ("price", ASCENDING)]},
+        {"name": "occasion_key_price", "keys": [("occasion_key", ASCENDING), ("price", ASCENDING)]},
+    ],
+    "carts": [
+        # get_cart and the atomic cart updates; unique so concurrent upserts cannot create two carts
+        {"name": "user_id_unique", "keys": [("user_id", ASCENDING)], "unique": True},
+    ],
+    "wishlists": [
+        {"name": "user_id", "keys": [("user_id", ASCENDING)]},
+    ],
+    "orders": [
+        # get_order, every status update
+        {"name": "order_number_unique", "keys": [("order_number", ASCENDING)], "unique": True},
+        # list_user_orders, get_user_orders, latest-order lookups and product-interest checks
+        {"name": "user_id_created_at", "keys": [("user_id", ASCENDING), ("created_at", DESCENDING)]},
+        # list_admin_orders keyset pages
+        {"name": "created_at_id", "keys": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+        # _process_due_order_transitions
+        {
+            "name": "scheduled_transitions_due",
+            "keys": [("scheduled_transitions.processed_at", ASCENDING), ("scheduled_transitions.due_at", ASCENDING)],
+        },
+    ],
+    "payments": [
+        {"name": "payment_id_unique", "keys": [("payment_id", ASCENDING)], "unique": True},
+        # get_order / list_user_orders payment history
+        {"name": "order_number_created_at", "keys": [("order_number", ASCENDING), ("created_at", ASCENDING)]},
+        # _process_due_payment_updates
+        {
+            "name": "scheduled_updates_due",
+            "keys": [("scheduled_updates.processed_at", ASCENDING), ("scheduled_updates.due_at", ASCENDING)],
+        },
+    ],
+    "commerce_events": [
+        {"name": "event_id", "keys": [("event_id", ASCENDING)]},
+        {"name": "user_id_created_at", "keys": [("user_id", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "notifications": [
+        # _create_notification de-duplication
+        {"name": "dedupe_key", "keys": [("dedupe_key", ASCENDING)]},
+        # get_user_communications keyset pages
+        {
+            "name": "user_id_created_at_id",
+            "keys": [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+        },
+        # list_admin_orders
+        {"name": "order_number_created_at", "keys": [("order_number", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "call_workflows": [
+        {"name": "dedupe_key", "keys": [("dedupe_key", ASCENDING)]},
+        # get_user_communications keyset pages
+        {
+            "name": "user_id_created_at_id",
+            "keys": [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+        },
+        {"name": "order_number_created_at", "keys": [("order_number", ASCENDING), ("created_at", DESCENDING)]},
+        # _activate_due_call_workflows only ever looks at scheduled calls
+        {
+            "name": "scheduled_for_pending",
+            "keys": [("status", ASCENDING), ("scheduled_for", ASCENDING)],
+            "partialFilterExpression": {"status": "scheduled"},
+        },
+    ],
+    "user_activity": [
+        # _product_interest_trigger
+        {
+            "name": "user_type_product_created_at",
+            "keys": [
+                ("user_id", ASCENDING),
+                ("activity_type", ASCENDING),
+                ("product_id", ASCENDING),
+                ("created_at", DESCENDING),
+            ],
+        },
+        # last cart activity and checkout-after-cart lookups in _process_cart_abandonment_calls;
+        # also the batched recent views of get_recommendation_signals
+        {
+            "name": "user_type_created_at",
+            "keys": [("user_id", ASCENDING), ("activity_type", ASCENDING), ("created_at", DESCENDING)],
+        },
+        # get_user_activity_summary
+        {"name": "user_id_created_at", "keys": [("user_id", ASCENDING), ("created_at", DESCENDING)]},
+        # get_product_view_counts for suggestion popularity
+        {"name": "type_created_at", "keys": [("activity_type", ASCENDING), ("created_at", DESCENDING)]},
+        # iter_view_sessions walks recent views user by user for the item similarity build
+        {
+            "name": "type_user_created_at",
+            "keys": [("activity_type", ASCENDING), ("user_id", ASCENDING), ("created_at", ASCENDING)],
+        },
+    ],
+    "order_items": [
+        {"name": "order_id", "keys": [("order_id", ASCENDING)]},
+    ],
+    "chat_sessions": [
+        {"name": "session_id", "keys": [("session_id", ASCENDING)]},
+        # get_user_chat_sessions, get_user_recent_messages
+        {"name": "user_id_updated_at", "keys": [("user_id", ASCENDING), ("updated_at", DESCENDING)]},
+    ],
+    "chat_messages": [
+        # get_chat_history tail and keyset paging
+        {
+            "name": "session_created_at_id",
+            "keys": [("session_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)],
+        },
+    ],
+    "agent_tasks": [
+        {"name": "task_id", "keys": [("task_id", ASCENDING)]},
+        {"name": "status", "keys": [("status", ASCENDING)]},
+    ],
+    "stock_holds": [
+        # commit_stock_holds, release_stock_holds, has_active_stock_holds
+        {"name": "order_number_status", "keys": [("order_number", ASCENDING), ("status", ASCENDING)]},
+        # release_expired_stock_holds only scans live holds
+        {
+            "name": "held_expires_at",
+            "keys": [("status", ASCENDING), ("expires_at", ASCENDING)],
+            "partialFilterExpression": {"status": "held"},
+        },
+        # committed and released holds are purged once their retention ends
+        {"name": "purge_at_ttl", "keys": [("purge_at", ASCENDING)], "expireAfterSeconds": 0},
+    ],
+    "search_queries": [
+        # get_popular_search_queries
+        {"name": "count", "keys": [("count", DESCENDING)]},
+        # searches nobody repeated for SEARCH_QUERY_RETENTION_SECONDS drop out of the table
+        {"name": "last_seen_ttl", "keys": [("last_seen", ASCENDING)], "expireAfterSeconds": SEARCH_QUERY_RETENTION_SECONDS},
+    ],
+    "schema_migrations": [],
+    "cache_versions": [],
+    # a single materialized document read by _id
+    "catalog_meta": [],
+    # top-k neighbours per product, read by _id; replace_item_similarity drops older builds
+    "item_similarity": [{"name": "built_at", "keys": [("built_at", ASCENDING)]}],
+    # one precomputed slate per user, read and replaced by _id
+    "user_recommendations": [],
+    "revoked_tokens": [
+        {"name": "expires_at_ttl", "keys": [("expires_at", ASCENDING)], "expireAfterSeconds": 0},
+    ],
+}
+
+# Representative reads for every indexed shape; check_indexes() explains each one.
+CANNED_QUERIES: List[Dict[str, Any]] = [
+    {"collection": "users", "filter": {"email": "canned@example.com"}},
+    {"collection": "users", "filter": {"user_id": "canned_user"}},
+    {"collection": "users", "filter": {"$or": [{"user_id": "1"}, {"id": 1}, {"user_id": 1}]}},
+    {"collection": "products", "filter": {"id": 1}},
+    {"collection": "products", "filter": {"dress_category": "women-dresses"}},
+    {"collection": "products", "filter": {"category_key": "women-dresses", "price": {"$lte": 300}}},
+    {"collection": "products", "filter": {"category_key": {"$regex": "^women-"}}},
+    {"collection": "products", "filter": {"occasion_key": "wedding"}},
+    {"collection": "products", "filter": {"id": {"$in": [1, 2, 3]}}},
+    {"collection": "carts", "filter": {"user_id": "canned_user"}},
+    {"collection": "search_queries", "filter": {}, "sort": [("count", DESCENDING)], "limit": 50},
+    {"collection": "wishlists", "filter": {"user_id": "canned_user"}},
+    {"collection": "orders", "filter": {"order_number": "ORD-CANNED"}},
+    {"collection": "orders", "filter": {"user_id": "canned_user"}, "sort": [("created_at", DESCENDING)]},
+    {"collection": "orders", "filter": {}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)], "limit": 100},
+    {
+        "collection": "orders",
+        "filter": {
+            "scheduled_transitions": {"$elemMatch": {"processed_at": None, "due_at": {"$lte": datetime(2030, 1, 1)}}}
+        },
+    },
+    {"collection": "payments", "filter": {"payment_id": "pay_canned"}},
+    {"collection": "payments", "filter": {"order_number": "ORD-CANNED"}, "sort": [("created_at", ASCENDING)]},
+    {
+        "collection": "payments",
+        "filter": {
+            "scheduled_updates": {"$elemMatch": {"processed_at": None, "due_at": {"$lte": datetime(2030, 1, 1)}}}
+        },
+    },
+    {"collection": "notifications", "filter": {"dedupe_key": "canned"}},
+    {
+        "collection": "notifications",
+        "filter": {"user_id": "canned_user"},
+        "sort": [("created_at", DESCENDING), ("_id", DESCENDING)],
+        "limit": 50,
+    },
+    {"collection": "call_workflows", "filter": {"status": "scheduled", "scheduled_for": {"$lte": datetime(2030, 1, 1)}}},
+    {
+        "collection": "call_workflows",
+        "filter": {"user_id": "canned_user"},
+        "sort": [("created_at", DESCENDING), ("_id", DESCENDING)],
+        "limit": 50,
+    },
+    {
+        "collection": "user_activity",
+        "filter": {
+            "user_id": "canned_user",
+            "activity_type": "product_view",
+            "product_id": 1,
+            "created_at": {"$gte": datetime(2024, 1, 1)},
+        },
+    },
+    {
+        "collection": "user_activity",
+        "filter": {"user_id": "canned_user", "activity_type": {"$in": ["cart_add", "cart_update", "cart_remove"]}},
+        "sort": [("created_at", DESCENDING)],
+    },
+    {"collection": "user_activity", "filter": {"user_id": "canned_user"}, "sort": [("created_at", DESCENDING)]},
+    {
+        "collection": "user_activity",
+        "filter": {"activity_type": "product_view", "created_at": {"$gte": datetime(2024, 1, 1)}},
+    },
+    {
+        "collection": "user_activity",
+        "filter": {"activity_type": "product_view", "created_at": {"$gte": datetime(2024, 1, 1)}},
+        "sort": [("user_id", ASCENDING), ("created_at", ASCENDING)],
+    },
+    {
+        "collection": "user_activity",
+        "filter": {
+            "user_id": {"$in": ["canned_user", "canned_user_2"]},
+            "activity_type": "product_view",
+            "created_at": {"$gte": datetime(2024, 1, 1)},
+        },
+    },
+    {"collection": "item_similarity", "filter": {"built_at": {"$lt": datetime(2024, 1, 1)}}},
+    {"collection": "user_recommendations", "filter": {"_id": "canned_user"}},
+    {"collection": "stock_holds", "filter": {"order_number": "ORD-CANNED", "status": "held"}},
+    {"collection": "stock_holds", "filter": {"status": "held", "expires_at": {"$lte": datetime(2030, 1, 1)}}},
+    {"collection": "chat_sessions", "filter": {"session_id": "sess_canned"}},
+    {
+        "collection": "chat_sessions",
+        "filter": {"user_id": "canned_user", "message_count": {"$gt": 0}},
+        "sort": [("updated_at", DESCENDING)],
+    },
+    {
+        "collection": "chat_messages",
+        "filter": {"session_id": "sess_canned"},
+        "sort": [("created_at", DESCENDING), ("_id", DESCENDING)],
+        "limit": 15,
+    },
+]
+
+
+def manifest_hash(manifest: Dict[str, List[Dict[str, Any]]] = INDEX_MANIFEST) -> str:
+    payload = json_util.dumps({"version": INDEX_MANIFEST_VERSION, "manifest": manifest}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _index_model(spec: Dict[str, Any]) -> IndexModel:
+    options = {key: value for key, value in spec.items() if key != "keys"}
+    return IndexModel(spec["keys"], **options)
+
+
+def apply_index_manifest(database, force: bool = False) -> bool:
+    """Bring the indexes of ``database`` in line with INDEX_MANIFEST.
+
+    Returns False without touching any collection when the recorded hash
+    matches. Otherwise missing collections are created, indexes that are no
+    longer in the manifest are dropped and the manifest indexes are built.
+    The hash is only recorded when every collection succeeded, so a failed
+    build is retried on the next connect.
+    """
+    current_hash = manifest_hash()
+    state = database.schema_migrations.find_one({"_id": MANIFEST_MIGRATION_ID}) or {}
+    if not force and state.get("hash") == current_hash:
+        return False
+
+    existing_collections = set(database.list_collection_names())
+    failures = 0
+    for collection_name, specs in INDEX_MANIFEST.items():
+        if collection_name not in existing_collections:
+            database.create_collection(collection_name)
+            logger.info("Created collection: %s", collection_name)
+
+        collection = database[collection_name]
+        wanted = {spec["name"] for spec in specs}
+        try:
+            for index_name in collection.index_information():
+                if index_name != "_id_" and index_name not in wanted:
+                    collection.drop_index(index_name)
+                    logger.info("Dropped index %s.%s", collection_name, index_name)
+            if specs:
+                collection.create_indexes([_index_model(spec) for spec in specs])
+        except PyMongoError as error:
+            failures += 1
+            logger.error("Could not apply index manifest to %s: %s", collection_name, error)
+
+    if failures:
+        return False
+
+    database.schema_migrations.update_one(
+        {"_id": MANIFEST_MIGRATION_ID},
+        {"$set": {"version": INDEX_MANIFEST_VERSION, "hash": current_hash, "applied_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    logger.info("Applied index manifest v%s (%s)", INDEX_MANIFEST_VERSION, current_hash[:12])
+    return True
+
+
+def _plan_stages(plan: Any) -> Iterator[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+def check_indexes(database) -> List[Dict[str, Any]]:
+    """Explain every canned query and report the stages of its winning plan."""
+    results = []
+    for query in CANNED_QUERIES:
+        cursor = database[query["collection"]].find(query["filter"])
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        if query.get("limit"):
+            cursor = cursor.limit(query["limit"])
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = list(_plan_stages(winning_plan))
+        results.append(
+            {
+                "collection": query["collection"],
+                "filter": query["filter"],
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+            }
+        )
+    return results
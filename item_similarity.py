@@ -0,0 +1,186 @@
+"""
+Item-item collaborative filtering from purchases and browsing sessions.
+
+Each order and each product-view session is a basket. Baskets form a sparse
+basket x item incidence matrix in CSR form; the item x item co-occurrence
+matrix is its weighted Gram matrix, computed by expanding the pairs inside
+each basket in bounded chunks and summing duplicates. Similarity is cosine
+over the weighted baskets, and only the TOP_K neighbours of every product are
+kept, again as CSR arrays (indptr, neighbours, scores).
+
+The matrix is built offline by ``maintenance.py build-item-similarity`` and
+stored one document per product in ``item_similarity``, so a request only
+reads the neighbour lists of its seed products.
+"""
+
+from __future__ import annotations
+
+import os
+from datetime import timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+ITEM_SIMILARITY_TOP_K = int(os.getenv("ITEM_SIMILARITY_TOP_K", "20"))
+ORDER_WEIGHT = 1.0
+VIEW_SESSION_WEIGHT = 0.3
+VIEW_SESSION_GAP = timedelta(minutes=30)
+# Baskets are truncated so one long browsing session cannot add thousands of pairs.
+MAX_BASKET_ITEMS = 50
+PAIR_CHUNK = 5_000_000
+
+
+def _product_id(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def view_sessions(views: Iterable[Dict[str, Any]], gap: timedelta = VIEW_SESSION_GAP) -> Iterator[List[int]]:
+    """Split product views, sorted by user and time, into per-user sessions."""
+    session: List[int] = []
+    last_user: Any = None
+    last_at: Any = None
+    for view in views:
+        product_id = _product_id(view.get("product_id"))
+        if product_id is None:
+            continue
+        created_at = view.get("created_at")
+        if view.get("user_id") != last_user or last_at is None or created_at is None or created_at - last_at > gap:
+            if session:
+                yield session
+            session = []
+        session.append(product_id)
+        last_user, last_at = view.get("user_id"), created_at
+    if session:
+        yield session
+
+
+class ItemSimilarity:
+    """Top-k neighbours of every product as CSR arrays, with row ``i`` belonging to ``product_ids[i]``."""
+
+    def __init__(self, product_ids: np.ndarray, indptr: np.ndarray, neighbours: np.ndarray, scores: np.ndarray) -> None:
+        self.product_ids = product_ids
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self.scores = scores
+        self._rows = {int(product_id): row for row, product_id in enumerate(product_ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def neighbours_of(self, product_id: Any) -> List[Tuple[int, float]]:
+        row = self._rows.get(_product_id(product_id))
+        if row is None:
+            return []
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return list(zip(self.product_ids[self.neighbours[start:end]].tolist(), self.scores[start:end].tolist()))
+
+    def documents(self) -> Iterator[Dict[str, Any]]:
+        """One ``item_similarity`` document per product that has neighbours."""
+        for row, product_id in enumerate(self.product_ids.tolist()):
+            start, end = int(self.indptr[row]), int(self.indptr[row + 1])
+            if start == end:
+                continue
+            yield {
+                "_id": product_id,
+                "neighbours": self.product_ids[self.neighbours[start:end]].tolist(),
+                "scores": [round(score, 6) for score in self.scores[start:end].tolist()],
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "products": len(self),
+            "with_neighbours": int(np.count_nonzero(np.diff(self.indptr))),
+            "pairs": len(self.neighbours),
+            "bytes": int(self.indptr.nbytes + self.neighbours.nbytes + self.scores.nbytes + self.product_ids.nbytes),
+        }
+
+
+def _baskets_to_csr(baskets: Iterable[Tuple[Sequence[Any], float]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Incidence matrix of de-duplicated baskets: (product_ids, indptr, item columns, basket weights)."""
+    items: List[int] = []
+    lengths: List[int] = []
+    weights: List[float] = []
+    for basket, weight in baskets:
+        unique = list(dict.fromkeys(pid for pid in map(_product_id, basket) if pid is not None))[:MAX_BASKET_ITEMS]
+        if len(unique) < 2:
+            continue
+        items.extend(unique)
+        lengths.append(len(unique))
+        weights.append(weight)
+    product_ids, columns = np.unique(np.array(items, dtype=np.int64), return_inverse=True)
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return product_ids, indptr, columns.astype(np.int64), np.array(weights, dtype=np.float64)
+
+
+def _cooccurrence(
+    indptr: np.ndarray, columns: np.ndarray, weights: np.ndarray, size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Weighted off-diagonal entries of B^T W B as (rows, cols, values), B being the CSR incidence matrix."""
+    lengths = np.diff(indptr)
+    pair_counts = lengths * lengths
+    pairs_before = np.concatenate(([0], np.cumsum(pair_counts)))
+    codes: List[np.ndarray] = []
+    sums: List[np.ndarray] = []
+    first = 0
+    while first < len(lengths):
+        # Grow the chunk of baskets until it would expand to more than PAIR_CHUNK pairs.
+        last = int(np.searchsorted(pairs_before, pairs_before[first] + PAIR_CHUNK, side="right")) - 1
+        last = min(max(last, first + 1), len(lengths))
+        chunk_lengths = lengths[first:last]
+        entries = np.arange(indptr[first], indptr[last])
+        entry_lengths = np.repeat(chunk_lengths, chunk_lengths)
+        entry_starts = np.repeat(indptr[first:last], chunk_lengths)
+        # Every entry pairs with each entry of its basket, itself included.
+        left = np.repeat(columns[entries], entry_lengths)
+        offsets = np.arange(int(entry_lengths.sum())) - np.repeat(np.cumsum(entry_lengths) - entry_lengths, entry_lengths)
+        right = columns[np.repeat(entry_starts, entry_lengths) + offsets]
+        pair_weights = np.repeat(np.repeat(weights[first:last], chunk_lengths), entry_lengths)
+        off_diagonal = left != right
+        chunk_codes, inverse = np.unique(left[off_diagonal] * size + right[off_diagonal], return_inverse=True)
+        codes.append(chunk_codes)
+        sums.append(np.bincount(inverse, weights=pair_weights[off_diagonal]))
+        first = last
+    if not codes:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.float64)
+    all_codes, inverse = np.unique(np.concatenate(codes), return_inverse=True)
+    values = np.bincount(inverse, weights=np.concatenate(sums))
+    return all_codes // size, all_codes % size, values
+
+
+def build_item_similarity(
+    baskets: Iterable[Tuple[Sequence[Any], float]], top_k: int = ITEM_SIMILARITY_TOP_K
+) -> ItemSimilarity:
+    """Cosine item-item similarity over weighted ``(product_ids, weight)`` baskets, truncated to ``top_k``."""
+    product_ids, indptr, columns, weights = _baskets_to_csr(baskets)
+    size = len(product_ids)
+    rows, cols, values = _cooccurrence(indptr, columns, weights, size)
+
+    # Weighted number of baskets containing each product: the diagonal of B^T W B.
+    frequency = np.bincount(columns, weights=np.repeat(weights, np.diff(indptr)), minlength=size)
+    scores = values / np.sqrt(frequency[rows] * frequency[cols])
+
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    row_starts = np.searchsorted(rows, np.arange(size))
+    keep = np.arange(len(rows)) - row_starts[rows] < top_k
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+    top_indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=top_indptr[1:])
+    return ItemSimilarity(product_ids, top_indptr, cols.astype(np.int32), scores.astype(np.float32))
+
+
+def blend_scores(neighbour_lists: Dict[Any, List[Tuple[int, float]]], exclude: Iterable[Any] = ()) -> Dict[int, float]:
+    """Sum the similarity of every neighbour across the seed products, leaving out the seeds."""
+    excluded = {_product_id(product_id) for product_id in exclude}
+    scores: Dict[int, float] = {}
+    for neighbours in neighbour_lists.values():
+        for product_id, score in neighbours:
+            if product_id not in excluded:
+                scores[product_id] = scores.get(product_id, 0.0) + score
+    return scores
@@ -113,7 +113,7 @@ def add_sample_products():
     
     try:
         # Clear existing products for fresh start
-        db.db.products.delete_many({})
+        db.delete_products({})
         print("🗑️  Cleared existing products")
         
         # Insert new products
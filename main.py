@@ -8,20 +8,35 @@ import logging
 from bson import ObjectId
 from datetime import datetime
 from dotenv import load_dotenv
-from fastapi import Body, FastAPI, HTTPException, Query, Response
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 import uvicorn
 
-from commerce_service import commerce_service
-from database import db
+from auth_tokens import TokenError, token_service
+from catalog_snapshot import process_memory
+from chat_writer import chat_writer
+from commerce_service import ORDER_LIST_PROJECTION, commerce_service
+from database import (
+    PRODUCT_LIST_PROJECTION,
+    SUGGEST_SYNC_INTERVAL_SECONDS,
+    CartVersionConflictError,
+    db,
+    projection_for,
+)
 from orchestrator import Orchestrator
+from recommendation_slates import recommendation_slates
+from search_cache import popular_queries
+from security import password_hasher
+from trending import TRENDING_TOP_N, trending
 from schemas import (
     ActivityRequest,
     CheckoutRequest,
     LoginResponse,
+    LogoutRequest,
     OrderAdvanceRequest,
     PaymentRetryRequest,
+    RefreshRequest,
     SalesRequest,
     SalesResponse,
     UserLogin,
@@ -68,11 +83,29 @@ def user_to_response(user: Dict[str, Any]) -> UserResponse:
         is_active=user.get("is_active", True),
         is_admin=user.get("is_admin", False),
         whatsapp_connection=user.get("whatsapp_connection"),
-        created_at=user.get("created_at", ""),
-        updated_at=user.get("updated_at", ""),
+        created_at=user.get("created_at"),
+        updated_at=user.get("updated_at"),
     )
 
 
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+async def optional_claims(authorization: Optional[str] = Header(None)) -> Optional[Dict[str, Any]]:
+    """Verified access-token claims, or None for anonymous requests."""
+    token = bearer_token(authorization)
+    if token is None:
+        return None
+    try:
+        return token_service.verify(token)
+    except TokenError as error:
+        raise HTTPException(status_code=401, detail=str(error), headers={"WWW-Authenticate": "Bearer"})
+
+
 def get_cors_configuration() -> tuple[List[str], bool]:
     default_origins = [
         "http://localhost:3000",
@@ -104,18 +137,38 @@ async def simulation_loop() -> None:
         await asyncio.sleep(15)
 
 
+async def suggestion_index_loop() -> None:
+    # The first pass warms the index at startup; /products/suggest answers empty until it lands.
+    while True:
+        try:
+            await asyncio.to_thread(db.refresh_suggestion_index)
+        except Exception:
+            logger.exception("Suggestion index refresh failed; keeping the current index")
+        await asyncio.sleep(SUGGEST_SYNC_INTERVAL_SECONDS)
+
+
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     try:
         commerce_service.process_due_simulations()
     except Exception:
         logger.exception("Skipping startup simulation warmup because the database is unavailable")
-    task = asyncio.create_task(simulation_loop())
+    await chat_writer.start()
+    await popular_queries.start()
+    await trending.start()
+    await recommendation_slates.start()
+    tasks = [asyncio.create_task(simulation_loop()), asyncio.create_task(suggestion_index_loop())]
     try:
         yield
     finally:
-        task.cancel()
-        await asyncio.gather(task, return_exceptions=True)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chat_writer.stop()
+        await popular_queries.stop()
+        await trending.stop()
+        await recommendation_slates.stop()
+        password_hasher.shutdown()
 
 
 app = FastAPI(
@@ -145,10 +198,12 @@ async def favicon():
 
 
 @app.post("/sales", response_model=SalesResponse)
-async def sales_chat(req: SalesRequest):
+async def sales_chat(req: SalesRequest, claims: Optional[Dict[str, Any]] = Depends(optional_claims)):
     try:
         commerce_service.process_due_simulations()
-        return await orchestrator.process_message(req)
+        if claims:
+            req.user_id = claims["sub"]
+        return await orchestrator.process_message(req, claims=claims)
     except Exception as error:
         logger.exception("Sales endpoint failed")
         raise HTTPException(status_code=500, detail=str(error))
@@ -171,11 +226,15 @@ async def voice_agent(req: VoiceAgentRequest):
 @app.post("/auth/register", response_model=LoginResponse)
 async def register(user_data: UserRegister):
     try:
+        if db.get_user_by_email(user_data.email):
+            raise HTTPException(status_code=400, detail="Email already registered")
+
         new_user = db.register_user(
             email=user_data.email,
             password=user_data.password,
             first_name=user_data.first_name,
             last_name=user_data.last_name,
+            password_hash=await password_hasher.hash(user_data.password),
         )
         if not new_user:
             raise HTTPException(status_code=400, detail="Email already registered")
@@ -184,7 +243,7 @@ async def register(user_data: UserRegister):
             success=True,
             message="User registered successfully",
             user=user_to_response(new_user),
-            token=str(new_user.get("_id", "")),
+            **token_service.issue_pair(new_user),
         )
     except HTTPException:
         raise
@@ -195,15 +254,22 @@ async def register(user_data: UserRegister):
 @app.post("/auth/login", response_model=LoginResponse)
 async def login(credentials: UserLogin):
     try:
-        user = db.authenticate_user(email=credentials.email, password=credentials.password)
-        if not user:
+        stored_user = db.get_user_by_email(credentials.email)
+        if not stored_user:
+            raise HTTPException(status_code=401, detail="Invalid email or password")
+
+        valid, new_hash = await password_hasher.verify(credentials.password, stored_user.get("password_hash", ""))
+        if not valid:
             raise HTTPException(status_code=401, detail="Invalid email or password")
+        if new_hash:
+            db.update_password_hash(stored_user["_id"], new_hash)
+        user = db.public_user(stored_user)
 
         return LoginResponse(
             success=True,
             message="Login successful",
             user=user_to_response(user),
-            token=user.get("id", ""),
+            **token_service.issue_pair(user),
         )
     except HTTPException:
         raise
@@ -211,6 +277,32 @@ async def login(credentials: UserLogin):
         raise HTTPException(status_code=500, detail=str(error))
 
 
+@app.post("/auth/refresh", response_model=LoginResponse)
+async def refresh_token(payload: RefreshRequest):
+    try:
+        tokens = token_service.refresh(payload.refresh_token)
+    except TokenError as error:
+        raise HTTPException(status_code=401, detail=str(error), headers={"WWW-Authenticate": "Bearer"})
+    return LoginResponse(success=True, message="Token refreshed", **tokens)
+
+
+@app.post("/auth/logout")
+async def logout(
+    payload: Optional[LogoutRequest] = Body(None),
+    authorization: Optional[str] = Header(None),
+):
+    revoked = 0
+    for token in (bearer_token(authorization), payload.refresh_token if payload else None):
+        if not token:
+            continue
+        try:
+            token_service.revoke(token)
+            revoked += 1
+        except TokenError as error:
+            raise HTTPException(status_code=401, detail=str(error))
+    return {"success": True, "revoked_tokens": revoked}
+
+
 @app.get("/auth/me/{user_id}", response_model=UserResponse)
 async def get_profile(user_id: str):
     try:
@@ -273,23 +365,75 @@ async def get_products(
     min_price: float = None,
     max_price: float = None,
     q: str = None,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return; omits descriptions by default"),
+    facets: bool = Query(False, description="Also return facet counts under the active filters"),
 ):
-    if category or occasion or min_price is not None or max_price is not None or q:
-        products = db.search_products(
-            category=category,
-            occasion=occasion,
-            min_price=min_price,
-            max_price=max_price,
-            query=q,
+    filters = {
+        "category": category,
+        "occasion": occasion,
+        "min_price": min_price,
+        "max_price": max_price,
+        "query": q,
+    }
+    if cursor is None and fields is None:
+        # First pages are what shoppers repeat; those go through the popular-search cache.
+        result = popular_queries.search(**filters, limit=limit, facets=facets)
+        return serialize_document(result)
+
+    try:
+        products, next_cursor = db.list_products_page(
+            **filters,
+            limit=limit,
+            cursor=cursor,
+            projection=projection_for(fields, PRODUCT_LIST_PROJECTION),
         )
-    else:
-        products = db.get_all_products()
-    return {"products": [serialize_document(product) for product in products]}
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    response = {"products": [serialize_document(product) for product in products], "next_cursor": next_cursor}
+    if facets:
+        response["facets"] = db.get_product_facets(**filters)
+    return response
 
 
 @app.get("/products/meta")
-async def get_product_metadata():
-    return serialize_document(db.get_catalog_metadata())
+async def get_product_metadata(response: Response, if_none_match: Optional[str] = Header(None)):
+    meta = db.get_catalog_metadata()
+    etag = f'"catalog-{meta.get("version", 0)}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return {
+        "categories": meta.get("categories", []),
+        "occasions": meta.get("occasions", []),
+        "version": meta.get("version", 0),
+    }
+
+
+@app.get("/products/suggest")
+async def suggest_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(8, ge=1, le=10),
+):
+    return {"query": q, "suggestions": db.product_suggestion_index().suggest(q, limit=limit)}
+
+
+@app.get("/products/trending")
+async def get_trending_products(
+    category: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=TRENDING_TOP_N),
+):
+    ranked = trending.top(category, limit)
+    scores = dict(ranked)
+    products = db.get_products_by_ids([product_id for product_id, _ in ranked], PRODUCT_LIST_PROJECTION)
+    return {
+        "category": category,
+        "products": [
+            {**serialize_document(product), "trending_score": round(scores[product["id"]], 3)} for product in products
+        ],
+    }
 
 
 @app.get("/products/{product_id}")
@@ -304,8 +448,8 @@ async def get_product(product_id: int):
 async def get_user_cart(user_id: str):
     cart = db.get_cart(user_id)
     if not cart:
-        return {"user_id": user_id, "items": []}
-    return {"user_id": user_id, "items": cart.get("items", [])}
+        return {"user_id": user_id, "items": [], "version": 0}
+    return {"user_id": user_id, "items": cart.get("items", []), "version": cart.get("version", 0)}
 
 
 @app.post("/user/{user_id}/cart/add/{product_id}")
@@ -315,32 +459,25 @@ async def add_to_cart(
     quantity: int = Query(1, ge=1),
     size: Optional[str] = Query(None),
     color: Optional[str] = Query(None),
+    expected_version: Optional[int] = Query(None, ge=0),
 ):
     product = db.get_product(product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    cart = db.get_cart(user_id) or {"user_id": user_id, "items": []}
-    for item in cart.get("items", []):
-        if (
-            item["product_id"] == product_id
-            and item.get("size") == size
-            and item.get("color") == color
-        ):
-            item["quantity"] += quantity
-            break
-    else:
-        cart.setdefault("items", []).append(
-            {
-                "product_id": product_id,
-                "quantity": quantity,
-                "price": product["price"],
-                "size": size,
-                "color": color,
-            }
+    try:
+        cart = db.add_to_cart(
+            user_id,
+            product_id,
+            quantity=quantity,
+            price=product["price"],
+            size=size,
+            color=color,
+            expected_version=expected_version,
         )
+    except CartVersionConflictError as error:
+        raise HTTPException(status_code=409, detail=str(error))
 
-    db.update_cart(user_id, cart.get("items", []))
     commerce_service.record_user_activity(
         user_id,
         "cart_add",
@@ -351,25 +488,40 @@ async def add_to_cart(
             "color": color,
         },
     )
-    return {"message": "Item added to cart", "user_id": user_id, "product_id": product_id}
+    return {
+        "message": "Item added to cart",
+        "user_id": user_id,
+        "product_id": product_id,
+        "version": cart.get("version", 0),
+    }
 
 
 @app.delete("/user/{user_id}/cart/remove/{product_id}")
-async def remove_from_cart(user_id: str, product_id: int):
-    cart = db.get_cart(user_id) or {"user_id": user_id, "items": []}
-    original_length = len(cart.get("items", []))
-    cart["items"] = [item for item in cart.get("items", []) if item["product_id"] != product_id]
-
-    if len(cart["items"]) == original_length:
+async def remove_from_cart(
+    user_id: str,
+    product_id: int,
+    size: Optional[str] = Query(None),
+    color: Optional[str] = Query(None),
+    expected_version: Optional[int] = Query(None, ge=0),
+):
+    try:
+        cart = db.remove_from_cart(user_id, product_id, size=size, color=color, expected_version=expected_version)
+    except CartVersionConflictError as error:
+        raise HTTPException(status_code=409, detail=str(error))
+    if cart is None:
         raise HTTPException(status_code=404, detail="Product not found in cart")
 
-    db.update_cart(user_id, cart["items"])
     commerce_service.record_user_activity(
         user_id,
         "cart_remove",
         {"product_id": product_id},
     )
-    return {"message": "Item removed from cart", "user_id": user_id, "product_id": product_id}
+    return {
+        "message": "Item removed from cart",
+        "user_id": user_id,
+        "product_id": product_id,
+        "version": cart.get("version", 0),
+    }
 
 
 @app.post("/user/{user_id}/checkout")
@@ -443,7 +595,10 @@ async def advance_order(order_number: str, payload: OrderAdvanceRequest):
 
 @app.post("/orders/{order_number}/payments/{payment_id}/retry")
 async def retry_payment(order_number: str, payment_id: str, payload: PaymentRetryRequest):
-    order = commerce_service.retry_payment(order_number, payment_id, scenario=payload.scenario)
+    try:
+        order = commerce_service.retry_payment(order_number, payment_id, scenario=payload.scenario)
+    except ValueError as error:
+        raise HTTPException(status_code=409, detail=str(error))
     if not order:
         raise HTTPException(status_code=404, detail="Order or payment not found")
     return serialize_document(order)
@@ -468,23 +623,33 @@ async def add_to_wishlist(user_id: str, product_id: int):
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     db.add_to_wishlist(user_id, product_id)
+    recommendation_slates.mark_stale(user_id)
     return {"message": "Item added to wishlist", "user_id": user_id, "product_id": product_id}
 
 
 @app.delete("/user/{user_id}/wishlist/{product_id}")
 async def remove_from_wishlist(user_id: str, product_id: int):
     success = db.remove_from_wishlist(user_id, product_id)
+    recommendation_slates.mark_stale(user_id)
     if not success:
         raise HTTPException(status_code=404, detail="Product not found in wishlist")
     return {"message": "Item removed from wishlist", "user_id": user_id, "product_id": product_id}
 
 
 @app.get("/chat/{session_id}/messages")
-async def get_chat_messages(session_id: str):
-    messages = db.get_chat_history(session_id, limit=100)
+async def get_chat_messages(
+    session_id: str,
+    limit: int = Query(100, ge=1, le=500),
+    before: Optional[str] = Query(None),
+):
+    try:
+        messages, next_cursor = db.get_chat_history_page(session_id, limit=limit, before=before)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     return {
         "session_id": session_id,
         "messages": [serialize_document(message) for message in messages],
+        "next_cursor": next_cursor,
     }
 
 
@@ -517,16 +682,63 @@ async def get_activity_summary(user_id: str):
 
 
 @app.get("/user/{user_id}/communications")
-async def get_communications(user_id: str):
+async def get_communications(
+    user_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    notifications_cursor: Optional[str] = Query(None),
+    call_workflows_cursor: Optional[str] = Query(None),
+):
     commerce_service.process_due_simulations()
-    return serialize_document(commerce_service.get_user_communications(user_id))
+    try:
+        communications = commerce_service.get_user_communications(
+            user_id,
+            limit=limit,
+            cursors={"notifications": notifications_cursor, "call_workflows": call_workflows_cursor},
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return serialize_document(communications)
+
+
+@app.get("/admin/cache/metrics")
+async def get_cache_metrics():
+    return {
+        **db.cache_stats(),
+        "verified_tokens": token_service.stats(),
+        "sales_messages": orchestrator.inflight.stats(),
+        "popular_searches": popular_queries.stats(),
+        "trending": trending.stats(),
+        "recommendation_slates": recommendation_slates.stats(),
+        "process": process_memory(),
+    }
+
+
+@app.get("/admin/search/popular")
+async def get_popular_searches(limit: int = Query(50, ge=1, le=500)):
+    return {
+        "cache": popular_queries.stats(),
+        "queries": popular_queries.frequency_table(limit),
+    }
 
 
 @app.get("/admin/simulation/orders")
-async def get_admin_simulation_orders():
+async def get_admin_simulation_orders(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return; omits timelines by default"),
+):
     commerce_service.process_due_simulations()
+    try:
+        orders, next_cursor = commerce_service.list_admin_orders(
+            limit=limit,
+            cursor=cursor,
+            projection=projection_for(fields, ORDER_LIST_PROJECTION),
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
     return {
-        "orders": [serialize_document(order) for order in commerce_service.list_admin_orders()],
+        "orders": [serialize_document(order) for order in orders],
+        "next_cursor": next_cursor,
     }
 
 
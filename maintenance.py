@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Offline maintenance jobs for the MongoDB data set (backfills and migrations).
+Run `python maintenance.py <job> --help` for the options of each job.
+"""
+
+import argparse
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from database import ITEM_SIMILARITY_WINDOW_DAYS, Database
+from indexes import INDEX_MANIFEST_VERSION, apply_index_manifest, check_indexes
+from item_similarity import (
+    ITEM_SIMILARITY_TOP_K,
+    ORDER_WEIGHT,
+    VIEW_SESSION_WEIGHT,
+    build_item_similarity,
+    view_sessions,
+)
+from recommendation_slates import (
+    SLATE_ACTIVE_DAYS,
+    SLATE_BATCH_SIZE,
+    SLATE_SIZE,
+    SLATE_WORKERS,
+    SlateBuilder,
+)
+from trending import TrendingTracker
+
+load_dotenv()
+
+
+def backfill_chat_sessions(database: Database, args: argparse.Namespace) -> None:
+    """Populate message_count, title and last_message_preview on existing chat sessions."""
+    started = time.perf_counter()
+    updated = database.backfill_chat_session_summaries(batch_size=args.batch_size)
+    print(f"✅ Backfilled {updated} chat sessions in {time.perf_counter() - started:.1f}s")
+
+
+def migrate_user_ids(database: Database, args: argparse.Namespace) -> None:
+    """Rewrite users and their references to the canonical string user_id."""
+    started = time.perf_counter()
+    counts = database.migrate_canonical_user_ids(batch_size=args.batch_size)
+    print(
+        f"✅ Migrated {counts['users']} users and {counts['references']} referencing documents "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+def migrate_timestamps(database: Database, args: argparse.Namespace) -> None:
+    """Convert ISO-string timestamps in all collections to BSON datetimes."""
+    started = time.perf_counter()
+    counts = database.migrate_timestamps_to_datetime(batch_size=args.batch_size)
+    for collection_name, modified in sorted(counts.items()):
+        print(f"  {collection_name}: {modified} documents")
+    print(f"✅ Converted {sum(counts.values())} documents in {time.perf_counter() - started:.1f}s")
+
+
+def check_indexes_job(database: Database, args: argparse.Namespace) -> None:
+    """Apply the index manifest, explain the canned queries and exit 1 on any COLLSCAN."""
+    if not args.skip_apply:
+        applied = apply_index_manifest(database.db, force=args.force)
+        print(f"Index manifest v{INDEX_MANIFEST_VERSION}: {'applied' if applied else 'already up to date'}")
+
+    results = check_indexes(database.db)
+    for result in results:
+        marker = "❌" if result["collscan"] else "✅"
+        print(f"{marker} {result['collection']} {result['filter']}: {' <- '.join(result['stages'])}")
+
+    collscans = sum(1 for result in results if result["collscan"])
+    if collscans:
+        print(f"{collscans} of {len(results)} canned queries use a collection scan")
+        sys.exit(1)
+    print(f"All {len(results)} canned queries are index-backed")
+
+
+def normalize_catalog_keys(database: Database, args: argparse.Namespace) -> None:
+    """Backfill lowercase category/occasion keys so product filters can use indexes."""
+    started = time.perf_counter()
+    modified = database.normalize_catalog_keys(batch_size=args.batch_size)
+    print(f"✅ Normalized {modified} products in {time.perf_counter() - started:.1f}s")
+
+
+def refresh_catalog_meta(database: Database, args: argparse.Namespace) -> None:
+    """Rebuild the materialized /products/meta counts after out-of-band product edits."""
+    meta = database.refresh_catalog_metadata()
+    print(
+        f"✅ Catalog meta v{meta['version']}: {len(meta['categories'])} categories, "
+        f"{len(meta['occasions'])} occasions"
+    )
+
+
+def build_item_similarity_job(database: Database, args: argparse.Namespace) -> None:
+    """Rebuild the item-item similarity neighbours from orders and recent product-view sessions."""
+    started = time.perf_counter()
+    counts = {"orders": 0, "view_sessions": 0}
+
+    def baskets():
+        for basket in database.iter_purchase_baskets():
+            counts["orders"] += 1
+            yield basket, ORDER_WEIGHT
+        for session in view_sessions(database.iter_recent_views(days=args.days)):
+            counts["view_sessions"] += 1
+            yield session, VIEW_SESSION_WEIGHT
+
+    similarity = build_item_similarity(baskets(), top_k=args.top_k)
+    built = time.perf_counter() - started
+    written = database.replace_item_similarity(similarity.documents())
+    print(
+        f"✅ Item similarity from {counts['orders']} orders and {counts['view_sessions']} view sessions: "
+        f"{similarity.stats()} built in {built:.1f}s, {written} products stored in "
+        f"{time.perf_counter() - started - built:.1f}s"
+    )
+
+
+def build_recommendation_slates(database: Database, args: argparse.Namespace) -> None:
+    """Rebuild the recommendation slate of every recently active user, in parallel batches."""
+    tracker = TrendingTracker(database)
+    tracker.sync()
+    builder = SlateBuilder(database, tracker, size=args.size)
+    totals = builder.run(batch_size=args.batch_size, workers=args.workers, days=args.days, report=print)
+    print(
+        f"✅ Built {totals['users']} slates in {totals['batches']} batches in {totals['seconds']:.1f}s "
+        f"({totals['users_per_second'] or 0:.0f} users/s)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-name", help="Override MONGODB_DB_NAME")
+    subparsers = parser.add_subparsers(dest="job", required=True)
+
+    chat_sessions = subparsers.add_parser("backfill-chat-sessions", help=backfill_chat_sessions.__doc__)
+    chat_sessions.add_argument("--batch-size", type=int, default=500)
+    chat_sessions.set_defaults(func=backfill_chat_sessions)
+
+    user_ids = subparsers.add_parser("migrate-user-ids", help=migrate_user_ids.__doc__)
+    user_ids.add_argument("--batch-size", type=int, default=500)
+    user_ids.set_defaults(func=migrate_user_ids)
+
+    timestamps = subparsers.add_parser("migrate-timestamps", help=migrate_timestamps.__doc__)
+    timestamps.add_argument("--batch-size", type=int, default=500)
+    timestamps.set_defaults(func=migrate_timestamps)
+
+    index_check = subparsers.add_parser("check-indexes", help=check_indexes_job.__doc__)
+    index_check.add_argument("--force", action="store_true", help="Re-apply the manifest even if its hash is unchanged")
+    index_check.add_argument("--skip-apply", action="store_true", help="Only explain the canned queries")
+    index_check.set_defaults(func=check_indexes_job)
+
+    catalog_keys = subparsers.add_parser("normalize-catalog-keys", help=normalize_catalog_keys.__doc__)
+    catalog_keys.add_argument("--batch-size", type=int, default=500)
+    catalog_keys.set_defaults(func=normalize_catalog_keys)
+
+    catalog_meta = subparsers.add_parser("refresh-catalog-meta", help=refresh_catalog_meta.__doc__)
+    catalog_meta.set_defaults(func=refresh_catalog_meta)
+
+    similarity = subparsers.add_parser("build-item-similarity", help=build_item_similarity_job.__doc__)
+    similarity.add_argument("--top-k", type=int, default=ITEM_SIMILARITY_TOP_K)
+    similarity.add_argument("--days", type=int, default=ITEM_SIMILARITY_WINDOW_DAYS, help="View history window")
+    similarity.set_defaults(func=build_item_similarity_job)
+
+    slates = subparsers.add_parser("build-recommendation-slates", help=build_recommendation_slates.__doc__)
+    slates.add_argument("--batch-size", type=int, default=SLATE_BATCH_SIZE)
+    slates.add_argument("--workers", type=int, default=SLATE_WORKERS)
+    slates.add_argument("--days", type=int, default=SLATE_ACTIVE_DAYS, help="Activity window for active users and views")
+    slates.add_argument("--size", type=int, default=SLATE_SIZE)
+    slates.set_defaults(func=build_recommendation_slates)
+
+    args = parser.parse_args()
+    database = Database(db_name=args.db_name)
+    try:
+        args.func(database, args)
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
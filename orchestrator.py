@@ -1,4 +1,4 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from agents.sales_agent import SalesAgent
 from agents.recommendation_agent import RecommendationAgent
@@ -8,8 +8,11 @@ from agents.fulfillment_agent import FulfillmentAgent
 from agents.loyalty_agent import LoyaltyAgent
 from agents.support_agent import SupportAgent
 from database import db
+from chat_writer import chat_writer, merge_pending
 from commerce_service import commerce_service
+from recommendation_slates import derive_style_preferences
 from schemas import SalesRequest, SalesResponse
+from singleflight import SingleFlight, normalize_message
 
 
 class Orchestrator:
@@ -31,25 +34,42 @@ class Orchestrator:
             "loyalty": self.loyalty_agent,
             "support": self.support_agent,
         }
+        self.inflight = SingleFlight("sales_messages")
 
-    async def process_message(self, request: SalesRequest) -> SalesResponse:
-        """Main entry point for processing sales conversations."""
+    async def process_message(self, request: SalesRequest, claims: Optional[Dict[str, Any]] = None) -> SalesResponse:
+        """Main entry point for processing sales conversations.
+
+        ``claims`` are verified access-token claims; when present they replace
+        the user document lookup for the profile part of the context.
+        """
+        if not request.session_id:
+            return await self._process_message(request, claims)
+
+        # Double-submits and webhook retries for the same session attach to the
+        # turn that is already running instead of producing a second reply. The
+        # user and channel are part of the key, so a request can never receive a
+        # reply built for another user's context.
+        key = (request.session_id, request.user_id, request.channel.value, normalize_message(request.message))
+        return await self.inflight.do_async(key, self._process_message, request, claims)
+
+    async def _process_message(self, request: SalesRequest, claims: Optional[Dict[str, Any]] = None) -> SalesResponse:
         session_id = db.get_or_create_chat_session(
             user_id=request.user_id,
             session_id=request.session_id,
             channel=request.channel.value,
         )
 
+        user_message_id = None
         if session_id:
-            db.add_chat_message(session_id, "user", request.message)
+            user_message_id = chat_writer.enqueue(session_id, "user", request.message)
 
         # Get user context
-        user_context = self._build_user_context(request.user_id, session_id)
+        user_context = self._build_user_context(request.user_id, session_id, claims)
 
         deterministic_reply = commerce_service.maybe_build_chatbot_reply(request.user_id, request.message)
         if deterministic_reply:
             if session_id:
-                db.add_chat_message(session_id, "assistant", deterministic_reply, "support")
+                chat_writer.enqueue(session_id, "assistant", deterministic_reply, "support")
             return SalesResponse(
                 reply=deterministic_reply,
                 session_id=session_id,
@@ -61,11 +81,16 @@ class Orchestrator:
         # Get chat history
         chat_history = []
         if session_id:
-            messages = db.get_chat_history(session_id, limit=14)
+            messages = merge_pending(
+                db.get_chat_history(session_id, limit=15),
+                chat_writer.pending_messages(session_id),
+            )
+            # The tail includes the message just stored; it is sent separately as the user turn.
             chat_history = [
-                {"role": msg["message_type"], "content": msg["content"]}
+                {"id": str(msg.get("_id")), "role": msg["message_type"], "content": msg["content"]}
                 for msg in messages
-            ]
+                if str(msg.get("_id")) != user_message_id
+            ][-14:]
 
         intents = self._detect_intents(request.message)
         tool_outputs = await self._run_agentic_steps(intents, request.message, user_context)
@@ -76,10 +101,11 @@ class Orchestrator:
             user_context=user_context,
             channel=request.channel,
             tool_outputs=tool_outputs,
+            session_id=session_id,
         )
 
         if session_id:
-            db.add_chat_message(session_id, "assistant", response_text, "sales")
+            chat_writer.enqueue(session_id, "assistant", response_text, "sales")
 
         requires_action, action_type, action_data = self._extract_action(
             request.message,
@@ -95,23 +121,37 @@ class Orchestrator:
             action_data=action_data,
         )
 
-    def _build_user_context(self, user_id: str | None, session_id: str | None = None) -> Dict[str, Any]:
+    def _build_user_context(
+        self,
+        user_id: str | None,
+        session_id: str | None = None,
+        claims: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
         if not user_id:
             return {}
 
-        user = db.get_user_flexible(user_id)
         base_context = {
             "user_id": user_id,
             "past_orders": db.get_user_orders(user_id),
         }
 
-        if user:
+        if claims and claims.get("sub") == user_id:
             base_context.update(
                 {
-                    "name": f"{user['first_name']} {user['last_name']}",
-                    "loyalty_score": user.get("loyalty_score", 0),
+                    "name": claims.get("name", ""),
+                    "loyalty_score": claims.get("loyalty_score", 0),
+                    "loyalty_tier": claims.get("tier"),
                 }
             )
+        else:
+            user = db.get_user_flexible(user_id)
+            if user:
+                base_context.update(
+                    {
+                        "name": f"{user['first_name']} {user['last_name']}",
+                        "loyalty_score": user.get("loyalty_score", 0),
+                    }
+                )
 
         commerce_context = commerce_service.get_chatbot_context(user_id)
         if commerce_context:
@@ -128,6 +168,8 @@ class Orchestrator:
 
         base_context["cross_channel_memory"] = memory_snippets
         base_context["style_preferences"] = self._derive_style_preferences(cross_messages)
+        slate = db.get_user_recommendations(user_id)
+        base_context["recommendation_slate"] = slate.get("products", []) if slate else []
 
         return base_context
 
@@ -250,23 +292,4 @@ class Orchestrator:
         return False, None, None
 
     def _derive_style_preferences(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Extract lightweight recurring style signals from recent chat history."""
-        colors = ["black", "white", "blue", "navy", "red", "green", "pink", "beige", "burgundy"]
-        occasions = ["wedding", "party", "casual", "formal", "office", "vacation", "business"]
-
-        detected_colors: list[str] = []
-        detected_occasions: list[str] = []
-
-        for message in messages:
-            content = (message.get("content") or "").lower()
-            for color in colors:
-                if color in content and color not in detected_colors:
-                    detected_colors.append(color)
-            for occasion in occasions:
-                if occasion in content and occasion not in detected_occasions:
-                    detected_occasions.append(occasion)
-
-        return {
-            "colors": detected_colors[:3],
-            "occasions": detected_occasions[:2],
-        }
+        return derive_style_preferences(messages)
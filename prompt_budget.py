@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+MESSAGE_OVERHEAD_TOKENS = 4
+
+DEFAULT_SECTION_BUDGETS = {
+    "profile": 120,
+    "memory": 200,
+    "products": 700,
+    "tools": 900,
+    "summary": 250,
+    "history": 1500,
+}
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """Approximate a BPE tokenizer: short words are one token, long ones ~4 chars each."""
+    total = 0
+    for match in TOKEN_PATTERN.finditer(text or ""):
+        length = match.end() - match.start()
+        total += 1 if length <= 4 else (length + 3) // 4
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+
+    used = 0
+    cut = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        length = match.end() - match.start()
+        used += 1 if length <= 4 else (length + 3) // 4
+        if used > max_tokens:
+            # The ellipsis is a token too, so cut where one token was still free.
+            return text[:cut].rstrip() + " …"
+        if used < max_tokens:
+            cut = match.end()
+    return text
+
+
+def fold_turns_into_summary(summary: str, turns: Sequence[Dict[str, Any]], max_tokens: int) -> str:
+    """Append condensed older turns to the rolling summary, keeping the newest lines in budget."""
+    lines = [line for line in (summary or "").splitlines() if line.strip()]
+    for turn in turns:
+        content = " ".join(str(turn.get("content") or "").split())
+        if content:
+            lines.append(f"- {turn.get('role', 'user')}: {content[:160]}")
+
+    while lines and count_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+@dataclass
+class PromptAssembly:
+    messages: List[Dict[str, str]]
+    section_tokens: Dict[str, int]
+    dropped_turns: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.section_tokens.values())
+
+
+class PromptBudget:
+    """Fit a chat prompt into a token budget with a fixed allowance per section.
+
+    Fixed sections (system prompt, answering rules, the current user message)
+    are always sent in full. Budgeted sections are truncated to their share,
+    or to what is left of ``total_tokens`` when that is less, and history
+    keeps the newest turns that fit; older turns are returned as
+    ``dropped_turns`` so the caller can fold them into the rolling summary.
+    """
+
+    def __init__(
+        self,
+        total_tokens: Optional[int] = None,
+        section_budgets: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.total_tokens = total_tokens or int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+        self.section_budgets = {**DEFAULT_SECTION_BUDGETS, **(section_budgets or {})}
+
+    def assemble(
+        self,
+        sections: Sequence[Tuple[str, str]],
+        history: Sequence[Dict[str, Any]],
+        user_message: str,
+        summary: Optional[str] = None,
+    ) -> PromptAssembly:
+        section_tokens: Dict[str, int] = {}
+        parts: List[str] = []
+
+        # Fixed sections are sent in full; budgeted ones share what they leave of total_tokens.
+        fixed_tokens = count_tokens(user_message) + 2 * MESSAGE_OVERHEAD_TOKENS + sum(
+            count_tokens(text) for name, text in sections if text and name not in self.section_budgets
+        )
+        remaining = self.total_tokens - fixed_tokens
+
+        for name, text in sections:
+            if not text:
+                continue
+            budget = self.section_budgets.get(name)
+            if budget is not None:
+                text = truncate_to_tokens(text, min(budget, remaining))
+                remaining -= count_tokens(text)
+            parts.append(text)
+            section_tokens[name] = section_tokens.get(name, 0) + count_tokens(text)
+
+        if summary:
+            header = "\nEarlier in this conversation:\n"
+            summary_budget = min(self.section_budgets["summary"], remaining - count_tokens(header))
+            if summary_budget > 0:
+                summary_text = header + truncate_to_tokens(summary, summary_budget) + "\n"
+                parts.append(summary_text)
+                section_tokens["summary"] = count_tokens(summary_text)
+
+        system_prompt = "".join(parts)
+        section_tokens["user_message"] = count_tokens(user_message) + MESSAGE_OVERHEAD_TOKENS
+        used = sum(section_tokens.values()) + MESSAGE_OVERHEAD_TOKENS
+        # History gets its own allowance, but never more than the other sections left over.
+        history_budget = max(0, min(self.section_budgets["history"], self.total_tokens - used))
+
+        kept: List[Dict[str, str]] = []
+        history_tokens = 0
+        dropped_index = -1
+        for index in range(len(history) - 1, -1, -1):
+            turn = history[index]
+            turn_tokens = count_tokens(turn.get("content")) + MESSAGE_OVERHEAD_TOKENS
+            if history_tokens + turn_tokens > history_budget:
+                dropped_index = index
+                break
+            kept.append({"role": turn["role"], "content": turn["content"]})
+            history_tokens += turn_tokens
+        kept.reverse()
+        section_tokens["history"] = history_tokens
+
+        messages = [{"role": "system", "content": system_prompt}] + kept + [{"role": "user", "content": user_message}]
+        return PromptAssembly(
+            messages=messages,
+            section_tokens=section_tokens,
+            dropped_turns=list(history[: dropped_index + 1]),
+        )
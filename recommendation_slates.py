@@ -0,0 +1,240 @@
+"""
+Precomputed per-user recommendation slates.
+
+A slate is the top SLATE_SIZE products for one user, scored from their recent
+views, cart, wishlist and past orders (through the item similarity
+neighbours), the style preferences in their recent chat messages, and what is
+trending. Slates live in ``user_recommendations`` so the agents read one
+document at chat time and only re-rank it for the filters in the message.
+
+``maintenance.py build-recommendation-slates`` rebuilds every active user in
+parallel batches. In the API process, activities that change a user's signals
+mark the user stale and a background task rebuilds stale slates in batches.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from catalog import ProductRecord
+from database import Database, db
+from trending import TrendingTracker, trending
+
+logger = logging.getLogger(__name__)
+
+SLATE_SIZE = int(os.getenv("SLATE_SIZE", "50"))
+SLATE_ACTIVE_DAYS = int(os.getenv("SLATE_ACTIVE_DAYS", "30"))
+SLATE_BATCH_SIZE = int(os.getenv("SLATE_BATCH_SIZE", "200"))
+SLATE_WORKERS = int(os.getenv("SLATE_WORKERS", "4"))
+SLATE_REFRESH_INTERVAL_SECONDS = float(os.getenv("SLATE_REFRESH_INTERVAL_SECONDS", "15"))
+# Activities that change a user's signals and so their slate.
+SLATE_ACTIVITY_TYPES = ["product_view", "cart_add", "cart_update", "cart_remove", "checkout_started"]
+
+SIGNAL_WEIGHTS: Dict[str, float] = {"view": 1.0, "wishlist": 2.0, "cart": 3.0, "purchase": 2.0}
+MAX_VIEW_WEIGHT = 3.0
+# Products the user looked at or saved come back, but below strong neighbours.
+RESURFACE_FACTOR = 0.5
+TRENDING_BONUS = 0.2
+STYLE_BONUS = 0.5
+
+STYLE_COLORS = ["black", "white", "blue", "navy", "red", "green", "pink", "beige", "burgundy"]
+STYLE_OCCASIONS = ["wedding", "party", "casual", "formal", "office", "vacation", "business"]
+
+
+def derive_style_preferences(messages: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Extract lightweight recurring style signals from recent chat history."""
+    detected_colors: List[str] = []
+    detected_occasions: List[str] = []
+
+    for message in messages:
+        content = (message.get("content") or "").lower()
+        for color in STYLE_COLORS:
+            if color in content and color not in detected_colors:
+                detected_colors.append(color)
+        for occasion in STYLE_OCCASIONS:
+            if occasion in content and occasion not in detected_occasions:
+                detected_occasions.append(occasion)
+
+    return {
+        "colors": detected_colors[:3],
+        "occasions": detected_occasions[:2],
+    }
+
+
+def build_slate(
+    signals: Dict[str, Any],
+    style: Dict[str, Any],
+    record_of: Callable[[Any], Optional[ProductRecord]],
+    neighbours: Dict[Any, List[Any]],
+    hot: Set[int],
+    size: int = SLATE_SIZE,
+) -> List[Dict[str, Any]]:
+    """Score candidate products for one user and return the best ``size`` with their reasons."""
+    seeds: Dict[int, float] = {}
+    for product_id, count in signals.get("views", {}).items():
+        seeds[product_id] = seeds.get(product_id, 0.0) + min(count * SIGNAL_WEIGHTS["view"], MAX_VIEW_WEIGHT)
+    for kind, key in (("wishlist", "wishlist"), ("cart", "cart"), ("purchase", "purchased")):
+        for product_id in signals.get(key, ()):
+            seeds[product_id] = seeds.get(product_id, 0.0) + SIGNAL_WEIGHTS[kind]
+    excluded = set(signals.get("purchased", ())) | set(signals.get("cart", ()))
+
+    scores: Dict[int, float] = {}
+    reasons: Dict[int, Set[str]] = {}
+
+    def add(product_id: int, score: float, reason: str) -> None:
+        scores[product_id] = scores.get(product_id, 0.0) + score
+        reasons.setdefault(product_id, set()).add(reason)
+
+    for seed, weight in seeds.items():
+        for product_id, similarity in neighbours.get(seed, ()):
+            add(product_id, weight * similarity, "similar")
+    for product_id, count in signals.get("views", {}).items():
+        add(product_id, RESURFACE_FACTOR * min(count, MAX_VIEW_WEIGHT), "viewed")
+    for product_id in signals.get("wishlist", ()):
+        add(product_id, RESURFACE_FACTOR * SIGNAL_WEIGHTS["wishlist"], "wishlisted")
+    for product_id in hot:
+        add(product_id, TRENDING_BONUS, "trending")
+
+    colors = [color.lower() for color in style.get("colors", [])]
+    occasions = {occasion.lower() for occasion in style.get("occasions", [])}
+    slate = []
+    for product_id, score in scores.items():
+        record = record_of(product_id)
+        if product_id in excluded or record is None or record.stock <= 0:
+            continue
+        if any(color in record.colors_lower for color in colors) or record.occasion_lower in occasions:
+            score += STYLE_BONUS
+            reasons[product_id].add("style")
+        slate.append({"product_id": product_id, "score": round(score, 4), "reasons": sorted(reasons[product_id])})
+    slate.sort(key=lambda entry: (-entry["score"], entry["product_id"]))
+    return slate[:size]
+
+
+class SlateBuilder:
+    """Build slates in batches, for the offline job and for stale users in the API process."""
+
+    def __init__(
+        self,
+        database: Database,
+        tracker: TrendingTracker,
+        size: int = SLATE_SIZE,
+        interval: float = SLATE_REFRESH_INTERVAL_SECONDS,
+    ) -> None:
+        self._database = database
+        self._trending = tracker
+        self.size = size
+        self.interval = interval
+        self._stale: Set[str] = set()
+        self._stale_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshed = 0
+
+    def build_users(self, user_ids: List[str], days: int = SLATE_ACTIVE_DAYS) -> int:
+        """Rebuild and store the slates of ``user_ids``; returns how many were stored."""
+        if not user_ids:
+            return 0
+        signals = self._database.get_recommendation_signals(user_ids, days=days)
+        seeds = {
+            product_id
+            for user_signals in signals.values()
+            for key in ("views", "wishlist", "cart", "purchased")
+            for product_id in user_signals.get(key, ())
+        }
+        neighbours = self._database.get_item_neighbours(seeds)
+        hot = self._trending.hot_products()
+        candidates = seeds | hot | {product_id for similar in neighbours.values() for product_id, _ in similar}
+        records = self._database.product_records(candidates)
+        messages = self._database.get_users_recent_messages(user_ids, limit=12, days=days)
+        slates = {}
+        for user_id in user_ids:
+            style = derive_style_preferences(messages.get(user_id, []))
+            slates[user_id] = build_slate(
+                signals.get(user_id, {}),
+                style,
+                records.get,
+                neighbours,
+                hot,
+                self.size,
+            )
+        return self._database.save_user_recommendations(slates)
+
+    def run(
+        self,
+        batch_size: int = SLATE_BATCH_SIZE,
+        workers: int = SLATE_WORKERS,
+        days: int = SLATE_ACTIVE_DAYS,
+        report: Callable[[str], None] = logger.info,
+    ) -> Dict[str, Any]:
+        """Rebuild every user active in the last ``days``, ``workers`` batches at a time."""
+        started = time.perf_counter()
+        user_ids = self._database.get_active_user_ids(days, SLATE_ACTIVITY_TYPES)
+        batches = [user_ids[start : start + batch_size] for start in range(0, len(user_ids), batch_size)]
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="slates") as pool:
+            for number, stored in enumerate(pool.map(lambda batch: self.build_users(batch, days), batches), 1):
+                done += stored
+                elapsed = time.perf_counter() - started
+                report(f"batch {number}/{len(batches)}: {done} users in {elapsed:.1f}s ({done / elapsed:.0f} users/s)")
+        elapsed = time.perf_counter() - started
+        return {
+            "users": done,
+            "batches": len(batches),
+            "seconds": round(elapsed, 2),
+            "users_per_second": round(done / elapsed, 1) if elapsed else None,
+        }
+
+    def mark_stale(self, user_id: Optional[str]) -> None:
+        if user_id:
+            with self._stale_lock:
+                self._stale.add(str(user_id))
+
+    def refresh_stale(self) -> int:
+        with self._stale_lock:
+            user_ids, self._stale = sorted(self._stale), set()
+        refreshed = 0
+        for start in range(0, len(user_ids), SLATE_BATCH_SIZE):
+            batch = user_ids[start : start + SLATE_BATCH_SIZE]
+            try:
+                refreshed += self.build_users(batch)
+            except Exception:
+                # Keep the users stale so the next round retries them.
+                logger.exception("Recommendation slates for %s users failed", len(batch))
+                with self._stale_lock:
+                    self._stale.update(batch)
+        self.refreshed += refreshed
+        return refreshed
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.refresh_stale)
+            except Exception:
+                logger.exception("Recommendation slate refresh failed")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"stale": len(self._stale), "refreshed": self.refreshed}
+
+
+recommendation_slates = SlateBuilder(db, trending)
@@ -112,7 +112,7 @@ class OrderTimelineEntry(BaseModel):
     description: str
     source: str
     metadata: Dict[str, Any] = Field(default_factory=dict)
-    created_at: str
+    created_at: datetime
 
 class WhatsAppConnection(BaseModel):
     provider: str = "openclaw"
@@ -120,8 +120,8 @@ class WhatsAppConnection(BaseModel):
     status: str = "disconnected"
     phone_number: Optional[str] = None
     opt_in: bool = True
-    connected_at: Optional[str] = None
-    updated_at: Optional[str] = None
+    connected_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
 class CheckoutItemRequest(BaseModel):
     product_id: str
@@ -218,11 +218,20 @@ class UserResponse(BaseModel):
     is_active: bool = True
     is_admin: bool = False
     whatsapp_connection: Optional[WhatsAppConnection] = None
-    created_at: str
-    updated_at: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
 class LoginResponse(BaseModel):
     success: bool
     message: str
     user: Optional[UserResponse] = None
     token: Optional[str] = None
+    refresh_token: Optional[str] = None
+    token_type: str = "bearer"
+    expires_in: Optional[int] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import FrequencyLRUCache
+from catalog import normalize_key, tokenize
+from database import Database, db
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "120"))
+SEARCH_PRECOMPUTE_TOP_N = int(os.getenv("SEARCH_PRECOMPUTE_TOP_N", "50"))
+SEARCH_PRECOMPUTE_INTERVAL_SECONDS = float(os.getenv("SEARCH_PRECOMPUTE_INTERVAL_SECONDS", "30"))
+
+SearchKey = Tuple[Optional[str], Optional[str], Optional[float], Optional[float], Optional[str], int, bool]
+_PARAM_NAMES = ("category", "occasion", "min_price", "max_price", "query", "limit", "facets")
+
+
+def normalize_search(
+    category: Optional[str] = None,
+    occasion: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    query: Optional[str] = None,
+    limit: int = 50,
+    facets: bool = False,
+) -> SearchKey:
+    """Canonical form of a first-page search, so "Women " and "women" share one entry."""
+    return (
+        normalize_key(category),
+        normalize_key(occasion),
+        float(min_price) if min_price is not None else None,
+        float(max_price) if max_price is not None else None,
+        " ".join(tokenize(query)) or None,
+        int(limit),
+        bool(facets),
+    )
+
+
+def _key_id(key: SearchKey) -> str:
+    return json.dumps(list(key), separators=(",", ":"))
+
+
+class PopularQueryCache:
+    """Serve first-page /products results for hot searches from memory.
+
+    Every first-page search is counted locally and the counts are merged into
+    the shared ``search_queries`` table by a background task, which also
+    precomputes the results of the SEARCH_PRECOMPUTE_TOP_N most frequent
+    searches. Results are tagged with the catalog version they were computed
+    for and evicted by frequency-weighted LRU. Stock does not bump the catalog
+    version, so cache hits overlay live stock levels for the page's products.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        maxsize: int = SEARCH_CACHE_SIZE,
+        ttl: float = SEARCH_CACHE_TTL_SECONDS,
+        top_n: int = SEARCH_PRECOMPUTE_TOP_N,
+        interval: float = SEARCH_PRECOMPUTE_INTERVAL_SECONDS,
+    ) -> None:
+        self._database = database
+        self.top_n = top_n
+        self.interval = interval
+        self.ttl = ttl
+        self._cache = FrequencyLRUCache("popular_searches", maxsize=maxsize, ttl=ttl)
+        self._counts: Dict[str, Tuple[Dict[str, Any], int]] = {}
+        self._counts_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.precomputed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.to_thread(self.flush_counts)
+
+    def search(self, **params: Any) -> Dict[str, Any]:
+        key = normalize_search(**params)
+        self._record(key)
+        version = self._catalog_version()
+        cached = self._cache.get(key)
+        if cached is not None and cached["version"] == version:
+            return self._with_live_stock(cached["result"])
+        result = self._compute(key)
+        self._store(key, version, result)
+        return result
+
+    def _with_live_stock(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """A copy of a cached result with current stock; the cached products are shared and left untouched."""
+        stock = self._database.get_stock_levels([product["id"] for product in result["products"] if "id" in product])
+        products = [
+            {**product, "stock": stock[product["id"]]} if product.get("id") in stock else product
+            for product in result["products"]
+        ]
+        return {**result, "products": products}
+
+    def _store(self, key: SearchKey, version: Any, result: Dict[str, Any]) -> None:
+        self._cache.set(key, {"version": version, "result": result, "computed_at": time.monotonic()})
+
+    def _record(self, key: SearchKey) -> None:
+        key_id = _key_id(key)
+        with self._counts_lock:
+            params, count = self._counts.get(key_id, (dict(zip(_PARAM_NAMES, key)), 0))
+            self._counts[key_id] = (params, count + 1)
+
+    def _catalog_version(self) -> Any:
+        return self._database.get_catalog_metadata().get("version", 0)
+
+    def _compute(self, key: SearchKey) -> Dict[str, Any]:
+        category, occasion, min_price, max_price, query, limit, facets = key
+        filters = {
+            "category": category,
+            "occasion": occasion,
+            "min_price": min_price,
+            "max_price": max_price,
+            "query": query,
+        }
+        products, next_cursor = self._database.list_products_page(**filters, limit=limit)
+        result: Dict[str, Any] = {"products": products, "next_cursor": next_cursor}
+        if facets:
+            result["facets"] = self._database.get_product_facets(**filters)
+        return result
+
+    def flush_counts(self) -> None:
+        with self._counts_lock:
+            counts, self._counts = self._counts, {}
+        try:
+            self._database.record_search_queries(counts)
+        except Exception:
+            logger.exception("Could not store %s search counts; keeping them for the next flush", len(counts))
+            with self._counts_lock:
+                for key_id, (params, count) in counts.items():
+                    _, newer = self._counts.get(key_id, (params, 0))
+                    self._counts[key_id] = (params, count + newer)
+
+    def precompute(self) -> int:
+        """Recompute the hottest searches whose cached page is missing, half-way to expiry or from an older catalog."""
+        version = self._catalog_version()
+        refresh_before = time.monotonic() - self.ttl / 2
+        refreshed = 0
+        for entry in self._database.get_popular_search_queries(self.top_n):
+            try:
+                key = normalize_search(**entry["params"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            cached = self._cache.peek(key)
+            if cached is not None and cached["version"] == version and cached["computed_at"] > refresh_before:
+                continue
+            self._store(key, version, self._compute(key))
+            refreshed += 1
+        self.precomputed += refreshed
+        return refreshed
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.flush_counts)
+                await asyncio.to_thread(self.precompute)
+            except Exception:
+                logger.exception("Popular search precompute failed")
+
+    def frequency_table(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Most frequent searches across workers, including counts not yet flushed by this one."""
+        table = {
+            entry["_id"]: {"params": entry.get("params", {}), "count": entry.get("count", 0)}
+            for entry in self._database.get_popular_search_queries(limit)
+        }
+        with self._counts_lock:
+            for key_id, (params, count) in self._counts.items():
+                table.setdefault(key_id, {"params": params, "count": 0})["count"] += count
+        return sorted(table.values(), key=lambda item: item["count"], reverse=True)[:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._cache.stats(), "precomputed": self.precomputed}
+
+
+popular_queries = PopularQueryCache(db)
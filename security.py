@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+
+
+@lru_cache(maxsize=4)
+def password_context(rounds: int = BCRYPT_ROUNDS) -> CryptContext:
+    # Pinning the desired rounds makes needs_update() flag hashes made with
+    # any other cost, which drives rehash-on-login when BCRYPT_ROUNDS changes.
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_desired_rounds=rounds,
+        bcrypt__max_desired_rounds=rounds,
+    )
+
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return password_context(rounds).hash(password)
+
+
+def verify_password(password: str, password_hash: str, rounds: int = BCRYPT_ROUNDS) -> Tuple[bool, Optional[str]]:
+    """Return whether the password matches and, if the stored cost is outdated, a replacement hash."""
+    try:
+        return password_context(rounds).verify_and_update(password, password_hash or "")
+    except ValueError:
+        # Unknown or malformed hashes (e.g. seeded sample users) never match.
+        return False, None
+
+
+class PasswordHasher:
+    """Run bcrypt work in a dedicated process pool so it never blocks the event loop."""
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, rounds: int = BCRYPT_ROUNDS) -> None:
+        self.workers = workers
+        self.rounds = rounds
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawned workers avoid inheriting the parent's Mongo client threads.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info("Started password hashing pool with %s workers (bcrypt cost %s)", self.workers, self.rounds)
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(), hash_password, password, self.rounds)
+
+    async def verify(self, password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(), verify_password, password, password_hash, self.rounds)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
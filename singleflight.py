@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapse concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the work; callers that arrive while it is
+    still in flight wait for it and receive the same result (or exception).
+    When a result is shared, every caller gets its own deep copy, so no caller
+    can change what another one sees. Nothing is cached once the call completes.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        # key -> (task, [whether another caller joined it])
+        self._tasks: Dict[Hashable, Tuple[asyncio.Task, List[bool]]] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+                shared = call.waiters > 0
+            call.done.set()
+        # Waiters copy the result as they wake, so the leader must not hand out the original either.
+        return copy.deepcopy(call.result) if shared else call.result
+
+    async def do_async(
+        self,
+        key: Hashable,
+        fn: Callable[..., Awaitable[Any]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> Any:
+        entry = self._tasks.get(key)
+        leader = entry is None or entry[0].done()
+        if leader:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            shared = [False]
+            self._tasks[key] = (task, shared)
+            self.executions += 1
+            task.add_done_callback(lambda finished: self._forget_task(key, finished))
+        else:
+            task, shared = entry
+            shared[0] = True
+            self.coalesced += 1
+
+        # Shield the shared task so one cancelled caller does not cancel the
+        # work every other caller is waiting on.
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result) if shared[0] else result
+
+    def _forget_task(self, key: Hashable, task: asyncio.Task) -> None:
+        entry = self._tasks.get(key)
+        if entry is not None and entry[0] is task:
+            self._tasks.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "in_flight": len(self._calls) + len(self._tasks),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
+
+
+def normalize_message(message: Optional[str]) -> str:
+    return " ".join(str(message or "").lower().split())
@@ -0,0 +1,78 @@
+import cache
+from cache import FrequencyLRUCache
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _cache(monkeypatch, **kwargs) -> tuple[FrequencyLRUCache, Clock]:
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return FrequencyLRUCache("test", **kwargs), clock
+
+
+def test_frequent_entry_survives_burst_of_one_off_keys(monkeypatch):
+    lru, clock = _cache(monkeypatch, maxsize=3, half_life=60)
+    lru.set("hot", 1)
+    for _ in range(5):
+        lru.get("hot")
+    for number in range(10):
+        clock.now += 1
+        lru.set(f"once-{number}", number)
+
+    assert lru.get("hot") == 1
+    assert len(lru) == 3
+    assert lru.evictions == 8
+
+
+def test_weights_decay_so_stale_favourites_fade(monkeypatch):
+    lru, clock = _cache(monkeypatch, maxsize=2, half_life=10)
+    lru.set("old", 1)
+    for _ in range(3):
+        lru.get("old")
+    clock.now += 100
+    lru.set("new", 2)
+    lru.get("new")
+    lru.set("newer", 3)
+
+    assert lru.peek("old") is None
+    assert lru.peek("new") == 2
+
+
+def test_ties_evict_least_recently_used(monkeypatch):
+    lru, clock = _cache(monkeypatch, maxsize=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.set("c", 3)
+
+    assert lru.peek("a") is None
+    assert lru.peek("b") == 2 and lru.peek("c") == 3
+
+
+def test_ttl_expiry_and_peek_does_not_count(monkeypatch):
+    lru, clock = _cache(monkeypatch, maxsize=4, ttl=5)
+    lru.set("key", "value")
+    assert lru.peek("key") == "value"
+    assert lru.stats()["hits"] == 0
+
+    clock.now += 6
+    assert lru.get("key") is None
+    assert lru.stats()["misses"] == 1
+
+
+def test_refresh_keeps_earned_frequency(monkeypatch):
+    lru, clock = _cache(monkeypatch, maxsize=2, half_life=60)
+    lru.set("kept", 1)
+    lru.get("kept")
+    lru.get("kept")
+    lru.set("kept", 2)
+    lru.set("other", 3)
+    lru.set("third", 4)
+
+    assert lru.peek("kept") == 2
+    assert lru.peek("other") is None
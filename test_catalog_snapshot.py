@@ -0,0 +1,101 @@
+import math
+
+from bson import ObjectId
+
+from catalog import ProductRecord
+from catalog_snapshot import CatalogSnapshot, write_snapshot
+
+
+def _product(product_id, **fields):
+    product = {
+        "_id": ObjectId(),
+        "id": product_id,
+        "product_name": f"Product {product_id}",
+        "description": "",
+        "dress_category": "women-dresses",
+        "occasion": "Party",
+        "price": 100.0,
+        "stock": 3,
+        "colors": "Black",
+        "available_sizes": "S,M",
+        "featured_dress": False,
+    }
+    product.update(fields)
+    return product
+
+
+def _snapshot(tmp_path, products):
+    path = str(tmp_path / "catalog.snap")
+    write_snapshot(products, path, version=1)
+    return CatalogSnapshot(path)
+
+
+def test_rows_round_trip(tmp_path):
+    products = [
+        _product(3, tags=["new"], price=49.5),
+        _product(1, stock=0, featured_dress=True, material="Silk"),
+        _product(2, price=120, colors=None),
+    ]
+    del products[0]["description"]
+    snapshot = _snapshot(tmp_path, products)
+
+    assert len(snapshot) == 3
+    assert snapshot.rows(range(3)) == products
+    assert snapshot.position(2) == 2
+    assert snapshot.position("1") == 1
+    assert snapshot.position(99) is None
+
+
+def test_contains_does_not_match_across_rows(tmp_path):
+    snapshot = _snapshot(
+        tmp_path,
+        [
+            _product(1, product_name="Classic Sil", colors="red"),
+            _product(2, product_name="k Gown", colors="blue"),
+            _product(3, product_name="Silk Slip", colors="Navy,Red"),
+        ],
+    )
+
+    assert snapshot.contains("product_name", "silk").tolist() == [False, False, True]
+    assert snapshot.contains("colors", "redb").tolist() == [False, False, False]
+    assert snapshot.contains("colors", "red").tolist() == [True, False, True]
+    assert snapshot.contains("product_name", "gown").tolist() == [False, True, False]
+
+
+def test_contains_finds_hit_after_a_rejected_boundary_match(tmp_path):
+    snapshot = _snapshot(
+        tmp_path,
+        [_product(1, colors="ab"), _product(2, colors="c"), _product(3, colors="abc")],
+    )
+    assert snapshot.contains("colors", "abc").tolist() == [False, False, True]
+
+
+def test_missing_price_fails_price_filters(tmp_path):
+    no_price = _product(2)
+    del no_price["price"]
+    snapshot = _snapshot(tmp_path, [_product(1, price=80.0), no_price, _product(3, price="n/a")])
+
+    assert math.isnan(snapshot.array("price")[1])
+    assert snapshot.filter_mask(max_price=100).tolist() == [True, False, False]
+    assert snapshot.filter_mask(min_price=0).tolist() == [True, False, False]
+    assert snapshot.filter_mask().tolist() == [True, True, True]
+    assert "price" not in snapshot.row(1)
+    assert snapshot.row(2)["price"] == "n/a"
+
+    record = ProductRecord(no_price)
+    assert not record.matches(max_price=100)
+    assert record.matches()
+
+
+def test_filter_mask_matches_category_prefix_and_occasion(tmp_path):
+    snapshot = _snapshot(
+        tmp_path,
+        [
+            _product(1, dress_category="Women-Dresses", occasion="Party"),
+            _product(2, dress_category="men-suits", occasion="Formal"),
+            _product(3, dress_category="women-tops", occasion="formal "),
+        ],
+    )
+    assert snapshot.filter_mask(category="women").tolist() == [True, False, True]
+    assert snapshot.filter_mask(category="women-dresses").tolist() == [True, False, False]
+    assert snapshot.filter_mask(occasion="Formal").tolist() == [False, True, True]
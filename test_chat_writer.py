@@ -0,0 +1,46 @@
+import asyncio
+
+from bson import ObjectId
+
+import chat_writer
+from chat_writer import ChatMessageWriter
+
+
+class _FlakyDatabase:
+    def __init__(self, failures):
+        self.failures = failures
+        self.stored = []
+        self.folded = []
+
+    def build_chat_message(self, session_id, role, content, agent_type=None):
+        return {"_id": ObjectId(), "session_id": session_id, "message_type": role, "content": content}
+
+    def store_chat_messages(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("primary unavailable")
+        self.stored.extend(messages)
+
+    def fold_chat_messages(self, messages, batch_id):
+        self.folded.append(batch_id)
+
+
+def test_failed_store_stays_pending_until_it_lands(monkeypatch):
+    monkeypatch.setattr(chat_writer, "CHAT_WRITE_MAX_BACKOFF_SECONDS", 0)
+    database = _FlakyDatabase(failures=5)
+    writer = ChatMessageWriter(database, max_retries=2)
+
+    async def scenario():
+        await writer.start()
+        writer.enqueue("s1", "user", "hello")
+        writer.enqueue("s1", "assistant", "hi there")
+        await asyncio.sleep(0)
+        # Past max_retries the messages are still visible to the current turn.
+        assert [message["content"] for message in writer.pending_messages("s1")] == ["hello", "hi there"]
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert database.failures == 0
+    assert [message["content"] for message in database.stored] == ["hello", "hi there"]
+    assert len(database.folded) == 1
+    assert writer.pending_messages("s1") == []
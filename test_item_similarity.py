@@ -0,0 +1,77 @@
+import math
+import random
+from datetime import datetime, timedelta
+
+import item_similarity
+from item_similarity import blend_scores, build_item_similarity, view_sessions
+
+
+def _brute_force(baskets):
+    frequency, together = {}, {}
+    for basket, weight in baskets:
+        unique = list(dict.fromkeys(basket))
+        if len(unique) < 2:
+            continue
+        for left in unique:
+            frequency[left] = frequency.get(left, 0.0) + weight
+            for right in unique:
+                if left != right:
+                    together[left, right] = together.get((left, right), 0.0) + weight
+    return {pair: value / math.sqrt(frequency[pair[0]] * frequency[pair[1]]) for pair, value in together.items()}
+
+
+def _random_baskets(seed=3, count=300):
+    rng = random.Random(seed)
+    return [
+        ([rng.randint(1, 40) for _ in range(rng.randint(1, 8))], rng.choice([1.0, 0.3]))
+        for _ in range(count)
+    ]
+
+
+def test_matches_brute_force_cosine():
+    baskets = _random_baskets()
+    expected = _brute_force(baskets)
+    similarity = build_item_similarity(baskets, top_k=1000)
+
+    for (left, right), score in expected.items():
+        found = dict(similarity.neighbours_of(left))
+        assert math.isclose(found[right], score, rel_tol=1e-5)
+    assert sum(len(similarity.neighbours_of(pid)) for pid in similarity.product_ids.tolist()) == len(expected)
+
+
+def test_keeps_top_k_best_first_and_chunking_does_not_change_scores(monkeypatch):
+    baskets = _random_baskets(seed=11)
+    whole = build_item_similarity(baskets, top_k=5)
+    monkeypatch.setattr(item_similarity, "PAIR_CHUNK", 7)
+    chunked = build_item_similarity(baskets, top_k=5)
+
+    for product_id in whole.product_ids.tolist():
+        neighbours = whole.neighbours_of(product_id)
+        assert len(neighbours) <= 5
+        assert [score for _, score in neighbours] == sorted((score for _, score in neighbours), reverse=True)
+        assert neighbours == chunked.neighbours_of(product_id)
+
+
+def test_single_item_baskets_and_unknown_products():
+    similarity = build_item_similarity([([1], 1.0), ([2, 2], 1.0), (["3", "x", 4], 1.0)])
+    assert similarity.product_ids.tolist() == [3, 4]
+    assert similarity.neighbours_of(3) == [(4, 1.0)]
+    assert similarity.neighbours_of(1) == []
+    assert len(build_item_similarity([])) == 0
+
+
+def test_view_sessions_split_on_user_and_gap():
+    start = datetime(2024, 1, 1)
+    views = [
+        {"user_id": "a", "product_id": 1, "created_at": start},
+        {"user_id": "a", "product_id": "2", "created_at": start + timedelta(minutes=10)},
+        {"user_id": "a", "product_id": 3, "created_at": start + timedelta(hours=2)},
+        {"user_id": "b", "product_id": 4, "created_at": start + timedelta(hours=2)},
+        {"user_id": "b", "product_id": None, "created_at": start + timedelta(hours=2)},
+    ]
+    assert list(view_sessions(views)) == [[1, 2], [3], [4]]
+
+
+def test_blend_scores_sums_and_excludes_seeds():
+    scores = blend_scores({1: [(2, 0.5), (3, 0.25)], 2: [(3, 0.5), (1, 0.9)]}, exclude=["1", 2])
+    assert scores == {3: 0.75}
@@ -0,0 +1,60 @@
+from prompt_budget import MESSAGE_OVERHEAD_TOKENS, PromptBudget, count_tokens, fold_turns_into_summary, truncate_to_tokens
+
+
+def _history(turns, words=40):
+    return [
+        {"role": "user" if index % 2 == 0 else "assistant", "content": f"turn {index} " + "word " * words}
+        for index in range(turns)
+    ]
+
+
+def test_truncate_to_tokens_respects_limit():
+    text = "alpha beta gamma delta " * 50
+    truncated = truncate_to_tokens(text, 20)
+    assert truncated.endswith("…")
+    assert count_tokens(truncated) <= 20
+    assert truncate_to_tokens("short text", 20) == "short text"
+    assert truncate_to_tokens("anything", 0) == ""
+
+
+def test_long_history_and_context_stay_within_total():
+    budget = PromptBudget(total_tokens=1000)
+    sections = [
+        ("system", "You are a helpful stylist."),
+        ("products", "product " * 2000),
+        ("tools", "tool output " * 2000),
+        ("memory", "remembered " * 500),
+    ]
+    assembly = budget.assemble(sections, _history(200), "show me a dress", summary="earlier " * 800)
+
+    assert assembly.total_tokens + MESSAGE_OVERHEAD_TOKENS <= budget.total_tokens
+    assert assembly.section_tokens["products"] <= budget.section_budgets["products"]
+    assert assembly.dropped_turns
+
+
+def test_history_keeps_newest_turns_and_reports_dropped():
+    budget = PromptBudget(total_tokens=4000, section_budgets={"history": 200})
+    history = _history(30)
+    assembly = budget.assemble([("system", "rules")], history, "hi")
+
+    kept = assembly.messages[1:-1]
+    assert kept
+    assert kept[-1]["content"] == history[-1]["content"]
+    assert assembly.section_tokens["history"] <= 200
+    assert assembly.dropped_turns == history[: len(history) - len(kept)]
+
+
+def test_history_budget_is_zero_when_fixed_sections_use_everything():
+    budget = PromptBudget(total_tokens=50)
+    assembly = budget.assemble([("system", "rule " * 200)], _history(4), "hello")
+
+    assert assembly.section_tokens["history"] == 0
+    assert len(assembly.dropped_turns) == 4
+    assert assembly.messages[-1] == {"role": "user", "content": "hello"}
+
+
+def test_fold_turns_into_summary_keeps_newest_lines():
+    summary = fold_turns_into_summary("", _history(50, words=10), max_tokens=60)
+    assert count_tokens(summary) <= 60
+    assert "turn 49" in summary
+    assert "turn 0 " not in summary
@@ -0,0 +1,64 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+from database import Database, utc_now
+
+
+class _Sessions:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        return [session for session in self.documents if session["user_id"] in query["user_id"]["$in"]]
+
+
+class _Messages:
+    """Evaluates the $match / $sort / $group $push / $slice pipeline of get_users_recent_messages."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def aggregate(self, pipeline, **kwargs):
+        session_ids = pipeline[0]["$match"]["session_id"]["$in"]
+        push = pipeline[2]["$group"]["messages"]["$push"]
+        limit = pipeline[3]["$project"]["messages"]["$slice"][1]
+        groups = {}
+        for message in sorted(self.documents, key=lambda message: message["created_at"], reverse=True):
+            if message["session_id"] in session_ids:
+                # Like MongoDB, an expression object leaves out fields the document does not have.
+                pushed = {key: message[path[1:]] for key, path in push.items() if path[1:] in message}
+                groups.setdefault(message["session_id"], []).append(pushed)
+        return [{"_id": session_id, "messages": messages[:limit]} for session_id, messages in groups.items()]
+
+
+def _database(sessions, messages):
+    database = Database(db_name="test")
+    database._db = SimpleNamespace(chat_sessions=_Sessions(sessions), chat_messages=_Messages(messages))
+    return database
+
+
+def test_recent_messages_keep_the_stored_message_shape():
+    database = Database(db_name="test")
+    now = utc_now()
+    messages = []
+    for index in range(6):
+        message = database.build_chat_message("s1" if index % 2 else "s2", "user" if index % 3 else "assistant", f"m{index}")
+        message["created_at"] = now + timedelta(minutes=index)
+        messages.append(message)
+    messages.append(database.build_chat_message("s3", "user", "red dress"))
+    database = _database(
+        [{"session_id": "s1", "user_id": "u1"}, {"session_id": "s2", "user_id": "u1"}, {"session_id": "s3", "user_id": "u2"}],
+        messages,
+    )
+
+    recent = database.get_users_recent_messages(["u1", "u2", "u3"], limit=4)
+
+    assert [message["content"] for message in recent["u1"]] == ["m2", "m3", "m4", "m5"]
+    assert [message["content"] for message in recent["u2"]] == ["red dress"]
+    assert recent["u3"] == []
+    stored = {message["content"]: message for message in messages}
+    for message in recent["u1"] + recent["u2"]:
+        assert set(message) == {"session_id", "message_type", "content", "created_at"}
+        original = stored[message["content"]]
+        assert message["message_type"] == original["message_type"]
+        assert message["session_id"] == original["session_id"]
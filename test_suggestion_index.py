@@ -0,0 +1,76 @@
+from catalog import SuggestionIndex
+
+
+def _products(count, start=1):
+    return [
+        {
+            "id": product_id,
+            "product_name": f"Silk Gown {product_id}",
+            "dress_category": "women-dresses" if product_id % 2 else "men-suits",
+            "occasion": "Party",
+            "colors": "Black, Red",
+            "material": "Silk",
+        }
+        for product_id in range(start, start + count)
+    ]
+
+
+def test_empty_index_suggests_nothing():
+    index = SuggestionIndex()
+    assert index.suggest("silk") == []
+    index.rerank({1: 5})
+    assert index.version is None
+
+
+def test_prefix_matches_any_word_and_ranks_by_views():
+    index = SuggestionIndex(top_k=5, scan_limit=4)
+    index.update(_products(20), {7: 100, 3: 50}, version=1)
+
+    gowns = [item["product_id"] for item in index.suggest("gown") if item["kind"] == "product"]
+    assert gowns[:2] == [7, 3]
+    assert {item["text"] for item in index.suggest("wom")} == {"Women Dresses"}
+    assert {item["text"] for item in index.suggest("re")} >= {"Red"}
+    assert index.suggest("zzz") == []
+    assert len(index.suggest("s", limit=3)) == 3
+
+
+def test_added_products_extend_incrementally():
+    index = SuggestionIndex(top_k=5, scan_limit=4)
+    products = _products(10)
+    index.update(products, {}, version=1)
+    index.update(products + _products(3, start=11), {12: 500}, version=2)
+
+    assert index.incremental_updates == 1 and index.builds == 1
+    assert index.version == 2
+    assert index.suggest("silk gown 12")[0]["product_id"] == 12
+
+
+def test_edits_rebuild_and_rerank_keeps_version():
+    index = SuggestionIndex(top_k=5, scan_limit=4)
+    products = _products(10)
+    index.update(products, {}, version=1)
+    products[0] = {**products[0], "product_name": "Velvet Blazer 1"}
+    index.update(products, {}, version=2)
+    assert index.builds == 2
+    assert index.suggest("velvet")[0]["product_id"] == 1
+
+    index.rerank({9: 1000})
+    assert index.version == 2 and index.reranks == 1
+    assert [item["product_id"] for item in index.suggest("gown")][0] == 9
+
+
+def test_extend_refreshes_heads_of_rescored_shared_suggestions():
+    index = SuggestionIndex(top_k=1, scan_limit=2)
+    products = [
+        {"id": 1, "product_name": "Linen Shirt 1", "colors": "Blue"},
+        {"id": 2, "product_name": "Linen Shirt 2", "colors": "Beige"},
+        {"id": 3, "product_name": "Linen Shirt 3", "colors": "Brown"},
+    ]
+    index.update(products, {1: 5}, version=1)
+    assert index.suggest("b")[0]["text"] == "Blue"
+
+    # The new product only adds keys under "s"; "Brown" overtakes "Blue" by score alone.
+    added = {"id": 4, "product_name": "Shirt 4", "colors": "Brown"}
+    index.update(products + [added], {1: 5, 4: 50}, version=2)
+    assert index.incremental_updates == 1
+    assert index.suggest("b")[0]["text"] == "Brown"
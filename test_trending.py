@@ -0,0 +1,54 @@
+import trending
+from trending import TrendingIndex, activity_products
+
+
+def _index(monkeypatch, **kwargs) -> TrendingIndex:
+    monkeypatch.setattr(trending.time, "time", lambda: 0.0)
+    return TrendingIndex(**kwargs)
+
+
+def test_scores_halve_every_half_life(monkeypatch):
+    index = _index(monkeypatch, half_life_hours=1)
+    index.record(1, "dresses", 4.0, at=0.0)
+    assert index.score(1, now=3600.0) == 2.0
+    assert index.score(1, now=7200.0) == 1.0
+    assert index.score(2, now=0.0) == 0.0
+
+
+def test_recent_event_outranks_older_heavier_one(monkeypatch):
+    index = _index(monkeypatch, half_life_hours=1)
+    index.record(1, "dresses", 3.0, at=0.0)
+    index.record(2, "dresses", 1.0, at=3 * 3600.0)
+    assert [product_id for product_id, _ in index.top(limit=2)] == [2, 1]
+
+
+def test_top_n_overall_and_per_category(monkeypatch):
+    index = _index(monkeypatch, top_n=2)
+    for product_id, category, weight in [(1, "dresses", 1.0), (2, "suits", 5.0), (3, "dresses", 3.0), (4, None, 4.0)]:
+        index.record(product_id, category, weight, at=0.0)
+    index.record(1, "dresses", 5.0, at=0.0)
+
+    assert [product_id for product_id, _ in index.top()] == [1, 2]
+    assert [product_id for product_id, _ in index.top("dresses")] == [1, 3]
+    assert [product_id for product_id, _ in index.top("suits")] == [2]
+    assert index.hot_products() == {1, 2, 3}
+    assert index.stats()["categories"] == 2
+
+
+def test_rebase_keeps_ranking_and_current_scores(monkeypatch):
+    index = _index(monkeypatch, half_life_hours=1)
+    index.record(1, None, 2.0, at=0.0)
+    index.record(2, None, 1.0, at=0.0)
+    late = (trending.MAX_EXPONENT + 1) * 3600.0
+    monkeypatch.setattr(trending.time, "time", lambda: late)
+    index.record(3, None, 1.0, at=late)
+
+    assert index.rebases == 1
+    assert index.score(3, now=late) == 1.0
+    assert [product_id for product_id, _ in index.top(limit=1)] == [3]
+
+
+def test_activity_products():
+    assert activity_products({"product_id": "7"}) == [7]
+    assert activity_products({"metadata": {"product_ids": [1, "2", "x"]}}) == [1, 2]
+    assert activity_products({}) == []
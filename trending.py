@@ -0,0 +1,232 @@
+"""
+Time-decayed trending scores per product, maintained event by event.
+
+A product's score is the sum of its activity weights, each halving every
+TRENDING_HALF_LIFE_HOURS. Scores are kept relative to a fixed epoch
+(``weight * 2 ** ((t - epoch) / half_life)``), so an event is a single
+addition and every score decays by the same factor: the ranking only changes
+when a product receives an event, which lets the top-N lists per category be
+maintained exactly on each update instead of by re-sorting the catalog.
+
+Every worker applies its own activities immediately and tails
+``user_activity`` for the ones recorded by other workers, so no worker ever
+rescans the activity history after its warm start.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from catalog import normalize_key
+from database import Database, db
+
+logger = logging.getLogger(__name__)
+
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+TRENDING_TOP_N = int(os.getenv("TRENDING_TOP_N", "50"))
+TRENDING_SYNC_INTERVAL_SECONDS = float(os.getenv("TRENDING_SYNC_INTERVAL_SECONDS", "2"))
+TRENDING_WEIGHTS: Dict[str, float] = {"product_view": 1.0, "cart_add": 3.0, "checkout_started": 5.0}
+# Events older than this many half-lives weigh under 1/32 and are skipped on warm start.
+WARM_START_HALF_LIVES = 5
+# ObjectIds from different workers are only ordered to the second, so the tail re-reads this much.
+TAIL_OVERLAP_SECONDS = 5.0
+# Rebase well before 2 ** exponent could overflow a float.
+MAX_EXPONENT = 512.0
+
+
+def activity_products(activity: Dict[str, Any]) -> List[int]:
+    """Product ids an activity is about: its product_id, or the products of a checkout."""
+    metadata = activity.get("metadata") or {}
+    values = [activity.get("product_id")] if activity.get("product_id") is not None else metadata.get("product_ids", [])
+    products = []
+    for value in values:
+        try:
+            products.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return products
+
+
+def _timestamp(value: Any) -> float:
+    if isinstance(value, datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+    return time.time()
+
+
+class TrendingIndex:
+    """Decayed scores and exact top-N lists, overall and per category."""
+
+    def __init__(self, half_life_hours: float = TRENDING_HALF_LIFE_HOURS, top_n: int = TRENDING_TOP_N) -> None:
+        self.half_life = half_life_hours * 3600
+        self.top_n = top_n
+        self.epoch = time.time()
+        self._scores: Dict[int, float] = {}
+        self._top: Dict[Optional[str], List[int]] = {}
+        self._lock = threading.Lock()
+        self.events = 0
+        self.rebases = 0
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def record(self, product_id: int, category: Optional[str], weight: float, at: float) -> None:
+        with self._lock:
+            exponent = (at - self.epoch) / self.half_life
+            if exponent > MAX_EXPONENT:
+                self._rebase(at)
+                exponent = 0.0
+            score = self._scores.get(product_id, 0.0) + weight * 2.0**exponent
+            self._scores[product_id] = score
+            self._promote(None, product_id, score)
+            if category:
+                self._promote(category, product_id, score)
+            self.events += 1
+
+    def _promote(self, key: Optional[str], product_id: int, score: float) -> None:
+        top = self._top.setdefault(key, [])
+        if product_id in top:
+            top.sort(key=self._scores.__getitem__, reverse=True)
+        elif len(top) < self.top_n or score > self._scores[top[-1]]:
+            top.append(product_id)
+            top.sort(key=self._scores.__getitem__, reverse=True)
+            del top[self.top_n :]
+
+    def _rebase(self, now: float) -> None:
+        factor = 2.0 ** (-(now - self.epoch) / self.half_life)
+        self._scores = {product_id: score * factor for product_id, score in self._scores.items() if score * factor > 0.0}
+        for top in self._top.values():
+            top[:] = [product_id for product_id in top if product_id in self._scores]
+        self.epoch = now
+        self.rebases += 1
+
+    def _current(self, score: float, now: float) -> float:
+        return score * 2.0 ** ((self.epoch - now) / self.half_life)
+
+    def score(self, product_id: int, now: Optional[float] = None) -> float:
+        return self._current(self._scores.get(product_id, 0.0), now or time.time())
+
+    def top(self, category: Optional[str] = None, limit: int = TRENDING_TOP_N) -> List[Tuple[int, float]]:
+        """Up to ``limit`` (product_id, current score) pairs, hottest first."""
+        now = time.time()
+        with self._lock:
+            top = list(self._top.get(category, ())[:limit])
+            return [(product_id, self._current(self._scores[product_id], now)) for product_id in top]
+
+    def hot_products(self) -> set[int]:
+        """Products in the top-N overall or in their category."""
+        with self._lock:
+            return {product_id for top in self._top.values() for product_id in top}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "products": len(self._scores),
+            "categories": len(self._top) - (None in self._top),
+            "events": self.events,
+            "rebases": self.rebases,
+            "half_life_hours": self.half_life / 3600,
+        }
+
+
+class TrendingTracker:
+    """Feed a TrendingIndex from this worker's activities and from the shared activity log."""
+
+    def __init__(self, database: Database, interval: float = TRENDING_SYNC_INTERVAL_SECONDS) -> None:
+        self._database = database
+        self.interval = interval
+        self.index = TrendingIndex()
+        self._seen: Dict[ObjectId, float] = {}
+        self._seen_lock = threading.Lock()
+        self._tail_from: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self.synced = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _category_of(self, product_id: int) -> Optional[str]:
+        return self._database.product_categories().get(product_id)
+
+    def record_activity(self, activity: Dict[str, Any]) -> None:
+        """Apply one activity unless it was already applied (by this call or the tail)."""
+        weight = TRENDING_WEIGHTS.get(activity.get("activity_type"))
+        if weight is None:
+            return
+        activity_id = activity.get("_id")
+        if activity_id is not None:
+            with self._seen_lock:
+                if activity_id in self._seen:
+                    return
+                self._seen[activity_id] = time.time()
+        at = _timestamp(activity.get("created_at"))
+        for product_id in activity_products(activity):
+            self.index.record(product_id, self._category_of(product_id), weight, at)
+
+    def sync(self) -> int:
+        """Apply activities recorded since the last sync; the first sync warms up from recent history."""
+        if self._tail_from is None:
+            self._tail_from = datetime.now(timezone.utc) - timedelta(
+                seconds=self.index.half_life * WARM_START_HALF_LIVES
+            )
+        started = datetime.now(timezone.utc)
+        applied = 0
+        activities = self._database.iter_activity_since(
+            self._tail_from - timedelta(seconds=TAIL_OVERLAP_SECONDS), list(TRENDING_WEIGHTS)
+        )
+        for activity in activities:
+            before = self.index.events
+            self.record_activity(activity)
+            applied += self.index.events > before
+        # The next sync re-reads from here, so only ids generated since can come back.
+        self._tail_from = started
+        keep_after = started - timedelta(seconds=TAIL_OVERLAP_SECONDS + 1)
+        with self._seen_lock:
+            self._seen = {
+                activity_id: seen_at
+                for activity_id, seen_at in self._seen.items()
+                if activity_id.generation_time >= keep_after
+            }
+        self.synced += applied
+        return applied
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception:
+                logger.exception("Trending sync failed")
+            await asyncio.sleep(self.interval)
+
+    def top(self, category: Optional[str] = None, limit: int = TRENDING_TOP_N) -> List[Tuple[int, float]]:
+        return self.index.top(normalize_key(category), limit)
+
+    def hot_products(self) -> set[int]:
+        return self.index.hot_products()
+
+    def score(self, product_id: int) -> float:
+        return self.index.score(product_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.index.stats(), "synced": self.synced, "pending_dedupe": len(self._seen)}
+
+
+trending = TrendingTracker(db)
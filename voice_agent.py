@@ -4,6 +4,8 @@ from typing import Final
 
 import requests
 
+from singleflight import SingleFlight
+
 VOICE_STAGE_ORDER: Final[dict[str, str]] = {
     "intro": "qualification",
     "qualification": "closing",
@@ -14,6 +16,7 @@ GEMINI_API_URL: Final[str] = "https://generativelanguage.googleapis.com/v1beta/m
 DEFAULT_GEMINI_MODEL: Final[str] = "gemini-2.5-flash-lite"
 
 logger = logging.getLogger(__name__)
+gemini_flight = SingleFlight("gemini")
 
 
 def get_next_stage(stage: str) -> str:
@@ -57,6 +60,10 @@ def call_gemini(prompt: str) -> str:
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY is not configured.")
 
+    return gemini_flight.do((model, prompt), _request_gemini, prompt, api_key, model)
+
+
+def _request_gemini(prompt: str, api_key: str, model: str) -> str:
     response = requests.post(
         GEMINI_API_URL.format(model=model),
         params={"key": api_key},